@@ -2,14 +2,16 @@ from __future__ import annotations
 
 import logging
 import re
-from typing import Optional, List, Union, Callable
+from typing import Optional, List, Union, Callable, Dict, Type, Any
 
 import sqlalchemy as sql
 from pgvector.sqlalchemy import Vector
 
 from pixeltable import exceptions as exc
 from pixeltable.metadata import schema
-from pixeltable.type_system import ColumnType, StringType
+from pixeltable.type_system import ColumnType, StringType, FloatType, IntType
+from pixeltable.utils.imgcodec import ImageCodec
+from pixeltable.utils.vector_index import VectorIndex
 
 _ID_RE = r'[a-zA-Z]\w*'
 _PATH_RE = f'{_ID_RE}(\\.{_ID_RE})*'
@@ -23,11 +25,18 @@ class Column:
     A Column contains all the metadata necessary for executing queries and updates against a particular version of a
     table/view.
     """
+    # video metadata that is probed at insert time (see utils.video.probe()) and stored alongside video columns
+    VIDEO_MD_TYPES: Dict[str, Type[ColumnType]] = {
+        'duration': FloatType, 'fps': FloatType, 'width': IntType, 'height': IntType, 'num_frames': IntType,
+        'codec': StringType, 'bitrate': IntType,
+    }
+
     def __init__(
             self, name: str, col_type: Optional[ColumnType] = None,
             computed_with: Optional[Union['Expr', Callable]] = None,
             primary_key: bool = False, stored: Optional[bool] = None,
-            indexed: bool = False,
+            indexed: bool = False, index_params: Optional[Dict[str, Any]] = None,
+            img_format: Optional[str] = None, img_quality: Optional[int] = None, img_packed: bool = False,
             # these parameters aren't set by users
             col_id: Optional[int] = None):
         """Column constructor.
@@ -39,6 +48,10 @@ class Column:
             primary_key: if True, this column is part of the primary key
             stored: determines whether a computed column is present in the stored table or recomputed on demand
             indexed: if True, this column has a nearest neighbor index (only valid for image columns)
+            index_params: type, distance metric and build/query parameters of the index (see VectorIndex)
+            img_format: storage format of a stored image column ('jpeg', 'png', 'webp' or 'npy'); None: jpeg
+            img_quality: encoding quality (1-100) for img_format 'jpeg' or 'webp'
+            img_packed: if True, stores images in segment files instead of one file per image
             col_id: column ID (only used internally)
 
         Computed columns: those have a non-None ``computed_with`` argument
@@ -60,6 +73,14 @@ class Column:
         - if None: the system chooses for you (at present, this is always False, but this may change in the future)
 
         indexed: only valid for image columns; if true, maintains an NN index for this column
+
+        index_params: only valid for indexed columns; for example, ``{'type': 'hnsw', 'metric': 'cosine', 'm': 32}``
+
+        ``img_format``/``img_quality`` (only valid for image columns): determine how images are encoded when they are
+        written to the image store; images that are unmodified copies of a source file are not re-encoded.
+
+        img_packed: only valid for image columns; packing small images (eg, thumbnails or crops) into large segment
+        files avoids the per-file overhead of the file system.
         """
         if re.fullmatch(_ID_RE, name) is None:
             raise exc.Error(f"Invalid column name: '{name}'")
@@ -104,12 +125,29 @@ class Column:
         self.sa_errortype_col: Optional[sql.schema.Column] = None
         # indexed columns also have a column for the embeddings
         self.sa_idx_col: Optional[sql.schema.Column] = None
+        # video columns also have columns for their metadata; columns created before these existed don't have them
+        self.has_video_md = self.col_type.is_video_type() and not self.is_computed
+        self.sa_video_md_cols: Dict[str, sql.schema.Column] = {}
         from .table_version import TableVersion
         self.tbl: Optional[TableVersion] = None  # set by owning TableVersion
 
         if indexed and not self.col_type.is_image_type():
             raise exc.Error(f'Column {name}: indexed=True requires ImageType')
         self.is_indexed = indexed
+        if index_params is not None and not indexed:
+            raise exc.Error(f'Column {name}: index_params requires indexed=True')
+        try:
+            self.index = VectorIndex.from_dict(index_params) if indexed else None
+        except (exc.Error, TypeError) as e:
+            raise exc.Error(f'Column {name}: {e}')
+
+        if (img_format is not None or img_quality is not None or img_packed) and not self.col_type.is_image_type():
+            raise exc.Error(f'Column {name}: img_format, img_quality and img_packed require ImageType')
+        try:
+            self.img_codec = ImageCodec(img_format, img_quality)
+        except exc.Error as e:
+            raise exc.Error(f'Column {name}: {e}')
+        self.img_packed = img_packed
 
     @classmethod
     def from_md(cls, col_id: int, md: schema.SchemaColumn, tbl: 'TableVersion') -> Column:
@@ -119,7 +157,9 @@ class Column:
         """
         col = cls(
             md.name, col_type=ColumnType.from_dict(md.col_type), primary_key=md.is_pk,
-            stored=md.stored, indexed=md.is_indexed, col_id=col_id)
+            stored=md.stored, indexed=md.is_indexed, index_params=md.index_params, img_format=md.img_format,
+            img_quality=md.img_quality, img_packed=md.img_packed, col_id=col_id)
+        col.has_video_md = md.has_video_md
         col.tbl = tbl
         return col
 
@@ -172,6 +212,11 @@ class Column:
             self.sa_errortype_col = sql.Column(self.errortype_storage_name(), StringType().to_sa_type(), nullable=True)
         if self.is_indexed:
             self.sa_idx_col = sql.Column(self.index_storage_name(), Vector(512), nullable=True)
+        if self.has_video_md:
+            self.sa_video_md_cols = {
+                name: sql.Column(self.video_md_storage_name(name), col_type().to_sa_type(), nullable=True)
+                for name, col_type in self.VIDEO_MD_TYPES.items()
+            }
 
     def storage_name(self) -> str:
         assert self.id is not None
@@ -187,6 +232,9 @@ class Column:
     def index_storage_name(self) -> str:
         return f'{self.storage_name()}_idx_0'
 
+    def video_md_storage_name(self, name: str) -> str:
+        return f'{self.storage_name()}_{name}'
+
     def __str__(self) -> str:
         return f'{self.name}: {self.col_type}'
 
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import logging
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 from uuid import UUID
 
 import sqlalchemy.orm as orm
@@ -34,11 +34,13 @@ class MutableTable(Table):
             num_retained_versions: int,
             extract_frames_from: Optional[str], extracted_frame_col: Optional[str],
             extracted_frame_idx_col: Optional[str], extracted_fps: Optional[int],
+            extraction_mode: str = 'fps', decoder: Optional[Dict[str, Any]] = None,
     ) -> MutableTable:
         with orm.Session(Env.get().engine, future=True) as session:
             tbl_version = TableVersion.create(
                 dir_id, name, cols, None, None, num_retained_versions, extract_frames_from, extracted_frame_col,
-                extracted_frame_idx_col, extracted_fps, session)
+                extracted_frame_idx_col, extracted_fps, session, extraction_mode=extraction_mode,
+                decoder=decoder)
             tbl = cls(dir_id, tbl_version)
             session.commit()
             _logger.info(f'created table {name}, id={tbl_version.id}')
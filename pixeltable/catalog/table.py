@@ -1,8 +1,9 @@
 from __future__ import annotations
 
 import dataclasses
+import itertools
 import logging
-from typing import Optional, List, Dict, Any, Union
+from typing import Optional, List, Dict, Any, Union, Iterator
 from uuid import UUID
 
 from .table_base import TableBase
@@ -95,7 +96,10 @@ class Table(TableBase):
         self._check_is_dropped()
         self.tbl_version.rename_column(old_name, new_name)
 
-    def insert(self, rows: List[List[Any]], columns: List[str] = [], print_stats: bool = False) -> Table.UpdateStatus:
+    def insert(
+            self, rows: List[List[Any]], columns: List[str] = [], print_stats: bool = False,
+            chunk_size: Optional[int] = None
+    ) -> Table.UpdateStatus:
         """Insert rows into table.
 
         Args:
@@ -103,6 +107,8 @@ class Table(TableBase):
             columns: A list of column names that specify the columns present in ``rows``.
                 If ``columns`` is empty, all non-computed columns are present in ``rows``.
             print_stats: If ``True``, print statistics about the cost of computed columns.
+            chunk_size: If given, insert and commit the rows in chunks of ``chunk_size`` rows, each of which creates a
+                new table version. Rows of chunks that were committed before a failure remain in the table.
 
         Returns:
             execution status
@@ -134,6 +140,8 @@ class Table(TableBase):
                 raise exc.Error('rows must be a list of lists')
         if not isinstance(columns, list):
             raise exc.Error('columns must be a list of column names')
+        if chunk_size is not None and (not isinstance(chunk_size, int) or chunk_size <= 0):
+            raise exc.Error('chunk_size must be a positive integer')
         for col_name in columns:
             if not isinstance(col_name, str):
                 raise exc.Error('columns must be a list of column names')
@@ -166,7 +174,73 @@ class Table(TableBase):
                 f'({", ".join(columns)})')
 
         self.tbl_version.check_input_rows(rows, columns)
-        return self.tbl_version.insert(rows, columns, print_stats=print_stats)
+        return self.tbl_version.insert(rows, columns, print_stats=print_stats, chunk_size=chunk_size)
+
+    def insert_from(
+            self, source: Any, columns: Optional[List[str]] = None, print_stats: bool = False,
+            chunk_size: Optional[int] = None
+    ) -> Table.UpdateStatus:
+        """Insert rows from a bulk data source into the table.
+
+        The data is read and validated one batch of rows at a time, column by column, and streamed into the table,
+        without materializing it in memory.
+
+        Args:
+            source: One of
+
+                - an iterable of rows (eg, a generator), each of which is a list of values
+                - a pandas ``DataFrame``
+                - a pyarrow ``Table``, ``RecordBatch`` or ``RecordBatchReader``
+                - the path of a Parquet (``.parquet``) or CSV (``.csv``) file
+
+                The column names of DataFrames, Arrow data and files need to match the table's column names.
+            columns: The columns to insert. For an iterable of rows, the columns present in each row (as in
+                :meth:`insert`); otherwise a subset of the columns of ``source``, which defaults to all of them.
+            print_stats: If ``True``, print statistics about the cost of computed columns.
+            chunk_size: If given, insert and commit the rows in chunks of ``chunk_size`` rows, each of which creates a
+                new table version.
+
+        Returns:
+            execution status
+
+        Raises:
+            Error: If ``source`` is empty or doesn't match the table's schema.
+
+        Examples:
+            Insert the rows of a Parquet file, committing every million rows:
+
+            >>> tbl.insert_from('/path/to/manifest.parquet', chunk_size=1_000_000)
+
+            Insert rows produced by a generator into a table with int columns ``a`` and ``b``:
+
+            >>> tbl.insert_from(([i, i * i] for i in range(1000)), columns=['a', 'b'])
+        """
+        from pixeltable.utils import ingest
+        self._check_is_dropped()
+        if columns is not None and \
+                (not isinstance(columns, list) or not all(isinstance(name, str) for name in columns)):
+            raise exc.Error('columns must be a list of column names')
+        if chunk_size is not None and (not isinstance(chunk_size, int) or chunk_size <= 0):
+            raise exc.Error('chunk_size must be a positive integer')
+
+        col_names, batches = ingest.read_source(
+            source, columns, self.tbl_version.get_insertable_col_names(), ingest.BATCH_SIZE)
+        self.tbl_version.check_input_col_names(col_names)
+        cols = [self.tbl_version.cols_by_name[name] for name in col_names]
+        # check for empty input before creating a new version
+        first_batch = next(batches, None)
+        if first_batch is None or len(first_batch[0]) == 0:
+            raise exc.Error('source must not be empty')
+
+        def rows() -> Iterator[List[Any]]:
+            row_idx = 0
+            for batch in itertools.chain([first_batch], batches):
+                col_vals = [ingest.validate_column(col, data, row_idx) for col, data in zip(cols, batch)]
+                row_idx += len(col_vals[0])
+                for row in zip(*col_vals):
+                    yield list(row)
+
+        return self.tbl_version.insert(rows(), col_names, print_stats=print_stats, chunk_size=chunk_size)
 
     def update(
             self, value_spec: Dict[str, Union['pixeltable.exprs.Expr', Any]],
@@ -3,9 +3,10 @@ from __future__ import annotations
 import copy
 import dataclasses
 import inspect
+import itertools
 import logging
 import re
-from typing import Optional, List, Dict, Any, Union, Tuple
+from typing import Optional, List, Dict, Any, Union, Tuple, Iterable, Iterator, Set
 from uuid import UUID
 import time
 
@@ -20,6 +21,8 @@ from pixeltable.exec import ColumnInfo
 from pixeltable.function import Function
 from pixeltable.metadata import schema
 from pixeltable.utils.imgstore import ImageStore
+from pixeltable.utils.video import KeyframeIndex
+from pixeltable.utils.embedded_index import EmbeddedIndex
 
 _ID_RE = r'[a-zA-Z]\w*'
 _PATH_RE = f'{_ID_RE}(\\.{_ID_RE})*'
@@ -84,7 +87,7 @@ class TableVersion:
             num_retained_versions: int,
             extract_frames_from: Optional[str], extracted_frame_col: Optional[str],
             extracted_frame_idx_col: Optional[str], extracted_fps: Optional[int],
-            session: orm.Session
+            session: orm.Session, extraction_mode: str = 'fps', decoder: Optional[Dict[str, Any]] = None
     ) -> TableVersion:
         # create a copy here so we can modify it
         cols = [copy.copy(c) for c in cols]
@@ -151,7 +154,7 @@ class TableVersion:
             cols_by_name[extract_frames_from].id if extract_frames_from is not None else -1,
             cols_by_name[extracted_frame_col].id if extracted_frame_col is not None else -1,
             cols_by_name[extracted_frame_idx_col].id if extracted_frame_idx_col is not None else -1,
-            extracted_fps)
+            extracted_fps, extraction_mode, decoder)
 
         ts = time.time()
         # create schema.Table
@@ -185,7 +188,10 @@ class TableVersion:
             value_expr_dict = col.value_expr.as_dict() if col.value_expr is not None else None
             column_md[col.id] = schema.SchemaColumn(
                 pos=pos, name=col.name, col_type=col.col_type.as_dict(),
-                is_pk=col.primary_key, value_expr=value_expr_dict, stored=col.stored, is_indexed=col.is_indexed)
+                is_pk=col.primary_key, value_expr=value_expr_dict, stored=col.stored, is_indexed=col.is_indexed,
+                index_params=col.index.as_dict() if col.is_indexed else None,
+                img_format=col.img_codec.format, img_quality=col.img_codec.quality, img_packed=col.img_packed,
+                has_video_md=col.has_video_md)
 
         schema_version_md = schema.TableSchemaVersionMd(
             schema_version=0, preceding_schema_version=None, columns=column_md)
@@ -221,6 +227,8 @@ class TableVersion:
 
             # delete this table and all associated data
             ImageStore.delete(self.id)
+            KeyframeIndex.delete(self.id)
+            EmbeddedIndex.delete(self.id)
             conn = session.connection()
             conn.execute(
                 sql.delete(schema.TableSchemaVersion.__table__).where(schema.TableSchemaVersion.tbl_id == self.id))
@@ -313,6 +321,11 @@ class TableVersion:
 
         row_count = self.count()
         if row_count == 0:
+            # a trained index is only built by the first insert (see StoreBase.create_deferred_indexes())
+            if col.is_indexed and not col.index.is_trained:
+                with Env.get().engine.begin() as conn:
+                    self.store_tbl.create_index(col, conn)
+                self._update_embedded_indexes()
             return UpdateStatus()
         if (not col.is_computed or not col.is_stored) and not col.is_indexed:
             return UpdateStatus(num_rows=row_count)
@@ -322,18 +335,20 @@ class TableVersion:
         from pixeltable.plan import Planner
         plan, value_expr_slot_idx, embedding_slot_idx = Planner.create_add_column_plan(self, col)
         plan.ctx.num_rows = row_count
-        # TODO: create pgvector index, if col is indexed
 
         plan.open()
         try:
             # TODO: do this in the same transaction as the metadata update
             with Env.get().engine.begin() as conn:
                 num_excs = self.store_tbl.load_column(col, plan, value_expr_slot_idx, embedding_slot_idx, conn)
+                if col.is_indexed:
+                    self.store_tbl.create_index(col, conn)
         except sql.exc.DBAPIError as e:
             self.drop_column(col.name)
             raise exc.Error(f'Error during SQL execution:\n{e}')
         finally:
             plan.close()
+        self._update_embedded_indexes()
 
         msg = f'added {row_count} column values with {num_excs} error{"" if num_excs == 1 else "s"}'
         print(msg)
@@ -388,6 +403,8 @@ class TableVersion:
             self._update_md(ts, preceding_schema_version, conn)
         if col.is_stored:
             self.store_tbl.drop_column()
+        if col.is_indexed:
+            EmbeddedIndex.delete(self.id, col.id)
         _logger.info(f'Dropped column {name} from table {self.name}, new version: {self.version}')
 
     def rename_column(self, old_name: str, new_name: str) -> None:
@@ -414,7 +431,10 @@ class TableVersion:
             self._update_md(ts, preceding_schema_version, conn)
         _logger.info(f'Renamed column {old_name} to {new_name} in table {self.name}, new version: {self.version}')
 
-    def insert(self, rows: List[List[Any]], column_names: List[str], print_stats: bool = False) -> UpdateStatus:
+    def insert(
+            self, rows: Iterable[List[Any]], column_names: List[str], print_stats: bool = False,
+            chunk_size: Optional[int] = None
+    ) -> UpdateStatus:
         """Insert rows into this table.
 
         If self.parameters.frame_src_col_id != None:
@@ -422,42 +442,94 @@ class TableVersion:
         - each row (containing a video) is expanded into one row per extracted frame (at the rate of the fps parameter)
         - parameters.frame_col_id is the image column that receives the extracted frame
         - parameters.frame_idx_col_id is the integer column that receives the frame index (starting at 0)
-        """
-        # we're creating a new version
-        ts = time.time()
-        self.version += 1
-        from pixeltable.plan import Planner
-        total_num_rows, total_num_excs = 0, 0
-        with Env.get().engine.begin() as conn:
-            plan, schema_col_info, idx_col_info, num_values_per_row = \
-                Planner.create_insert_plan(self, rows, column_names)
-            num_rows, num_excs, cols_with_excs = self.store_tbl.insert_rows(plan, schema_col_info, idx_col_info, conn)
-            total_num_rows, total_num_excs = total_num_rows + num_rows, total_num_excs + num_excs
-            self._update_md(ts, None, conn)
 
-            # update views
-            for view in self.views:
-                plan, schema_col_info, idx_col_info, num_values_per_row = Planner.create_view_load_plan(
-                    view, base_version=self.version)
-                num_rows, num_excs, cols_with_excs = \
-                    view.store_tbl.insert_rows(plan, schema_col_info, idx_col_info, conn)
-                total_num_rows, total_num_excs = total_num_rows + num_rows, total_num_excs + num_excs
+        rows are consumed incrementally. If chunk_size is given, every chunk_size rows are inserted and committed
+        separately, each chunk creating a new version.
+        """
+        row_iter = iter(rows)
+        chunks: Iterator[Iterable[List[Any]]]
+        if chunk_size is None:
+            chunks = iter([row_iter])
+        else:
+            chunks = iter(lambda: list(itertools.islice(row_iter, chunk_size)), [])
+
+        status = UpdateStatus()
+        num_input_rows, num_excs = 0, 0
+        cols_with_excs: Set[int] = set()
+        for chunk in chunks:
+            chunk_status, chunk_num_input_rows, chunk_num_excs, chunk_cols_with_excs = \
+                self._insert(chunk, column_names, print_stats)
+            num_input_rows += chunk_num_input_rows
+            num_excs += chunk_num_excs
+            cols_with_excs.update(chunk_cols_with_excs)
+            status.num_rows += chunk_status.num_rows
+            status.num_computed_values += chunk_status.num_computed_values
+            status.num_excs += chunk_status.num_excs
 
-        if print_stats:
-            plan.ctx.profile.print(num_rows=len(rows))
         if num_excs == 0:
             cols_with_excs_str = ''
         else:
             cols_with_excs_str = f'across {len(cols_with_excs)} column{"" if len(cols_with_excs) == 1 else "s"}'
             cols_with_excs_str += f' ({", ".join([self.cols_by_id[id].name for id in cols_with_excs])})'
-        msg = f'inserted {len(rows)} rows with {num_excs} error{"" if num_excs == 1 else "s"} {cols_with_excs_str}'
+        msg = f'inserted {num_input_rows} rows with {num_excs} error{"" if num_excs == 1 else "s"} {cols_with_excs_str}'
         print(msg)
         _logger.info(f'Table {self.name}: {msg}, new version {self.version}')
-        status = UpdateStatus(
-            num_rows=total_num_rows, num_computed_values=num_values_per_row * len(rows), num_excs=total_num_excs,
-            cols_with_excs=[self.cols_by_id[cid].name for cid in cols_with_excs])
+        status.cols_with_excs = [self.cols_by_id[cid].name for cid in cols_with_excs]
         return status
 
+    def _insert(
+            self, rows: Iterable[List[Any]], column_names: List[str], print_stats: bool
+    ) -> Tuple[UpdateStatus, int, int, Set[int]]:
+        """Insert rows in a single transaction and version
+
+        Returns the status, the number of input rows, and the number of exceptions and the ids of the columns with
+        exceptions for this table.
+        """
+        num_input_rows = 0
+
+        def count_rows() -> Iterator[List[Any]]:
+            nonlocal num_input_rows
+            for row in rows:
+                num_input_rows += 1
+                yield row
+
+        # we're creating a new version
+        ts = time.time()
+        prev_version, prev_next_rowid = self.version, self.next_rowid
+        self.version += 1
+        from pixeltable.plan import Planner
+        total_num_rows, total_num_excs = 0, 0
+        try:
+            with Env.get().engine.begin() as conn:
+                plan, schema_col_info, idx_col_info, num_values_per_row = \
+                    Planner.create_insert_plan(self, count_rows(), column_names)
+                num_rows, num_excs, cols_with_excs = \
+                    self.store_tbl.insert_rows(plan, schema_col_info, idx_col_info, conn)
+                total_num_rows, total_num_excs = total_num_rows + num_rows, total_num_excs + num_excs
+                self._update_md(ts, None, conn)
+                if print_stats:
+                    plan.ctx.profile.print(num_rows=num_input_rows)
+
+                # update views
+                for view in self.views:
+                    view_plan, schema_col_info, idx_col_info, _ = Planner.create_view_load_plan(
+                        view, base_version=self.version)
+                    view_num_rows, view_num_excs, _ = \
+                        view.store_tbl.insert_rows(view_plan, schema_col_info, idx_col_info, conn)
+                    total_num_rows, total_num_excs = total_num_rows + view_num_rows, total_num_excs + view_num_excs
+        except Exception:
+            # the transaction was rolled back; streamed input can fail validation halfway through, after the images
+            # of the preceding rows were stored: remove them, otherwise the next insert reuses the failed version
+            ImageStore.delete(self.id, version=self.version)
+            self.version, self.next_rowid = prev_version, prev_next_rowid
+            raise
+        self._update_embedded_indexes()
+
+        status = UpdateStatus(
+            num_rows=total_num_rows, num_computed_values=num_values_per_row * num_input_rows,
+            num_excs=total_num_excs)
+        return status, num_input_rows, num_excs, cols_with_excs
+
     def update(
             self, value_spec: Dict[str, Union['pixeltable.exprs.Expr', Any]],
             where: Optional['pixeltable.exprs.Predicate'] = None, cascade: bool = True
@@ -599,6 +671,7 @@ class TableVersion:
                 stmt = stmt.where(analysis_info.sql_where_clause)
             num_rows = conn.execute(stmt).rowcount
             self._update_md(ts, None, conn)
+        self._update_embedded_indexes()
 
         status = UpdateStatus(num_rows=num_rows)
         return status
@@ -664,6 +737,8 @@ class TableVersion:
                 # physically drop the column, but only after we have re-created the schema
                 if added_col is not None:
                     self.store_tbl.drop_column(added_col, conn)
+                    if added_col.is_indexed:
+                        EmbeddedIndex.delete(self.id, added_col.id)
 
                 conn.execute(
                     sql.delete(schema.TableSchemaVersion.__table__)
@@ -684,6 +759,16 @@ class TableVersion:
 
             session.commit()
             _logger.info(f'Table {self.name}: reverted to version {self.version}')
+        # the embedded indexes reflect the reverted version
+        self._update_embedded_indexes()
+
+    def _update_embedded_indexes(self) -> None:
+        """Bring the embedded indexes of a live table up to date with the current version"""
+        if not self.is_insertable():
+            return
+        for col in self.cols:
+            if col.is_indexed and col.index.embedded:
+                EmbeddedIndex.get(self, col)
 
     def is_view(self) -> bool:
         return self.base is not None
@@ -732,20 +817,7 @@ class TableVersion:
         Make sure 'rows' conform to schema.
         """
         assert len(rows) > 0
-        all_col_names = {col.name for col in self.cols}
-        reqd_col_names = set(self.get_insertable_col_names(required_only=True))
-        given_col_names = set(column_names)
-        if not(reqd_col_names <= given_col_names):
-            raise exc.Error(f'Missing columns: {", ".join(reqd_col_names - given_col_names)}')
-        if not(given_col_names <= all_col_names):
-            raise exc.Error(f'Unknown columns: {", ".join(given_col_names - all_col_names)}')
-        computed_col_names = {col.name for col in self.cols if col.value_expr is not None}
-        if self.extracts_frames():
-            computed_col_names.add(self.cols_by_id[self.parameters.frame_col_id].name)
-            computed_col_names.add(self.cols_by_id[self.parameters.frame_idx_col_id].name)
-        if len(computed_col_names & given_col_names) > 0:
-            raise exc.Error(
-                f'Provided values for computed columns: {", ".join(computed_col_names & given_col_names)}')
+        self.check_input_col_names(column_names)
 
         # check data
         row_cols = [self.cols_by_name[name] for name in column_names]
@@ -762,6 +834,25 @@ class TableVersion:
                 except TypeError as e:
                     raise exc.Error(f'Column {col.name} in row {row_idx}: {e}')
 
+    def check_input_col_names(self, column_names: List[str]) -> None:
+        """
+        Make sure that 'column_names' are a valid set of columns to insert into.
+        """
+        all_col_names = {col.name for col in self.cols}
+        reqd_col_names = set(self.get_insertable_col_names(required_only=True))
+        given_col_names = set(column_names)
+        if not(reqd_col_names <= given_col_names):
+            raise exc.Error(f'Missing columns: {", ".join(reqd_col_names - given_col_names)}')
+        if not(given_col_names <= all_col_names):
+            raise exc.Error(f'Unknown columns: {", ".join(given_col_names - all_col_names)}')
+        computed_col_names = {col.name for col in self.cols if col.value_expr is not None}
+        if self.extracts_frames():
+            computed_col_names.add(self.cols_by_id[self.parameters.frame_col_id].name)
+            computed_col_names.add(self.cols_by_id[self.parameters.frame_idx_col_id].name)
+        if len(computed_col_names & given_col_names) > 0:
+            raise exc.Error(
+                f'Provided values for computed columns: {", ".join(computed_col_names & given_col_names)}')
+
     @classmethod
     def _create_value_expr(cls, col: Column, existing_cols: Dict[str, Column]) -> None:
         """
@@ -821,7 +912,10 @@ class TableVersion:
             value_expr_dict = col.value_expr.as_dict() if col.value_expr is not None else None
             column_md[col.id] = schema.SchemaColumn(
                 pos=pos, name=col.name, col_type=col.col_type.as_dict(),
-                is_pk=col.primary_key, value_expr=value_expr_dict, stored=col.stored, is_indexed=col.is_indexed)
+                is_pk=col.primary_key, value_expr=value_expr_dict, stored=col.stored, is_indexed=col.is_indexed,
+                index_params=col.index.as_dict() if col.is_indexed else None,
+                img_format=col.img_codec.format, img_quality=col.img_codec.quality, img_packed=col.img_packed,
+                has_video_md=col.has_video_md)
         # preceding_schema_version to be set by the caller
         return schema.TableSchemaVersionMd(
             schema_version=self.schema_version, preceding_schema_version=preceding_schema_version,
@@ -1,4 +1,4 @@
-from typing import List, Optional, Dict, Tuple
+from typing import List, Optional, Dict, Tuple, Any
 import pandas as pd
 import logging
 import dataclasses
@@ -15,6 +15,7 @@ from pixeltable.env import Env
 from pixeltable.function import FunctionRegistry, Function
 from pixeltable import exceptions as exc
 from pixeltable.exprs import Predicate
+from pixeltable.utils import video
 
 __all__ = [
     'Client',
@@ -225,6 +226,7 @@ class Client:
             self, path_str: str, schema: List[Column], num_retained_versions: int = 10,
             extract_frames_from: Optional[str] = None, extracted_frame_col: Optional[str] = None,
             extracted_frame_idx_col: Optional[str] = None, extracted_fps: Optional[int] = None,
+            extraction_mode: str = 'fps', decoder: Optional[Dict[str, Any]] = None,
     ) -> MutableTable:
         """Create a new table in the database.
 
@@ -236,6 +238,12 @@ class Client:
             extracted_frame_col: Name of the image column in which to store the extracted frames.
             extracted_frame_idx_col: Name of the int column in which to store the frame indices.
             extracted_fps: Frame rate at which to extract frames. 0: extract all frames.
+            extraction_mode: Which frames to extract: 'fps' (frames at extracted_fps), 'keyframes' (the keyframes of
+                the video; requires PyAV) or 'scenes' (the first frame of each scene). extracted_fps only applies
+                to 'fps'.
+            decoder: Parameters of the video decoder used for frame extraction: 'backend' ('opencv' or 'pyav'),
+                'thread_type' and 'thread_count' (pyav only), 'size' (width, height) to extract downscaled frames.
+                Queries can override this with DataFrame.with_decoder().
 
         Returns:
             The newly created table.
@@ -256,11 +264,36 @@ class Client:
             ... schema=[Column('video', VideoType()), Column('frame', ImageType()), Column('frame_idx', IntType())],
             ... extract_frames_from='video', extracted_frame_col='frame', extracted_frame_idx_col='frame_idx',
             ... extracted_fps=1)
+
+            Extract one frame per scene:
+
+            >>> table = cl.create_table('my_table',
+            ... schema=[Column('video', VideoType()), Column('frame', ImageType()), Column('frame_idx', IntType())],
+            ... extract_frames_from='video', extracted_frame_col='frame', extracted_frame_idx_col='frame_idx',
+            ... extraction_mode='scenes')
+
+            Decode with PyAV on 4 threads and extract frames at 640x360:
+
+            >>> table = cl.create_table('my_table',
+            ... schema=[Column('video', VideoType()), Column('frame', ImageType()), Column('frame_idx', IntType())],
+            ... extract_frames_from='video', extracted_frame_col='frame', extracted_frame_idx_col='frame_idx',
+            ... extracted_fps=1, decoder={'backend': 'pyav', 'thread_count': 4, 'size': (640, 360)})
         """
         path = Path(path_str)
         self.paths.check_is_valid(path, expected=None)
         dir = self.paths[path.parent]
 
+        if extraction_mode not in video.EXTRACTION_MODES:
+            raise exc.Error(
+                f'extraction_mode must be one of {", ".join(video.EXTRACTION_MODES)}, got {extraction_mode!r}')
+        if extraction_mode != video.EXTRACT_FPS:
+            if extracted_fps is not None:
+                raise exc.Error(f'extracted_fps does not apply to extraction_mode={extraction_mode!r}')
+            if extract_frames_from is None:
+                raise exc.Error(f'extraction_mode={extraction_mode!r} requires extract_frames_from')
+            extracted_fps = 0
+        if decoder is not None and extract_frames_from is None:
+            raise exc.Error('decoder requires extract_frames_from')
         # make sure frame extraction params are either fully present or absent
         frame_extraction_param_count = int(extract_frames_from is not None) + int(extracted_frame_col is not None) \
                                        + int(extracted_frame_idx_col is not None) + int(extracted_fps is not None)
@@ -272,7 +305,8 @@ class Client:
             raise exc.Error('extracted_fps must be >= 0')
         tbl = MutableTable.create(
             dir.id, path.name, schema, num_retained_versions, extract_frames_from, extracted_frame_col,
-            extracted_frame_idx_col, extracted_fps)
+            extracted_frame_idx_col, extracted_fps, extraction_mode,
+            decoder=video.DecoderConfig.from_dict(decoder).as_dict() if decoder is not None else None)
         self.tbl_versions[(tbl.id, None)] = tbl.tbl_version
         self.paths[path] = tbl
         _logger.info(f'Created table {path_str}')
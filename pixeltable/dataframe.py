@@ -16,6 +16,7 @@ from pixeltable.type_system import ColumnType
 from pixeltable import exprs
 from pixeltable import exceptions as exc
 from pixeltable.plan import Planner
+from pixeltable.utils.video import DecoderConfig
 
 __all__ = [
     'DataFrame'
@@ -121,13 +122,15 @@ class DataFrame:
             select_list: Optional[List[exprs.Expr]] = None,
             where_clause: Optional[exprs.Predicate] = None,
             group_by_clause: Optional[List[exprs.Expr]] = None,
-            order_by_clause: Optional[List[Tuple[exprs.Expr, bool]]] = None):  # List[(expr, asc)]
+            order_by_clause: Optional[List[Tuple[exprs.Expr, bool]]] = None,  # List[(expr, asc)]
+            decoder: Optional[DecoderConfig] = None):
         self.tbl = tbl
         # exprs contain execution state and therefore cannot be shared
         self.select_list = copy.deepcopy(select_list)  # None: implies all cols
         self.where_clause = copy.deepcopy(where_clause)
         self.group_by_clause = copy.deepcopy(group_by_clause)
         self.order_by_clause = copy.deepcopy(order_by_clause)
+        self.decoder = decoder
 
     def exec(self, n: int = 20) -> Generator[exprs.DataRow, None, None]:
         """Returned value: list of select list values"""
@@ -145,7 +148,7 @@ class DataFrame:
             item.bind_rel_paths(None)
         plan, self.select_list = Planner.create_query_plan(
             self.tbl, self.select_list, where_clause=self.where_clause, group_by_clause=self.group_by_clause,
-            order_by_clause=self.order_by_clause, limit=n)
+            order_by_clause=self.order_by_clause, limit=n, decoder=self.decoder)
         plan.open()
         try:
             result = next(plan)
@@ -235,12 +238,12 @@ class DataFrame:
             # TODO: check that ColumnRefs in expr refer to self.tbl
         return DataFrame(
             self.tbl, select_list=select_list, where_clause=self.where_clause, group_by_clause=self.group_by_clause,
-            order_by_clause=self.order_by_clause)
+            order_by_clause=self.order_by_clause, decoder=self.decoder)
 
     def where(self, pred: exprs.Predicate) -> DataFrame:
         return DataFrame(
             self.tbl, select_list=self.select_list, where_clause=pred, group_by_clause=self.group_by_clause,
-            order_by_clause=self.order_by_clause)
+            order_by_clause=self.order_by_clause, decoder=self.decoder)
 
     def group_by(self, *expr_list: exprs.Expr) -> DataFrame:
         if self.group_by_clause is not None:
@@ -251,7 +254,7 @@ class DataFrame:
         self.group_by_clause = [e.copy() for e in expr_list]
         return DataFrame(
             self.tbl, select_list=self.select_list, where_clause=self.where_clause, group_by_clause=expr_list,
-            order_by_clause=self.order_by_clause)
+            order_by_clause=self.order_by_clause, decoder=self.decoder)
 
     def order_by(self, *expr_list: exprs.Expr, asc: bool = True) -> DataFrame:
         for e in expr_list:
@@ -261,7 +264,18 @@ class DataFrame:
         order_by_clause.extend([(e.copy(), asc) for e in expr_list])
         return DataFrame(
             self.tbl, select_list=self.select_list, where_clause=self.where_clause,
-            group_by_clause=self.group_by_clause, order_by_clause=order_by_clause)
+            group_by_clause=self.group_by_clause, order_by_clause=order_by_clause, decoder=self.decoder)
+
+    def with_decoder(self, **params: Any) -> DataFrame:
+        """Decode the frames of this query with the given decoder, instead of the one configured for the table.
+
+        Takes the same parameters as the decoder argument of Client.create_table(), for example
+        backend='pyav', thread_type='FRAME', thread_count=4.
+        """
+        return DataFrame(
+            self.tbl, select_list=self.select_list, where_clause=self.where_clause,
+            group_by_clause=self.group_by_clause, order_by_clause=self.order_by_clause,
+            decoder=DecoderConfig.from_dict(params))
 
     def __getitem__(self, index: object) -> DataFrame:
         """
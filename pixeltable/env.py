@@ -34,8 +34,19 @@ class Env:
         self._home: Optional[Path] = None
         self._img_dir: Optional[Path] = None  # computed images
         self._filecache_dir: Optional[Path] = None  # cached media files with external URL
+        self._keyframe_dir: Optional[Path] = None  # keyframe indices of videos
+        self._framecache_dir: Optional[Path] = None  # decoded video frames
+        self._index_dir: Optional[Path] = None  # embedded nearest-neighbor indexes
         self._log_dir: Optional[Path] = None  # log files
         self._tmp_dir: Optional[Path] = None  # any tmp files
+        self._max_filecache_size: Optional[int] = None  # in bytes
+        self._readahead_bytes: Optional[int] = None  # budget for downloading media of upcoming rows
+        self._readahead_rows: Optional[int] = None
+        self._decode_readahead_bytes: Optional[int] = None  # budget for decoded frames of upcoming rows
+        self._s3_endpoint_url: Optional[str] = None  # eg, for S3-compatible stores
+        self._s3_max_bandwidth: Optional[int] = None  # in bytes/s, per download
+        self._frame_cache_memory: Optional[int] = None  # in bytes
+        self._frame_cache_size: Optional[int] = None  # on disk, in bytes
         self._sa_engine: Optional[sql.engine.base.Engine] = None
         self._db_name: Optional[str] = None
         self._db_user: Optional[str] = None
@@ -114,6 +125,9 @@ class Env:
         self._home = home
         self._img_dir = self._home / 'images'
         self._filecache_dir = self._home / 'filecache'
+        self._keyframe_dir = self._home / 'keyframes'
+        self._framecache_dir = self._home / 'framecache'
+        self._index_dir = self._home / 'indexes'
         self._log_dir = self._home / 'logs'
         self._tmp_dir = self._home / 'tmp'
         if self._home.exists() and not self._home.is_dir():
@@ -123,6 +137,16 @@ class Env:
         self._db_user = os.environ.get('PIXELTABLE_DB_USER', 'postgres')
         self._db_password = os.environ.get('PIXELTABLE_DB_PASSWORD', 'pgpassword')
         self._db_port = os.environ.get('PIXELTABLE_DB_PORT', '6543')
+        self._max_filecache_size = int(os.environ.get('PIXELTABLE_MAX_FILECACHE_SIZE', str(10 * 1024 ** 3)))
+        self._readahead_bytes = int(os.environ.get('PIXELTABLE_READAHEAD_BYTES', str(1024 ** 3)))
+        self._readahead_rows = int(os.environ.get('PIXELTABLE_READAHEAD_ROWS', '10000'))
+        self._decode_readahead_bytes = \
+            int(os.environ.get('PIXELTABLE_DECODE_READAHEAD_BYTES', str(512 * 1024 ** 2)))
+        self._s3_endpoint_url = os.environ.get('PIXELTABLE_S3_ENDPOINT_URL')
+        max_bandwidth = os.environ.get('PIXELTABLE_S3_MAX_BANDWIDTH')
+        self._s3_max_bandwidth = int(max_bandwidth) if max_bandwidth is not None else None
+        self._frame_cache_memory = int(os.environ.get('PIXELTABLE_FRAME_CACHE_MEMORY', str(512 * 1024 ** 2)))
+        self._frame_cache_size = int(os.environ.get('PIXELTABLE_FRAME_CACHE_SIZE', str(4 * 1024 ** 3)))
 
         if not self._home.exists():
             msg = f'setting up Pixeltable at {self._home}, db at {self.db_url(hide_passwd=True)}'
@@ -137,6 +161,12 @@ class Env:
             self._img_dir.mkdir()
         if not self._filecache_dir.exists():
             self._filecache_dir.mkdir()
+        if not self._keyframe_dir.exists():
+            self._keyframe_dir.mkdir()
+        if not self._framecache_dir.exists():
+            self._framecache_dir.mkdir()
+        if not self._index_dir.exists():
+            self._index_dir.mkdir()
         if not self._log_dir.exists():
             self._log_dir.mkdir()
         if not self._tmp_dir.exists():
@@ -244,12 +274,6 @@ class Env:
             #return 'postgres:15-alpine'
             return 'ankane/pgvector:latest'
 
-    def ffmpeg_image(self) -> str:
-       if self._is_apple_cpu():
-           return 'linuxserver/ffmpeg:arm64v8-latest'
-       else:
-           return 'linuxserver/ffmpeg:latest'
-
     def tear_down(self) -> None:
         if database_exists(self.db_url()):
             drop_database(self.db_url())
@@ -269,11 +293,64 @@ class Env:
         assert self._filecache_dir is not None
         return self._filecache_dir
 
+    @property
+    def keyframe_dir(self) -> Path:
+        assert self._keyframe_dir is not None
+        return self._keyframe_dir
+
+    @property
+    def framecache_dir(self) -> Path:
+        assert self._framecache_dir is not None
+        return self._framecache_dir
+
+    @property
+    def index_dir(self) -> Path:
+        assert self._index_dir is not None
+        return self._index_dir
+
     @property
     def tmp_dir(self) -> Path:
         assert self._tmp_dir is not None
         return self._tmp_dir
 
+    @property
+    def max_filecache_size(self) -> int:
+        assert self._max_filecache_size is not None
+        return self._max_filecache_size
+
+    @property
+    def readahead_bytes(self) -> int:
+        assert self._readahead_bytes is not None
+        return self._readahead_bytes
+
+    @property
+    def readahead_rows(self) -> int:
+        assert self._readahead_rows is not None
+        return self._readahead_rows
+
+    @property
+    def decode_readahead_bytes(self) -> int:
+        assert self._decode_readahead_bytes is not None
+        return self._decode_readahead_bytes
+
+    @property
+    def s3_endpoint_url(self) -> Optional[str]:
+        return self._s3_endpoint_url
+
+    @property
+    def s3_max_bandwidth(self) -> Optional[int]:
+        return self._s3_max_bandwidth
+
+    @property
+    def frame_cache_memory(self) -> int:
+        assert self._frame_cache_memory is not None
+        return self._frame_cache_memory
+
+    @property
+    def frame_cache_size(self) -> int:
+        assert self._frame_cache_size is not None
+        return self._frame_cache_size
+
     @property
     def engine(self) -> sql.engine.base.Engine:
         assert self._sa_engine is not None
@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import datetime
-from typing import List, Iterator, Set, Dict, Any, Optional, Tuple, Iterable
+from typing import List, Iterator, Set, Dict, Any, Optional, Tuple, Iterable, Deque
 from dataclasses import dataclass, field
 import logging
 import time
@@ -10,11 +10,14 @@ import io
 import sys
 import urllib.parse
 import urllib.request
+import uuid
 from uuid import UUID
 import concurrent.futures
+import itertools
 import threading
 import os
-from collections import defaultdict
+from collections import defaultdict, deque
+from pathlib import Path
 
 import numpy as np
 from tqdm.autonotebook import tqdm
@@ -26,9 +29,14 @@ from pixeltable import catalog
 from pixeltable.utils.imgstore import ImageStore
 from pixeltable.function import Function, FunctionRegistry
 from pixeltable.env import Env
-from pixeltable.utils.video import FrameIterator
+from pixeltable.utils import video
 from pixeltable import exceptions as exc
-from pixeltable.utils.filecache import FileCache
+from pixeltable.metadata import schema
+from pixeltable.utils.filecache import FileCache, Validators
+from pixeltable.utils.embedded_index import EmbeddedIndex
+from pixeltable.utils.download import DownloadPool, DownloadCancelled
+from pixeltable.utils.http import HttpClient
+from pixeltable.utils import fetch
 
 
 _logger = logging.getLogger('pixeltable')
@@ -91,8 +99,10 @@ class DataRowBatch:
             idx_range = slice(0, len(self.rows))
         for row in self.rows[idx_range]:
             for info in stored_img_info:
-                filepath = str(ImageStore.get_path(self.table_id, info.col.id, self.table_version))
-                row.flush_img(info.slot_idx, filepath)
+                row.flush_img(
+                    info.slot_idx,
+                    lambda img: ImageStore.save(
+                        img, self.table_id, info.col.id, self.table_version, info.col.img_codec, info.col.img_packed))
             for slot_idx in flushed_slot_idxs:
                 row.flush_img(slot_idx)
         #_logger.debug(
@@ -293,6 +303,13 @@ class SqlScanNode(ExecNode):
             # for a specific version
             self.stmt = self.stmt \
                 .where(base_tbl.store_tbl.v_min_col == version)
+        elif similarity_clause is not None and tbl.is_mutable():
+            # in a live table, the rows that are visible at the current version are the ones that haven't been
+            # deleted; expressed as v_max == MAX_VERSION, this matches the predicate of the (partial) vector index,
+            # which would otherwise not be used
+            self.stmt = self.stmt \
+                .where(base_tbl.store_tbl.v_min_col <= base_tbl.version) \
+                .where(base_tbl.store_tbl.v_max_col == schema.Table.MAX_VERSION)
         else:
             # for all rows visible at the current version
             self.stmt = self.stmt \
@@ -301,9 +318,24 @@ class SqlScanNode(ExecNode):
 
         if where_clause is not None:
             self.stmt = self.stmt.where(where_clause)
+        # settings of the vector index for this query
+        self.index_settings: Dict[str, int] = {}
         if similarity_clause is not None:
-            self.stmt = self.stmt.order_by(
-                similarity_clause.img_col_ref.col.sa_idx_col.l2_distance(similarity_clause.embedding()))
+            img_col = similarity_clause.img_col_ref.col
+            embedding = similarity_clause.embedding()
+            if img_col.index.embedded and tbl.is_insertable() and version is None and limit != 0 \
+                    and where_clause is None and filter is None:
+                # the embedded index resolves nearest() into a set of rowids
+                rowids = EmbeddedIndex.get(tbl, img_col).search(
+                    embedding, limit * EmbeddedIndex.OVERSAMPLING, ef_search=img_col.index.params.get('ef_search'))
+                rowid_col = tbl.store_tbl.rowid_col
+                self.stmt = self.stmt.where(rowid_col.in_(rowids))
+                if len(rowids) > 0:
+                    self.stmt = self.stmt.order_by(
+                        sql.case({rowid: i for i, rowid in enumerate(rowids)}, value=rowid_col))
+            else:
+                self.stmt = self.stmt.order_by(img_col.index.distance(img_col.sa_idx_col, embedding))
+                self.index_settings = img_col.index.query_settings()
         if len(order_by_clause) > 0:
             self.stmt = self.stmt.order_by(*order_by_clause)
         if limit != 0 and self.filter is None:
@@ -337,12 +369,18 @@ class SqlScanNode(ExecNode):
             tbl = tbl.base
         return stmt, base_tbl
 
+    def _execute(self, conn: sql.engine.Connection) -> sql.engine.CursorResult:
+        for name, val in self.index_settings.items():
+            # SET LOCAL: the setting only applies to the current transaction
+            conn.execute(sql.text(f'SET LOCAL {name} = {int(val)}'))
+        return conn.execute(self.stmt)
+
     def __next__(self) -> DataRowBatch:
         if self.result_cursor is None:
             # run the query; do this here rather than in _open(), exceptions are only expected during iteration
             if self.ctx.conn is not None:
                 try:
-                    self.result_cursor = self.ctx.conn.execute(self.stmt)
+                    self.result_cursor = self._execute(self.ctx.conn)
                     self.has_more_rows = True
                 except Exception as e:
                     self.has_more_rows = False
@@ -350,7 +388,7 @@ class SqlScanNode(ExecNode):
             else:
                 self.conn = Env.get().engine.connect()
                 try:
-                    self.result_cursor = self.conn.execute(self.stmt)
+                    self.result_cursor = self._execute(self.conn)
                     self.has_more_rows = True
                 except Exception as e:
                     self.conn.close()
@@ -408,7 +446,15 @@ class SqlScanNode(ExecNode):
 
 class ExprEvalNode(ExecNode):
     """Materializes expressions
+
+    Frames are decoded ahead of the row-wise evaluation: the node reads up to DECODE_READAHEAD_ROWS input rows ahead
+    and decodes their frames in parallel, so that different videos are decoded concurrently even if each input
+    batch contains the frames of a single video. Batches are returned in input order.
+    The decoded frames of the rows read ahead are held in memory: beyond the next two batches, read-ahead is also
+    limited to Env.decode_readahead_bytes, based on the largest decoded frame size per row seen so far.
     """
+    DECODE_READAHEAD_ROWS = 1024
+
     @dataclass
     class Cohort:
         """List of exprs that form an evaluation context and contain calls to at most one NOS function"""
@@ -495,11 +541,69 @@ class ExprEvalNode(ExecNode):
         self.target_exprs = [e for e in output_exprs if e.slot_idx not in input_slot_idxs]
         self.ignore_errors = ignore_errors  # if False, raise exc.ExprEvalError on error in _exec_cohort()
         self.pbar: Optional[tqdm] = None
+        # frames are decoded in parallel across videos, ahead of the row-wise evaluation
+        self.frame_refs = [
+            e for e in evaluator.get_eval_ctx(self.target_exprs, exclude=input_exprs)
+            if isinstance(e, exprs.FrameColumnRef)
+        ]
+        self.decode_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # input batches whose frames are being decoded, with their decoding tasks
+        self.decode_queue: Deque[Tuple[DataRowBatch, List[concurrent.futures.Future]]] = deque()
+        self.num_queued_rows = 0
+        # the largest size of the decoded frames of a row seen so far; None until the first batch is decoded
+        self.decoded_row_bytes: Optional[int] = None
+        self.input_exhausted = False
         self.cohorts: List[List[ExprEvalNode.Cohort]] = []
         self._create_cohorts()
 
+    def _next_input_batch(self) -> DataRowBatch:
+        if len(self.frame_refs) == 0:
+            return next(self.input)
+        # always keep the next batch in flight, and more batches within the read-ahead limits
+        while not self.input_exhausted and (len(self.decode_queue) < 2 or self._can_read_ahead()):
+            try:
+                batch = next(self.input)
+            except StopIteration:
+                self.input_exhausted = True
+                break
+            futures = [
+                f for frame_ref in self.frame_refs for f in frame_ref.submit_batch(batch.rows, self.decode_executor)]
+            self.decode_queue.append((batch, futures))
+            self.num_queued_rows += len(batch)
+        if len(self.decode_queue) == 0:
+            raise StopIteration
+        batch, futures = self.decode_queue.popleft()
+        self.num_queued_rows -= len(batch)
+        start_ts = time.perf_counter()
+        exprs.FrameColumnRef.wait(futures)
+        # the decoding time that the evaluation waited for
+        self.ctx.profile.eval_time[self.frame_refs[0].slot_idx] += time.perf_counter() - start_ts
+        if len(batch) > 0:
+            row_bytes = self._decoded_bytes(batch) // len(batch)
+            self.decoded_row_bytes = max(row_bytes, self.decoded_row_bytes or 0)
+        return batch
+
+    def _can_read_ahead(self) -> bool:
+        """Returns True if another input batch can be read ahead"""
+        if self.num_queued_rows >= self.DECODE_READAHEAD_ROWS:
+            return False
+        if self.decoded_row_bytes is None:
+            # we don't know the size of the frames yet
+            return False
+        return self.num_queued_rows * self.decoded_row_bytes < Env.get().decode_readahead_bytes
+
+    def _decoded_bytes(self, batch: DataRowBatch) -> int:
+        """Returns the size of the decoded frames in batch"""
+        result = 0
+        for row in batch:
+            for frame_ref in self.frame_refs:
+                if row.has_val[frame_ref.slot_idx]:
+                    frame = row[frame_ref.slot_idx]
+                    result += frame.width * frame.height * len(frame.getbands())
+        return result
+
     def __next__(self) -> DataRowBatch:
-        input_batch = next(self.input)
+        input_batch = self._next_input_batch()
         if len(input_batch) == 0:
             return input_batch
         # compute target exprs
@@ -509,10 +613,24 @@ class ExprEvalNode(ExecNode):
         return input_batch
 
     def _open(self) -> None:
+        if len(self.frame_refs) > 0:
+            # cv2 releases the GIL while decoding
+            self.decode_executor = concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count())
         if self.ctx.show_pbar:
-            self.pbar = tqdm(total=len(self.target_exprs) * self.ctx.num_rows, desc='Computing cells', unit='cells')
+            # the number of rows isn't known upfront if the input is streamed
+            total = len(self.target_exprs) * self.ctx.num_rows if self.ctx.num_rows is not None else None
+            self.pbar = tqdm(total=total, desc='Computing cells', unit='cells')
 
     def _close(self) -> None:
+        if self.decode_executor is not None:
+            # decoding tasks of batches that weren't consumed (eg, because of a limit) are abandoned
+            self.decode_executor.shutdown(cancel_futures=True)
+            self.decode_executor = None
+        self.decode_queue.clear()
+        self.num_queued_rows = 0
+        self.decoded_row_bytes = None
+        for frame_ref in self.frame_refs:
+            frame_ref.release()
         if self.pbar is not None:
             self.pbar.close()
 
@@ -708,9 +826,17 @@ class ExprEvalNode(ExecNode):
 
 
 class InsertDataNode(ExecNode):
-    """Outputs in-memory data as a row batch of a particular table"""
+    """Outputs in-memory data as row batches of a particular table
+
+    The input rows are consumed incrementally and the output batches contain at most ctx.batch_size rows (all rows
+    if the batch size is 0), so that memory use doesn't depend on the size of the input. For tables that extract
+    frames, the frame rows of a video are generated lazily, across as many batches as needed.
+    Videos are probed in chunks of ctx.batch_size input rows, for their frame counts and for the metadata that is
+    stored alongside video columns. Remote videos are downloaded into the file cache for that, unless they're only
+    probed, not decoded: those are probed with range requests for their container headers, if the server supports that.
+    """
     def __init__(
-            self, tbl: catalog.TableVersion, rows: List[List[Any]], row_column_pos: Dict[str, int],
+            self, tbl: catalog.TableVersion, rows: Iterable[List[Any]], row_column_pos: Dict[str, int],
             evaluator: exprs.Evaluator, input_cols: List[ColumnInfo], frame_idx_slot_idx: int, start_row_id: int,
     ):
         super().__init__(evaluator, [], [], None)
@@ -721,178 +847,437 @@ class InsertDataNode(ExecNode):
         self.evaluator = evaluator
         self.input_cols = input_cols
         self.frame_idx_slot_idx = frame_idx_slot_idx
-        self.start_row_id = start_row_id
-        self.has_returned_data = False
-        self.output_rows: Optional[DataRowBatch] = None
-
-        # TODO: remove this with component views
-        self.boto_client: Optional[Any] = None
+        self.next_row_id = start_row_id
+        self.input_iter: Optional[Iterator[List[Any]]] = None
+        # video columns that store metadata
+        self.video_md_cols = [info for info in input_cols if info.col.has_video_md]
+        # (input row, number of output rows, local video path, video metadata by slot idx) of the current chunk of
+        # input rows; the number of output rows is 1 if the table doesn't extract frames
+        self.pending_rows: Deque[Tuple[List[Any], int, Optional[str], Dict[int, Dict[str, Any]]]] = deque()
+        # idx of the next frame of pending_rows[0]
+        self.next_frame_idx = 0
+        # downloaded videos that weren't admitted to the file cache
+        self.uncached_paths: List[Path] = []
+        # videos downloaded by this insert aren't evicted from the file cache on behalf of later downloads
+        self.query_ts: Optional[float] = None
 
     def _open(self) -> None:
-        """Create row batch and populate with self.data"""
-
+        self.query_ts = time.time()
         for info in self.input_cols:
             assert info.col.name in self.row_column_pos
+        if isinstance(self.input_rows, list) and not self.tbl.extracts_frames():
+            self.ctx.num_rows = len(self.input_rows)
+        self.input_iter = iter(self.input_rows)
 
-        # before anything, convert any literal images within the input rows into references
-        # copy the input rows to avoid indirectly modifying the argument
-        _input_rows = [row.copy() for row in self.input_rows]
+    def _prepare_row(self, input_row: List[Any]) -> List[Any]:
+        """Convert literal images within input_row into references"""
+        result = input_row
         for info in self.input_cols:
-            if info.col.col_type.is_image_type():
-                col_idx = self.row_column_pos[info.col.name]
-                for row_idx, input_row in enumerate(_input_rows):
-                    val = input_row[col_idx]
-                    if isinstance(val, bytes):
-                        # we will save literal to a file here and use this path as the new value
-                        valpath = str(ImageStore.get_path(self.tbl.id, info.col.id, self.tbl.version))
-                        open(valpath, 'wb').write(val)
-                        input_row[col_idx] = valpath
-
-        self.input_rows = _input_rows
-
-        if not self.tbl.extracts_frames():
-            self.output_rows = DataRowBatch(self.tbl, self.evaluator, len(self.input_rows))
-            for info in self.input_cols:
-                col_idx = self.row_column_pos[info.col.name]
-                for row_idx, input_row in enumerate(self.input_rows):
-                    self.output_rows[row_idx][info.slot_idx] = input_row[col_idx]
-        else:
-            # we're extracting frames: we replace each row with one row per frame, which has the frame_idx col set
-            video_col = self.tbl.frame_src_col()
-            assert video_col is not None and self.frame_idx_slot_idx is not None
-            # get the output row count per video
-            counts = [0] * len(self.input_rows)
-            assert video_col.name in self.row_column_pos
-            video_col_idx = self.row_column_pos[video_col.name]
-            for row_idx, input_row in enumerate(self.input_rows):
-                video_path = self._get_local_path(input_row[video_col_idx])
-                if video_path is None:
-                    counts[row_idx] = 1  # this will occupy one row in output_rows
-                    continue
-                with FrameIterator(video_path, fps=self.tbl.parameters.extraction_fps) as frame_iter:
-                    counts[row_idx] = len(frame_iter)
-
-            self.output_rows = DataRowBatch(self.tbl, self.evaluator, sum(counts))
-            # populate frame_idx_col
-            row_idx = 0
-            for input_row_idx, count in enumerate(counts):
-                if self.input_rows[input_row_idx][video_col_idx] is None:
-                    self.output_rows[row_idx][self.frame_idx_slot_idx] = None
-                    row_idx += 1
-                    continue
-                for i in range(count):
-                    self.output_rows[row_idx][self.frame_idx_slot_idx] = i
-                    row_idx += 1
-            # populate cols we get from the input df
-            for info in self.input_cols:
-                row_idx = 0
-                col_idx = self.row_column_pos[info.col.name]
-                for input_row_idx, input_row in enumerate(self.input_rows):
-                    val = input_row[col_idx]
-                    for i in range(counts[input_row_idx]):
-                        self.output_rows[row_idx][info.slot_idx] = val
-                        row_idx += 1
+            if not info.col.col_type.is_image_type():
+                continue
+            col_idx = self.row_column_pos[info.col.name]
+            val = input_row[col_idx]
+            if isinstance(val, bytes):
+                if result is input_row:
+                    # copy the input row to avoid indirectly modifying the argument
+                    result = input_row.copy()
+                # we will save literal to a file here and use this path as the new value
+                valpath = str(ImageStore.get_path(self.tbl.id, info.col.id, self.tbl.version))
+                with open(valpath, 'wb') as f:
+                    f.write(val)
+                result[col_idx] = str(ImageStore.add(self.tbl.id, info.col.id, self.tbl.version, valpath))
+        return result
 
-        # assign row ids
-        self.output_rows.set_row_ids([self.start_row_id + i for i in range(len(self.output_rows))])
-        self.ctx.num_rows = len(self.output_rows)
+    def _add_output_row(
+            self, batch: DataRowBatch, input_row: List[Any], frame_idx: Optional[int] = None,
+            video_path: Optional[str] = None, video_md: Optional[Dict[int, Dict[str, Any]]] = None
+    ) -> None:
+        output_row = batch.add_row()
+        if video_md is not None:
+            for slot_idx, md in video_md.items():
+                output_row.video_md[slot_idx] = md
+        for info in self.input_cols:
+            val = input_row[self.row_column_pos[info.col.name]]
+            output_row[info.slot_idx] = val
+            if video_path is not None and info.col.id == self.tbl.parameters.frame_src_col_id \
+                    and val is not None and fetch.is_remote(val):
+                # we already have a local copy
+                output_row.file_paths[info.slot_idx] = video_path
+        if self.frame_idx_slot_idx is not None:
+            output_row[self.frame_idx_slot_idx] = frame_idx
+
+    def _load_chunk(self, num_rows: int) -> None:
+        """Read the next num_rows input rows into pending_rows, with their frame counts and video metadata"""
+        input_rows = [self._prepare_row(row) for row in itertools.islice(self.input_iter, num_rows)]
+        if len(input_rows) == 0:
+            return
+        frame_src_col = self.tbl.frame_src_col()
+        video_cols = [info.col for info in self.video_md_cols]
+        if frame_src_col is not None and frame_src_col not in video_cols:
+            video_cols.append(frame_src_col)
+        vals_by_col = {
+            col.id: [input_row[self.row_column_pos[col.name]] for input_row in input_rows] for col in video_cols}
+        # remote videos that are only probed (not decoded) and aren't cached are probed with range requests
+        frame_src_urls = set(vals_by_col[frame_src_col.id]) if frame_src_col is not None else set()
+        probe_only_urls = list({
+            url: None for col in video_cols for url in vals_by_col[col.id]
+            if url is not None and url not in frame_src_urls and fetch.is_remote(url)
+        })
+        cached_paths = FileCache.get().lookup_batch(probe_only_urls) if len(probe_only_urls) > 0 else []
+        ranged_urls = [url for url, path in zip(probe_only_urls, cached_paths) if path is None]
+        ranged_md: Dict[str, Dict[str, Any]] = {}
+        if len(ranged_urls) > 0:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=DownloadPool.INITIAL_CONCURRENCY) as executor:
+                ranged_md = {
+                    url: md for url, md in zip(ranged_urls, executor.map(fetch.probe_remote_video, ranged_urls))
+                    if md is not None
+                }
+        # the other videos are downloaded once, into the file cache; frame extraction later on uses the cached file
+        local_paths: Dict[str, str] = {}
+        for col in video_cols:
+            local_paths.update(self._get_local_paths(col, [url for url in vals_by_col[col.id] if url not in ranged_md]))
+
+        def probe(url: str) -> Optional[Dict[str, Any]]:
+            try:
+                return video.probe(local_paths[url])
+            except exc.Error as e:
+                # the metadata stays NULL; if this is a frame extraction source, counting the frames reports the error
+                _logger.warning(f'Failed to probe video {url}: {e}')
+                return None
+
+        def count_frames(url: Optional[str]) -> int:
+            if url is None:
+                return 1  # this will occupy one row in the output
+            params = self.tbl.parameters
+            return video.count_frames(
+                local_paths[url], fps=params.extraction_fps, mode=params.extraction_mode, tbl_id=self.tbl.id,
+                md=video_md.get(url))
+
+        # probing is dominated by opening the file and parsing the container (or, for scene detection, by decoding):
+        # do it in parallel
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            probed_urls = list(local_paths.keys()) if len(self.video_md_cols) > 0 else []
+            video_md: Dict[str, Optional[Dict[str, Any]]] = dict(zip(probed_urls, executor.map(probe, probed_urls)))
+            video_md.update(ranged_md)
+            if frame_src_col is not None:
+                frame_src_col_idx = self.row_column_pos[frame_src_col.name]
+                video_urls = [input_row[frame_src_col_idx] for input_row in input_rows]
+                counts = list(executor.map(count_frames, video_urls))
+            else:
+                video_urls, counts = [None] * len(input_rows), [1] * len(input_rows)
 
-    def _get_local_path(self, url: str) -> str:
-        """Returns local path for url"""
-        if url is None:
-            return None
-        parsed = urllib.parse.urlparse(url)
-        if parsed.scheme == '' or parsed.scheme == 'file':
-            # local file path
-            return parsed.path
-        if parsed.scheme == 's3':
-            from pixeltable.utils.s3 import get_client
-            if self.boto_client is None:
-                self.boto_client = get_client()
-            tmp_path = str(Env.get().tmp_dir / os.path.basename(parsed.path))
-            self.boto_client.download_file(parsed.netloc, parsed.path.lstrip('/'), tmp_path)
-            return tmp_path
-        assert False, f'Unsupported URL scheme: {parsed.scheme}'
+        for input_row, count, url in zip(input_rows, counts, video_urls):
+            row_video_md = {
+                info.slot_idx: video_md.get(input_row[self.row_column_pos[info.col.name]])
+                for info in self.video_md_cols
+            }
+            self.pending_rows.append(
+                (input_row, count, local_paths[url] if url is not None else None, row_video_md))
 
     def __next__(self) -> DataRowBatch:
-        if self.has_returned_data:
+        batch_size = self.ctx.batch_size if self.ctx.batch_size > 0 else sys.maxsize
+        output_rows = DataRowBatch(self.tbl, self.evaluator)
+        if not self.tbl.extracts_frames() and len(self.video_md_cols) == 0:
+            for input_row in itertools.islice(self.input_iter, batch_size):
+                self._add_output_row(output_rows, self._prepare_row(input_row))
+        else:
+            # if we're extracting frames, we replace each row with one row per frame, which has the frame_idx col set
+            while len(output_rows) < batch_size:
+                if len(self.pending_rows) == 0:
+                    self._load_chunk(self.ctx.batch_size if self.ctx.batch_size > 0 else sys.maxsize)
+                    if len(self.pending_rows) == 0:
+                        break
+                input_row, count, video_path, video_md = self.pending_rows[0]
+                if video_path is None:
+                    self._add_output_row(output_rows, input_row, video_md=video_md)
+                    self.next_frame_idx = count
+                else:
+                    end_frame_idx = min(count, self.next_frame_idx + batch_size - len(output_rows))
+                    for frame_idx in range(self.next_frame_idx, end_frame_idx):
+                        self._add_output_row(output_rows, input_row, frame_idx, video_path, video_md)
+                    self.next_frame_idx = end_frame_idx
+                if self.next_frame_idx == count:
+                    self.pending_rows.popleft()
+                    self.next_frame_idx = 0
+
+        if len(output_rows) == 0:
             raise StopIteration
-        self.has_returned_data = True
-        _logger.debug(f'InsertDataNode: created row batch with {len(self.output_rows)} output_rows')
-        return self.output_rows
+        # assign row ids
+        output_rows.set_row_ids([self.next_row_id + i for i in range(len(output_rows))])
+        self.next_row_id += len(output_rows)
+        _logger.debug(f'InsertDataNode: created row batch with {len(output_rows)} output_rows')
+        return output_rows
+
+    def _get_local_paths(self, col: catalog.Column, urls: List[Optional[str]]) -> Dict[str, str]:
+        """Returns the local paths for urls; remote urls are downloaded into the file cache"""
+        result: Dict[str, str] = {}
+        remote_urls: List[str] = []
+        for url in urls:
+            if url is None or url in result or url in remote_urls:
+                continue
+            if fetch.is_remote(url):
+                remote_urls.append(url)
+            else:
+                # local file path
+                result[url] = urllib.parse.urlparse(url).path
+        if len(remote_urls) == 0:
+            return result
+
+        file_cache = FileCache.get()
+        miss_urls: List[str] = []
+        for url, local_path in zip(remote_urls, file_cache.lookup_batch(remote_urls)):
+            if local_path is None:
+                miss_urls.append(url)
+            else:
+                result[url] = str(local_path)
+        if len(miss_urls) > 0:
+            results, stats = fetch.fetch_into_cache(
+                self.tbl.id, miss_urls, [col.id] * len(miss_urls), query_ts=self.query_ts)
+            _logger.debug(f'InsertDataNode: downloaded {stats}')
+            for url, (local_path, is_cached) in zip(miss_urls, results):
+                if not is_cached:
+                    self.uncached_paths.append(local_path)
+                result[url] = str(local_path)
+        return result
+
+    def _close(self) -> None:
+        for path in self.uncached_paths:
+            os.remove(path)
+        self.uncached_paths = []
 
 
 class CachePrefetchNode(ExecNode):
     """Brings files with external URLs into the cache
 
-    TODO:
-    - maintain a queue of row batches, in order to overlap download and evaluation
-    - adapting the number of download threads at runtime to maximize throughput
+    Downloads run in the shared DownloadPool, which adapts its concurrency, retries and hedges; the stats of each
+    batch are recorded in batch_stats.
+
+    The node reads ahead: it pulls batches from its input and starts their downloads in the background while the
+    previous batches are being evaluated, up to a budget of rows (Env.readahead_rows) and estimated bytes
+    (Env.readahead_bytes, but at most half the file cache capacity). Read-ahead doesn't evict data of the current
+    query: all files accessed by the query have access times >= query_ts, which the file cache doesn't evict on its
+    behalf; the byte budget keeps read-ahead from pushing the query into the cache's MRU mode.
+
+    Cached files that changed at their source are replaced in the file cache; the previous files stay in place until
+    the node is closed, because rows of earlier batches might still reference them.
     """
+    _READAHEAD_CACHE_FRACTION = 0.5
+
     def __init__(self, tbl_id: UUID, file_col_info: List[ColumnInfo], input: ExecNode):
         # []: we don't have anything to evaluate
         super().__init__(input.evaluator, [], [], input)
         self.tbl_id = tbl_id
         self.file_col_info = file_col_info
 
-        # clients for specific services are constructed as needed, because it's time-consuming
-        self.boto_client: Optional[Any] = None
-        self.boto_client_lock = threading.Lock()
+        # entries accessed by this query aren't evicted from the file cache on behalf of this query
+        self.query_ts: Optional[float] = None
+        # downloaded files that weren't admitted to the file cache; they're needed until the next batch
+        self.uncached_paths: List[Path] = []
+        # previous versions of files that _revalidate() replaced in the file cache; removed by _close()
+        self.retired_paths: List[Path] = []
+        self.retired_lock = threading.Lock()
+        self.batch_stats: List[DownloadPool.BatchStats] = []
+
+        # batches that have been pulled from the input, with the future of their downloads (which returns their
+        # uncached paths) and their estimated download size
+        self.readahead: Deque[Tuple[DataRowBatch, concurrent.futures.Future, int]] = deque()
+        self.readahead_rows = 0
+        self.readahead_bytes = 0
+        self.max_readahead_rows = 0
+        self.max_readahead_bytes = 0
+        self.input_exhausted = False
+        # downloads of successive batches run one after the other, each one in the DownloadPool
+        self.fetch_executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        # set by _close(): stops the downloads of the batch in progress
+        self.cancel_fetch = threading.Event()
 
-    def __next__(self) -> DataRowBatch:
-        input_batch = next(self.input)
-        if len(input_batch) == 0:
-            return input_batch
+    def _open(self) -> None:
+        self.query_ts = time.time()
+        self.cancel_fetch.clear()
+        self.max_readahead_rows = Env.get().readahead_rows
+        self.max_readahead_bytes = min(
+            Env.get().readahead_bytes, int(FileCache.get().capacity * self._READAHEAD_CACHE_FRACTION))
+        self.fetch_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _close(self) -> None:
+        self._remove_uncached_paths()
+        # the query might have stopped early (eg, show(n)): abandon the read-ahead batches instead of waiting for
+        # their downloads
+        self.cancel_fetch.set()
+        with self.retired_lock:
+            FileCache.get().remove_retired(self.retired_paths)
+            self.retired_paths = []
+        if self.fetch_executor is not None:
+            self.fetch_executor.shutdown(wait=False, cancel_futures=True)
+            self.fetch_executor = None
+        while len(self.readahead) > 0:
+            _, future, _ = self.readahead.popleft()
+            # batches whose downloads completed leave behind their uncached files; a cancelled batch removes the
+            # files it wrote itself
+            future.add_done_callback(self._remove_fetched_paths)
+        FileCache.get().flush()
+
+    @classmethod
+    def _remove_fetched_paths(cls, future: concurrent.futures.Future) -> None:
+        if future.cancelled() or future.exception() is not None:
+            return
+        for path in future.result():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _remove_uncached_paths(self) -> None:
+        for path in self.uncached_paths:
+            os.remove(path)
+        self.uncached_paths = []
 
-        # collect external URLs that aren't already cached, and set DataRow.file_paths for those that are
+    def __next__(self) -> DataRowBatch:
+        # the previous batch has been consumed
+        self._remove_uncached_paths()
+        self._fill_readahead()
+        if len(self.readahead) == 0:
+            raise StopIteration
+        batch, future, est_bytes = self.readahead.popleft()
+        self.readahead_rows -= len(batch)
+        self.readahead_bytes -= est_bytes
+        # start the downloads for the following batches before waiting for this one's
+        self._fill_readahead()
+        self.uncached_paths = future.result()
+        return batch
+
+    def _avg_download_size(self) -> int:
+        num_files = sum(stats.num_files for stats in self.batch_stats)
+        if num_files > 0:
+            return int(sum(stats.num_bytes for stats in self.batch_stats) / num_files)
+        return FileCache.get().avg_file_size()
+
+    def _fill_readahead(self) -> None:
+        """Pull batches from the input and start their downloads, until the read-ahead budget is exhausted"""
+        while not self.input_exhausted:
+            # we always need at least one batch
+            if len(self.readahead) > 0 and (
+                    self.readahead_rows >= self.max_readahead_rows or self.readahead_bytes >= self.max_readahead_bytes
+            ):
+                break
+            try:
+                batch = next(self.input)
+            except StopIteration:
+                self.input_exhausted = True
+                break
+            url_rows, miss_urls, stale_urls = self._lookup(batch)
+            est_bytes = len(miss_urls) * self._avg_download_size()
+            future = self.fetch_executor.submit(self._fetch_batch, url_rows, miss_urls, stale_urls)
+            self.readahead.append((batch, future, est_bytes))
+            self.readahead_rows += len(batch)
+            self.readahead_bytes += est_bytes
+
+    def _lookup(
+            self, batch: DataRowBatch
+    ) -> Tuple[Dict[str, List[Tuple[exprs.DataRow, ColumnInfo]]], List[str], Dict[str, Validators]]:
+        """Set DataRow.file_paths for the cached external URLs of batch
+
+        Returns
+        - the (row, info) with a url that needs a local path, grouped by url
+        - the urls that aren't cached
+        - the urls of cached files that need to be revalidated, with their validators
+        """
         file_cache = FileCache.get()
-        cache_misses: List[Tuple[exprs.DataRow, ColumnInfo]] = []
-        missing_url_rows: Dict[str, List[exprs.DataRow]] = defaultdict(list)
-        for row in input_batch:
+        url_rows: Dict[str, List[Tuple[exprs.DataRow, ColumnInfo]]] = defaultdict(list)
+        for row in batch:
             for info in self.file_col_info:
                 url = row.file_urls[info.slot_idx]
                 if url is None or row.file_paths[info.slot_idx] is not None:
                     # nothing to do
                     continue
-                if url in missing_url_rows:
-                    missing_url_rows[url].append(row)
-                    continue
-                local_path = file_cache.lookup(url)
-                if local_path is None:
-                    cache_misses.append((row, info))
-                    missing_url_rows[url].append(row)
-                else:
-                    row.file_paths[info.slot_idx] = local_path
-
-        # download the cache misses in parallel
-        # TODO: set max_workers to maximize throughput
-        futures: Dict[concurrent.futures.Future, Tuple[exprs.DataRow, ColumnInfo]] = {}
-        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-            for row, info in cache_misses:
-                futures[executor.submit(self._fetch_url, row.file_urls[info.slot_idx])] = (row, info)
-            for future in concurrent.futures.as_completed(futures):
-                # TODO:  does this need to deal with recoverable errors (such as retry after throttling)?
-                tmp_path = future.result()
-                row, info = futures[future]
-                url = row.file_urls[info.slot_idx]
-                local_path = file_cache.add(self.tbl_id, info.col.id, url, tmp_path)
+                url_rows[url].append((row, info))
+        urls = list(url_rows.keys())
+        miss_urls: List[str] = []
+        stale_urls: Dict[str, Validators] = {}
+        for url, local_path in zip(urls, file_cache.lookup_batch(urls)):
+            if local_path is None:
+                miss_urls.append(url)
+                continue
+            for row, info in url_rows[url]:
+                row.file_paths[info.slot_idx] = str(local_path)
+            validators = file_cache.stale_validators(url)
+            if validators is not None:
+                stale_urls[url] = validators
+        return url_rows, miss_urls, stale_urls
+
+    def _fetch_batch(
+            self, url_rows: Dict[str, List[Tuple[exprs.DataRow, ColumnInfo]]], miss_urls: List[str],
+            stale_urls: Dict[str, Validators]
+    ) -> List[Path]:
+        """Download miss_urls and changed stale_urls, set DataRow.file_paths for them and return the paths that
+        weren't cached
+        """
+        uncached_paths: List[Path] = []
+        if len(stale_urls) > 0:
+            uncached_paths.extend(self._revalidate(url_rows, stale_urls))
+        if len(miss_urls) == 0:
+            return uncached_paths
+        col_ids = [url_rows[url][0][1].col.id for url in miss_urls]
+        try:
+            results, stats = fetch.fetch_into_cache(
+                self.tbl_id, miss_urls, col_ids, query_ts=self.query_ts, cancel=self.cancel_fetch)
+        except DownloadCancelled:
+            for path in uncached_paths:
+                os.remove(path)
+            raise
+        self.batch_stats.append(stats)
+        _logger.debug(f'PrefetchNode: downloaded {stats}')
+        for url, (local_path, is_cached) in zip(miss_urls, results):
+            if not is_cached:
+                uncached_paths.append(local_path)
+            else:
                 _logger.debug(f'PrefetchNode: cached {url} as {local_path}')
-                for row in missing_url_rows[url]:
-                    row.file_paths[info.slot_idx] = str(local_path)
+            for row, info in url_rows[url]:
+                row.file_paths[info.slot_idx] = str(local_path)
+        return uncached_paths
 
-        return input_batch
+    def _revalidate(
+            self, url_rows: Dict[str, List[Tuple[exprs.DataRow, ColumnInfo]]], stale_urls: Dict[str, Validators]
+    ) -> List[Path]:
+        """Revalidate the cached files of stale_urls with conditional requests and replace those that changed
 
+        Returns the paths of replacements that weren't cached.
+        """
+        file_cache = FileCache.get()
 
-    def _fetch_url(self, url: str) -> str:
-        """Fetches a remote URL into Env.tmp_dir and returns its path"""
-        parsed = urllib.parse.urlparse(url)
-        assert parsed.scheme != '' and parsed.scheme != 'file'
-        if parsed.scheme == 's3':
-            from pixeltable.utils.s3 import get_client
-            with self.boto_client_lock:
-                if self.boto_client is None:
-                    self.boto_client = get_client()
-            tmp_path = Env.get().tmp_dir / os.path.basename(parsed.path)
-            self.boto_client.download_file(parsed.netloc, parsed.path.lstrip('/'), str(tmp_path))
-            return tmp_path
-        assert False, f'Unsupported URL scheme: {parsed.scheme}'
+        def revalidate(url: str) -> Optional[Tuple[Path, bool]]:
+            tmp_path = fetch.tmp_path(url)
+            modified, validators = HttpClient.get().download(url, tmp_path, validators=stale_urls[url])
+            if not modified:
+                file_cache.set_validated(url)
+                return None
+            _logger.debug(f'PrefetchNode: {url} changed')
+            _, info = url_rows[url][0]
+            # rows of earlier batches might reference the previous file: it's retired, not removed
+            local_path, retired_path = file_cache.replace(
+                self.tbl_id, info.col.id, url, tmp_path, query_ts=self.query_ts, validators=validators)
+            if retired_path is not None:
+                with self.retired_lock:
+                    if self.cancel_fetch.is_set():
+                        # the node has been closed already
+                        file_cache.remove_retired([retired_path])
+                    else:
+                        self.retired_paths.append(retired_path)
+            return local_path, local_path != tmp_path
+
+        def discard(result: Optional[Tuple[Path, bool]]) -> None:
+            if result is not None and not result[1]:
+                os.remove(result[0])
+
+        urls = list(stale_urls.keys())
+        results, _ = DownloadPool.get().map(urls, revalidate, discard_fn=discard, cancel=self.cancel_fetch)
+        uncached_paths: List[Path] = []
+        for url, result in zip(urls, results):
+            if result is None:
+                continue
+            local_path, is_cached = result
+            if not is_cached:
+                uncached_paths.append(local_path)
+            for row, info in url_rows[url]:
+                row.file_paths[info.slot_idx] = str(local_path)
+        return uncached_paths
@@ -12,6 +12,8 @@ import io
 from collections.abc import Iterable
 import time
 import inspect
+import concurrent.futures
+import logging
 from uuid import UUID
 import urllib.parse
 import urllib.request
@@ -26,10 +28,17 @@ from pixeltable.type_system import \
     ColumnType, InvalidType, StringType, IntType, FloatType, BoolType, JsonType, ArrayType
 from pixeltable.function import Function, FunctionRegistry
 from pixeltable.exceptions import Error, ExprEvalError
-from pixeltable.utils.video import FrameIterator
+from pixeltable.utils.video import FrameIterator, DecoderPool, DecoderConfig, get_frame_rate
+from pixeltable.utils.framecache import FrameCache
+from pixeltable.utils.imgcodec import ImageCodec
+from pixeltable.utils.imgsegment import SegmentReader
+from pixeltable.utils.imgstore import ImageStore
 from pixeltable.utils import print_perf_counter_delta
 from pixeltable.utils.clip import embed_image, embed_text
 
+
+_logger = logging.getLogger('pixeltable')
+
 # Python types corresponding to our literal types
 LiteralPythonTypes = Union[str, int, float, bool, datetime.datetime, datetime.date]
 
@@ -496,6 +505,10 @@ class ColumnRef(Expr):
             if self.col.is_computed and not self.col.is_stored:
                 raise Error(f'{name} not valid for computed unstored columns: {self}')
             return ColumnPropertyRef(self, ColumnPropertyRef.Property[name.upper()])
+        if name in catalog.Column.VIDEO_MD_TYPES and self.col.col_type.is_video_type():
+            if not self.col.has_video_md:
+                raise Error(f'{name} not available for {self}: the column was created without video metadata')
+            return ColumnPropertyRef(self, ColumnPropertyRef.Property[name.upper()])
 
         if self.col_type.is_json_type():
             return JsonPath(self).__getattr__(name)
@@ -543,15 +556,24 @@ class ColumnPropertyRef(Expr):
     """A reference to a property of a table column
 
     The properties themselves are type-specific and may or may not need to reference the underlying column data.
+    The video metadata properties (DURATION through BITRATE) are stored columns, which makes them usable in SQL filters.
     """
     class Property(enum.Enum):
         ERRORTYPE = 0
         ERRORMSG = 1
         FILEURL = 2
         LOCALPATH = 3
+        DURATION = 4
+        FPS = 5
+        WIDTH = 6
+        HEIGHT = 7
+        NUM_FRAMES = 8
+        CODEC = 9
+        BITRATE = 10
 
     def __init__(self, col_ref: ColumnRef, prop: Property):
-        super().__init__(StringType(nullable=True))
+        video_md_type = catalog.Column.VIDEO_MD_TYPES.get(prop.name.lower())
+        super().__init__(video_md_type(nullable=True) if video_md_type is not None else StringType(nullable=True))
         self.components = [col_ref]
         self.prop = prop
 
@@ -577,6 +599,8 @@ class ColumnPropertyRef(Expr):
         if self.prop == self.Property.ERRORMSG:
             assert self._col_ref.col.sa_errormsg_col is not None
             return self._col_ref.col.sa_errormsg_col
+        if self.prop.name.lower() in self._col_ref.col.sa_video_md_cols:
+            return self._col_ref.col.sa_video_md_cols[self.prop.name.lower()]
         return None
 
     def eval(self, data_row: DataRow, evaluator: Evaluator) -> None:
@@ -585,7 +609,13 @@ class ColumnPropertyRef(Expr):
         if self.prop == self.Property.FILEURL:
             data_row[self.slot_idx] = data_row.file_urls[self._col_ref.slot_idx]
         if self.prop == self.Property.LOCALPATH:
-            data_row[self.slot_idx] = data_row.file_paths[self._col_ref.slot_idx]
+            file_range = data_row.file_ranges[self._col_ref.slot_idx]
+            if file_range is not None:
+                # the image is stored in a segment file
+                data_row[self.slot_idx] = ImageStore.extract_packed(
+                    data_row.file_paths[self._col_ref.slot_idx], *file_range)
+            else:
+                data_row[self.slot_idx] = data_row.file_paths[self._col_ref.slot_idx]
 
     def _as_dict(self) -> Dict:
         return {'prop': self.prop.value, **super()._as_dict()}
@@ -612,7 +642,13 @@ class FrameColumnRef(ColumnRef):
         self.components = [ColumnRef(video_col), ColumnRef(frame_idx_col)]
         # execution state
         self.current_video: Optional[str] = None
+        self.current_video_key: Optional[str] = None
+        self.current_frame_rate: Optional[float] = None
         self.frames: Optional[FrameIterator] = None
+        # overrides the decoder of the table for a particular query
+        self.decoder: Optional[DecoderConfig] = None
+        # the most recently submitted decoding task per video (see submit_batch())
+        self.decode_tasks: Dict[str, concurrent.futures.Future] = {}
 
     @property
     def _video_ref(self) -> ColumnRef:
@@ -625,23 +661,131 @@ class FrameColumnRef(ColumnRef):
     def sql_expr(self) -> Optional[sql.sql.expression.ClauseElement]:
         return None
 
+    def _get_decoder(self) -> DecoderConfig:
+        if self.decoder is not None:
+            return self.decoder
+        return DecoderConfig.from_dict(self.tbl.parameters.decoder)
+
     def eval(self, data_row: DataRow, evaluator: Evaluator) -> None:
         # extract frame
         assert data_row.file_paths[self._video_ref.slot_idx] is not None
         video_path = data_row.file_paths[self._video_ref.slot_idx]  # we need the local path
-        if self.frames is None or self.current_video != video_path:
+        fps, mode = self.tbl.parameters.extraction_fps, self.tbl.parameters.extraction_mode
+        decoder = self._get_decoder()
+        if self.current_video != video_path:
             self.current_video = video_path
+            self.current_video_key = FrameCache.video_key(video_path, fps, mode, decoder.output_key)
+            self.current_frame_rate = get_frame_rate(video_path, fps, mode, self.tbl.id)
             if self.frames is not None:
-                self.frames.close()
-            self.frames = FrameIterator(self.current_video, fps=self.tbl.parameters.extraction_fps)
+                DecoderPool.get().release(self.frames)
+                self.frames = None
         frame_idx = data_row[self._frame_idx_ref.slot_idx]
-        self.frames.seek(frame_idx)
-        _, frame = next(self.frames, None)
+        frame_cache = FrameCache.get()
+        key = frame_cache.key(self.current_video_key, frame_idx)
+        frame = frame_cache.lookup(key)
+        if frame is None:
+            if self.frames is None:
+                # an open decoder positioned after the previously requested frame of this video streams forward
+                self.frames = DecoderPool.get().acquire(
+                    video_path, fps=fps, tbl_id=self.tbl.id, mode=mode, decoder=decoder)
+            # frames the decoder streams to are cheap to decode again: only those that needed a seek go to disk
+            spill = frame_idx != self.frames.next_frame_idx
+            self.frames.seek(frame_idx)
+            _, frame = next(self.frames, None)
+            frame_cache.add(key, frame, spill=spill)
+        # make_video() picks up the frame rate
+        frame.info['fps'] = self.current_frame_rate
         data_row[self.slot_idx] = frame
 
+    def eval_batch(self, data_rows: List[DataRow], executor: concurrent.futures.Executor) -> None:
+        """Materialize the frames of data_rows, decoding the frames of different videos in parallel."""
+        futures = self.submit_batch(data_rows, executor)
+        self.wait(futures)
+
+    @classmethod
+    def wait(cls, futures: List[concurrent.futures.Future]) -> None:
+        """Wait for the decoding tasks returned by submit_batch()"""
+        for future in concurrent.futures.as_completed(futures):
+            exc = future.exception()
+            if exc is not None:
+                # eval() records the error for the affected rows
+                _logger.debug(f'FrameColumnRef: decoding failed: {exc}')
+
+    def submit_batch(
+            self, data_rows: List[DataRow], executor: concurrent.futures.Executor
+    ) -> List[concurrent.futures.Future]:
+        """Start materializing the frames of data_rows and return the decoding tasks, one per video.
+
+        The frames of each video are decoded in ascending order by a single task, which streams through the video.
+        Tasks of consecutive batches run in parallel, except for tasks of the same video: those run one after the
+        other, so that the later one continues with the decoder the earlier one released.
+        Rows whose frame can't be materialized here (missing inputs, decoding errors) are left to eval().
+        """
+        fps, mode = self.tbl.parameters.extraction_fps, self.tbl.parameters.extraction_mode
+        decoder = self._get_decoder()
+        # key: video path, value: [(frame idx, data row)]
+        rows_by_video: Dict[str, List[Tuple[int, DataRow]]] = {}
+        for data_row in data_rows:
+            if data_row.has_val[self.slot_idx] or data_row.has_exc(self.slot_idx) \
+                    or not data_row.has_val[self._frame_idx_ref.slot_idx]:
+                continue
+            video_path = data_row.file_paths[self._video_ref.slot_idx]
+            frame_idx = data_row[self._frame_idx_ref.slot_idx]
+            if video_path is None or frame_idx is None:
+                continue
+            rows_by_video.setdefault(video_path, []).append((frame_idx, data_row))
+
+        def decode(video_path: str, rows: List[Tuple[int, DataRow]]) -> None:
+            frame_cache = FrameCache.get()
+            video_key = frame_cache.video_key(video_path, fps, mode, decoder.output_key)
+            frame_rate = get_frame_rate(video_path, fps, mode, self.tbl.id)
+            frames: Optional[FrameIterator] = None
+            try:
+                for frame_idx, data_row in sorted(rows, key=lambda t: t[0]):
+                    key = frame_cache.key(video_key, frame_idx)
+                    frame = frame_cache.lookup(key)
+                    if frame is None:
+                        if frames is None:
+                            frames = DecoderPool.get().acquire(
+                                video_path, fps=fps, tbl_id=self.tbl.id, mode=mode, decoder=decoder)
+                        spill = frame_idx != frames.next_frame_idx
+                        frames.seek(frame_idx)
+                        result = next(frames, None)
+                        if result is None:
+                            return
+                        frame = result[1]
+                        frame_cache.add(key, frame, spill=spill)
+                    frame.info['fps'] = frame_rate
+                    # each row is only written by this task
+                    data_row[self.slot_idx] = frame
+            finally:
+                if frames is not None:
+                    DecoderPool.get().release(frames)
+
+        def run(
+                video_path: str, rows: List[Tuple[int, DataRow]], prev_task: Optional[concurrent.futures.Future]
+        ) -> None:
+            if prev_task is not None:
+                # the executor starts tasks in submission order: prev_task is already running
+                concurrent.futures.wait([prev_task])
+            decode(video_path, rows)
+
+        futures: List[concurrent.futures.Future] = []
+        for video_path, rows in rows_by_video.items():
+            prev_task = self.decode_tasks.get(video_path)
+            if prev_task is not None and prev_task.done():
+                prev_task = None
+            future = executor.submit(run, video_path, rows, prev_task)
+            self.decode_tasks[video_path] = future
+            futures.append(future)
+        for video_path in [p for p, f in self.decode_tasks.items() if f.done()]:
+            del self.decode_tasks[video_path]
+        return futures
+
     def release(self) -> None:
+        self.decode_tasks.clear()
         if self.frames is not None:
-            self.frames.close()
+            DecoderPool.get().release(self.frames)
             self.frames = None
 
 
@@ -1874,6 +2018,16 @@ class DataRow:
         # - None if vals[i] is not an image/video or if there is no local file yet for file_urls[i]
         self.file_paths: Optional[str] = [None] * size
 
+        # file_ranges:
+        # - (offset, length) within file_paths[i] if the image is stored in a segment file (see ImageStore)
+        # - None otherwise
+        self.file_ranges: List[Optional[Tuple[int, int]]] = [None] * size
+
+        # video_md:
+        # - metadata of the video in vals[i] (see video.probe()), if it was probed for storing the row
+        # - None otherwise
+        self.video_md: List[Optional[Dict[str, Any]]] = [None] * size
+
     def clear(self) -> None:
         size = len(self.vals)
         self.vals = [None] * size
@@ -1882,6 +2036,8 @@ class DataRow:
         self.pk = None
         self.file_urls = [None] * size
         self.file_paths = [None] * size
+        self.file_ranges = [None] * size
+        self.video_md = [None] * size
 
     def set_pk(self, pk: Tuple[int, ...]) -> None:
         self.pk = pk
@@ -1910,7 +2066,12 @@ class DataRow:
             # if we need to load this from a file, it should have been materialized locally
             assert not(self.file_urls[index] is not None and self.file_paths[index] is None)
             if self.file_paths[index] is not None and self.vals[index] is None:
-                self.vals[index] = PIL.Image.open(self.file_paths[index])
+                if self.file_ranges[index] is not None:
+                    offset, length = self.file_ranges[index]
+                    buf = SegmentReader.read(self.file_paths[index], offset, length)
+                    self.vals[index] = ImageCodec.open_buffer(buf)
+                else:
+                    self.vals[index] = ImageCodec.open(self.file_paths[index])
 
         if index in self.video_slot_idxs:
             # the value of a video cell is the url
@@ -1943,17 +2104,7 @@ class DataRow:
         assert self.excs[idx] is None
 
         if (idx in self.img_slot_idxs or idx in self.video_slot_idxs) and isinstance(val, str):
-            # this is either a local file path or a URL
-            parsed = urllib.parse.urlparse(val)
-            if parsed.scheme == '' or parsed.scheme == 'file':
-                # local file path
-                assert self.file_urls[idx] is None and self.file_paths[idx] is None
-                self.file_urls[idx] = urllib.parse.urljoin('file:', urllib.request.pathname2url(parsed.path))
-                self.file_paths[idx] = urllib.parse.unquote(parsed.path)
-            else:
-                # URL
-                assert self.file_urls[idx] is None
-                self.file_urls[idx] = val
+            self._set_file(idx, val)
             if idx in self.video_slot_idxs:
                 # the value of a video cell is the url
                 self.vals[idx] = self.file_urls[idx]
@@ -1963,18 +2114,36 @@ class DataRow:
             self.vals[idx] = val
         self.has_val[idx] = True
 
+    def _set_file(self, idx: object, val: str) -> None:
+        """Set file_urls/_paths/_ranges from a local file path or a URL"""
+        parsed = urllib.parse.urlparse(val)
+        if parsed.scheme == '' or parsed.scheme == 'file':
+            # local file path
+            assert self.file_urls[idx] is None and self.file_paths[idx] is None
+            self.file_urls[idx] = urllib.parse.urljoin('file:', urllib.request.pathname2url(parsed.path))
+            self.file_paths[idx] = urllib.parse.unquote(parsed.path)
+            if parsed.scheme == 'file' and parsed.fragment != '':
+                # a range within a segment file: 'file://<path>#<offset>:<length>'
+                self.file_urls[idx] += f'#{parsed.fragment}'
+                offset, length = parsed.fragment.split(':')
+                self.file_ranges[idx] = (int(offset), int(length))
+        else:
+            # URL
+            assert self.file_urls[idx] is None
+            self.file_urls[idx] = val
+
+    def flush_img(self, index: object, store_fn: Optional[Callable[[PIL.Image.Image], str]] = None) -> None:
+        """Discard the in-memory value and save it via store_fn, if store_fn is not None
 
-    def flush_img(self, index: object, filepath: Optional[str] = None) -> None:
-        """Discard the in-memory value and save it to a local file, if filepath is not None"""
+        store_fn stores the image and returns its local file path or file URL.
+        """
         if self.vals[index] is None:
             return
         assert self.excs[index] is None
         if self.file_paths[index] is None:
-            if filepath is not None:
+            if store_fn is not None:
                 # we want to save this to a file
-                self.file_paths[index] = filepath
-                self.file_urls[index] = urllib.parse.urljoin('file:', urllib.request.pathname2url(filepath))
-                self.vals[index].save(filepath, format='JPEG')
+                self._set_file(index, store_fn(self.vals[index]))
             else:
                 # we discard the content of this cell
                 self.has_val[index] = False
@@ -4,8 +4,7 @@ import inspect
 from pathlib import Path
 import tempfile
 
-import PIL, cv2
-import numpy as np
+import PIL
 
 from pixeltable.type_system import StringType, IntType, JsonType, ColumnType, FloatType, ImageType, VideoType
 from pixeltable.function import Function, FunctionRegistry
@@ -15,7 +14,7 @@ import pixeltable.exceptions as exc
 # import all standard function modules here so they get registered with the FunctionRegistry
 import pixeltable.functions.pil
 import pixeltable.functions.pil.image
-from pixeltable.utils.video import convert_to_h264
+from pixeltable.utils.video import VideoEncoder
 
 
 # def udf_call(eval_fn: Callable, return_type: ColumnType, tbl: Optional[catalog.Table]) -> exprs.FunctionCall:
@@ -102,29 +101,22 @@ FunctionRegistry.get().register_function(__name__, 'mean', mean)
 
 class VideoAggregator:
     def __init__(self):
-        self.video_writer = None
-        self.size = None
+        self.encoder: Optional[VideoEncoder] = None
 
     @classmethod
     def make_aggregator(cls) -> 'VideoAggregator':
         return cls()
 
     def update(self, frame: PIL.Image.Image) -> None:
-        if self.video_writer is None:
-            self.size = (frame.width, frame.height)
+        if self.encoder is None:
             self.out_file = Path(os.getcwd()) / f'{Path(tempfile.mktemp()).name}.mp4'
-            self.tmp_file = Path(os.getcwd()) / f'{Path(tempfile.mktemp()).name}.mp4'
-            # our target codec is H.264, but it's tainted by GPL and cv2 doesn't include it, so we use MP4V instead
-            self.video_writer = cv2.VideoWriter(str(self.tmp_file), cv2.VideoWriter_fourcc(*'mp4v'), 25, self.size)
-
-        frame_array = np.array(frame)
-        frame_array = cv2.cvtColor(frame_array, cv2.COLOR_RGB2BGR)
-        self.video_writer.write(frame_array)
+            # extracted frames carry the frame rate of their video
+            fps = frame.info.get('fps', VideoEncoder.DEFAULT_FPS)
+            self.encoder = VideoEncoder(self.out_file, fps, frame.size)
+        self.encoder.write(frame)
 
     def value(self) -> str:
-        self.video_writer.release()
-        convert_to_h264(self.tmp_file, self.out_file)
-        os.remove(self.tmp_file)
+        self.encoder.close()
         return str(self.out_file)
 
 make_video = Function.make_library_aggregate_function(
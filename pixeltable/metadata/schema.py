@@ -85,12 +85,18 @@ class TableParameters:
     frame_col_id: int = -1 # column id
     frame_idx_col_id: int = -1 # column id
     extraction_fps: int = -1
+    # 'fps', 'keyframes' or 'scenes'
+    extraction_mode: str = 'fps'
+    # parameters of the video decoder (see utils.video.DecoderConfig); None: the default decoder
+    decoder: Optional[dict] = None
 
     def reset(self) -> None:
         self.frame_src_col_id = -1
         self.frame_col_id = -1
         self.frame_idx_col_id = -1
         self.extraction_fps = -1
+        self.extraction_mode = 'fps'
+        self.decoder = None
 
 
 @dataclasses.dataclass
@@ -163,6 +169,15 @@ class SchemaColumn:
     stored: Optional[bool]
     # if True, creates vector index for this column
     is_indexed: bool
+    # VectorIndex.as_dict() of indexed columns; None: the default index
+    index_params: Optional[dict] = None
+    # storage codec of image columns
+    img_format: Optional[str] = None
+    img_quality: Optional[int] = None
+    # if True, images are stored in segment files
+    img_packed: bool = False
+    # if True, the store table has columns for the metadata of the videos in this column
+    has_video_md: bool = False
 
 
 @dataclasses.dataclass
@@ -1,4 +1,4 @@
-from typing import Tuple, Optional, List, Set, Any
+from typing import Tuple, Optional, List, Set, Any, Iterable
 from uuid import UUID
 
 import sqlalchemy as sql
@@ -8,8 +8,12 @@ from pixeltable import exprs
 from pixeltable.exec import \
     ColumnInfo, ExecContext, ExprEvalNode, InsertDataNode, SqlScanNode, ExecNode, AggregationNode, CachePrefetchNode
 from pixeltable import exceptions as exc
+from pixeltable.utils.video import DecoderConfig
 
 class Planner:
+    # number of output rows per batch of an insert plan; this bounds the memory use of inserts, which expand
+    # videos into frames
+    INSERT_BATCH_SIZE = 128
 
     # TODO: create an exec.CountNode and change this to create_count_plan()
     @classmethod
@@ -49,10 +53,12 @@ class Planner:
 
     @classmethod
     def create_insert_plan(
-            cls, tbl: catalog.TableVersion, rows: List[List[Any]], column_names: List[str]
+            cls, tbl: catalog.TableVersion, rows: Iterable[List[Any]], column_names: List[str]
     ) -> Tuple[ExecNode, List[ColumnInfo], List[ColumnInfo], int]:
         """Creates a plan for Table.insert()
 
+        rows are consumed incrementally, in batches of INSERT_BATCH_SIZE output rows.
+
         Returns:
             - root node of the plan
             - info for cols stored in the db
@@ -115,7 +121,7 @@ class Planner:
                 evaluator, computed_col_exprs, [evaluator.unique_exprs[i.slot_idx] for i in uncomputed_col_info],
                 ignore_errors=True, input=plan)
         plan.set_stored_img_cols(stored_img_col_info)
-        plan.set_ctx(ExecContext(evaluator, batch_size=0, show_pbar=True))
+        plan.set_ctx(ExecContext(evaluator, batch_size=cls.INSERT_BATCH_SIZE, show_pbar=True))
         return plan, db_col_info, idx_col_info, len(computed_col_info)
 
     @classmethod
@@ -436,12 +442,17 @@ class Planner:
             cls, tbl: catalog.TableVersion, select_list: List[exprs.Expr],
             where_clause: Optional[exprs.Predicate] = None, group_by_clause: List[exprs.Expr] = [],
             order_by_clause: List[Tuple[exprs.Expr, bool]] = [], limit: Optional[int] = None,
-            with_pk: bool = False, ignore_errors: bool = False, version: Optional[int] = None
+            with_pk: bool = False, ignore_errors: bool = False, version: Optional[int] = None,
+            decoder: Optional[DecoderConfig] = None
     ) -> Tuple[ExecNode, List[exprs.Expr]]:
         info = cls._analyze_query(
             tbl, select_list, where_clause=where_clause, group_by_clause=group_by_clause,
             order_by_clause=order_by_clause)
         evaluator = exprs.Evaluator(info.all_exprs, info.sql_exprs)
+        if decoder is not None:
+            for e in evaluator.unique_exprs:
+                if isinstance(e, exprs.FrameColumnRef):
+                    e.decoder = decoder
         cls._analyze_agg(evaluator, info)
         is_agg_query = len(info.group_by_clause) > 0 or len(info.agg_fn_calls) > 0
         ctx = ExecContext(evaluator)
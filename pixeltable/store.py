@@ -48,11 +48,28 @@ class StoreBase:
                 store_cols.append(col.sa_errortype_col)
             if col.is_indexed:
                 store_cols.append(col.sa_idx_col)
+            store_cols.extend(col.sa_video_md_cols.values())
 
         if self.sa_tbl is not None:
             # if we're called in response to a schema change, we need to remove the old table first
             self.sa_md.remove(self.sa_tbl)
         self.sa_tbl = sql.Table(self._storage_name(), self.sa_md, *store_cols)
+        for col in [c for c in self.tbl_version.cols if c.is_stored and c.is_indexed]:
+            self._create_sa_index(col)
+
+    def _create_sa_index(self, col: catalog.Column) -> sql.Index:
+        """Create the pgvector index of col's embeddings, as part of self.sa_tbl.
+
+        The index only covers the current versions of rows (v_max == MAX_VERSION): that's what queries against
+        the live table look at, and it keeps old row versions out of the index.
+        """
+        return sql.Index(
+            self._index_name(col), col.sa_idx_col, postgresql_using=col.index.type,
+            postgresql_with=col.index.build_params(), postgresql_ops={col.index_storage_name(): col.index.ops},
+            postgresql_where=self.v_max_col == schema.Table.MAX_VERSION)
+
+    def _index_name(self, col: catalog.Column) -> str:
+        return f'{self._storage_name()}_{col.index_storage_name()}'
 
     @abc.abstractmethod
     def _storage_name(self) -> str:
@@ -83,6 +100,11 @@ class StoreBase:
                 # we unfortunately need to set these, even if there are no errors
                 table_row[info.col.errortype_storage_name()] = None
                 table_row[info.col.errormsg_storage_name()] = None
+            if info.col.has_video_md:
+                video_md = input_row.video_md[info.slot_idx]
+                for name in info.col.VIDEO_MD_TYPES:
+                    table_row[info.col.video_md_storage_name(name)] = \
+                        video_md.get(name) if video_md is not None else None
 
         for info in idx_col_info:
             # don't use get_stored_val() here, we need to pass in the ndarray
@@ -108,7 +130,10 @@ class StoreBase:
         pass
 
     def create(self, conn: sql.engine.Connection) -> None:
-        self.sa_md.create_all(bind=conn)
+        # the table is still empty: trained indexes are deferred to create_deferred_indexes()
+        conn.execute(sql.schema.CreateTable(self.sa_tbl))
+        for col in [c for c in self.tbl_version.cols if c.is_stored and c.is_indexed and not c.index.is_trained]:
+            self.create_index(col, conn)
 
     def drop(self, conn: sql.engine.Connection) -> None:
         """Drop store table"""
@@ -118,7 +143,7 @@ class StoreBase:
         """Add column(s) to the store-resident table based on a catalog column
 
         Note that a computed catalog column will require two extra columns (for the computed value and for the error
-        message).
+        message), and a video column requires one extra column per metadata field.
         """
         assert col.is_stored
         stmt = f'ALTER TABLE {self._storage_name()} ADD COLUMN {col.storage_name()} {col.col_type.to_sql()}'
@@ -133,9 +158,42 @@ class StoreBase:
                     f'ADD COLUMN {col.errortype_storage_name()} {StringType().to_sql()} DEFAULT NULL')
             conn.execute(sql.text(stmt))
             added_storage_cols.extend([col.errormsg_storage_name(), col.errortype_storage_name()])
+        if col.has_video_md:
+            for name, col_type in col.VIDEO_MD_TYPES.items():
+                stmt = (f'ALTER TABLE {self._storage_name()} '
+                        f'ADD COLUMN {col.video_md_storage_name(name)} {col_type().to_sql()} DEFAULT NULL')
+                conn.execute(sql.text(stmt))
+                added_storage_cols.append(col.video_md_storage_name(name))
         self._create_sa_tbl()
         _logger.info(f'Added columns {added_storage_cols} to storage table {self._storage_name()}')
 
+    def create_index(self, col: catalog.Column, conn: sql.engine.Connection) -> None:
+        """Create the pgvector index of col
+
+        For added columns, this is called once the embeddings of the existing rows are loaded: building the index
+        in bulk is faster than maintaining it row by row, and IVFFlat indexes are trained on the data present at
+        build time.
+        """
+        assert col.is_indexed
+        idx = next(idx for idx in self.sa_tbl.indexes if idx.name == self._index_name(col))
+        idx.create(bind=conn)
+        _logger.info(f'Created {col.index.type} index {idx.name} for column {col.name}')
+
+    def create_deferred_indexes(self, conn: sql.engine.Connection) -> None:
+        """Create the trained (IVFFlat) indexes that don't exist yet
+
+        Building them on an empty table would train their lists on zero rows, which ruins recall; instead, they're
+        built once the table has rows, which is after the first insert.
+        """
+        deferred_cols = [
+            c for c in self.tbl_version.cols if c.is_stored and c.is_indexed and c.index.is_trained]
+        if len(deferred_cols) == 0:
+            return
+        inspector = sql.inspect(conn)
+        for col in deferred_cols:
+            if not inspector.has_index(self._storage_name(), self._index_name(col)):
+                self.create_index(col, conn)
+
     def drop_column(self, col: Optional[catalog.Column] = None, conn: Optional[sql.engine.Connection] = None) -> None:
         """Re-create self.sa_tbl and drop column, if one is given"""
         if col is not None:
@@ -147,6 +205,10 @@ class StoreBase:
                 conn.execute(sql.text(stmt))
                 stmt = f'ALTER TABLE {self._storage_name()} DROP COLUMN {col.errortype_storage_name()}'
                 conn.execute(sql.text(stmt))
+            if col.has_video_md:
+                for name in col.VIDEO_MD_TYPES:
+                    stmt = f'ALTER TABLE {self._storage_name()} DROP COLUMN {col.video_md_storage_name(name)}'
+                    conn.execute(sql.text(stmt))
         self._create_sa_tbl()
 
     def load_column(
@@ -188,7 +250,7 @@ class StoreBase:
                     assert not result_row.has_exc(embedding_slot_idx)
                     # don't use get_stored_val() here, we need to pass the ndarray
                     embedding = result_row[embedding_slot_idx]
-                    values_dict[col.sa_index_col] = embedding
+                    values_dict[col.sa_idx_col] = embedding
 
                 update_stmt = sql.update(self.sa_tbl).values(values_dict)
                 for pk_col, pk_val in zip(self.pk_columns(), result_row.pk):
@@ -231,6 +293,8 @@ class StoreBase:
                     conn.execute(sql.insert(self.sa_tbl), table_rows)
             if progress_bar is not None:
                 progress_bar.close()
+            if num_rows > 0:
+                self.create_deferred_indexes(conn)
             return num_rows, num_excs, cols_with_excs
         finally:
             exec_plan.close()
@@ -260,6 +324,7 @@ class StoreBase:
                 conn.execute(sql.insert(self.sa_tbl), table_rows)
         finally:
             exec_plan.close()
+        self._copy_video_md(conn)
 
         # mark old versions (v_min < self.version) of updated rows as deleted
         where_clause = where_clause if where_clause is not None else sql.true()
@@ -272,6 +337,28 @@ class StoreBase:
 
         return num_rows, num_excs, cols_with_excs
 
+    def _copy_video_md(self, conn: sql.engine.Connection) -> None:
+        """Copy the video metadata of the current versions of updated rows into their new versions
+
+        Video columns can't be updated, and update plans only materialize the column values.
+        """
+        md_cols = [
+            (sa_col, col.video_md_storage_name(name))
+            for col in self.tbl_version.cols if col.is_stored for name, sa_col in col.sa_video_md_cols.items()
+        ]
+        if len(md_cols) == 0:
+            return
+        old = self.sa_tbl.alias('old')
+        stmt = sql.update(self.sa_tbl) \
+            .values({sa_col: old.c[storage_name] for sa_col, storage_name in md_cols}) \
+            .where(self.v_min_col == self.tbl_version.version) \
+            .where(old.c.v_min < self.tbl_version.version) \
+            .where(old.c.v_max == schema.Table.MAX_VERSION)
+        # all pk columns other than v_min identify the row
+        for pk_col in self.pk_columns()[:-1]:
+            stmt = stmt.where(pk_col == old.c[pk_col.name])
+        conn.execute(stmt)
+
 
 class StoreTable(StoreBase):
     def __init__(self, tbl_version: catalog.TableVersion):
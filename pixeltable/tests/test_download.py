@@ -0,0 +1,77 @@
+import threading
+import time
+
+import pytest
+
+from pixeltable.utils.download import DownloadPool, DownloadCancelled
+
+
+class TestDownloadPool:
+    def test_retries(self) -> None:
+        pool = DownloadPool()
+        pool.BACKOFF_BASE = 0.01
+        num_calls = {'a': 0, 'b': 0}
+        lock = threading.Lock()
+
+        def fetch(item: str) -> int:
+            with lock:
+                num_calls[item] += 1
+                n = num_calls[item]
+            if item == 'a' and n < 3:
+                raise ConnectionError('connection reset')
+            return n
+
+        results, stats = pool.map(['a', 'b'], fetch, size_fn=lambda r: 100)
+        assert results == [3, 1]
+        assert stats.num_files == 2 and stats.num_bytes == 200 and stats.num_retries == 2
+
+        # non-retryable errors are raised right away
+        def fail(item: str) -> int:
+            raise ValueError(item)
+        with pytest.raises(ValueError):
+            pool.map(['a'], fail)
+
+    def test_hedging(self) -> None:
+        pool = DownloadPool()
+        pool.MIN_HEDGE_DELAY = 0.1
+        # establish a latency estimate
+        _ = pool.map(list(range(pool.MIN_LATENCY_SAMPLES)), lambda i: i)
+        discarded = []
+
+        def fetch(i: int) -> str:
+            if i == 0:
+                # straggler
+                time.sleep(2.0)
+            return 'primary'
+
+        start = time.time()
+        results, stats = pool.map(
+            list(range(10)), fetch, hedge_fn=lambda i: 'hedge', discard_fn=lambda r: discarded.append(r))
+        assert time.time() - start < 1.5
+        assert results[0] == 'hedge' and results[1:] == ['primary'] * 9
+        assert stats.num_hedged == 1
+        # the primary attempt finishes later and gets discarded
+        time.sleep(2.0)
+        assert discarded == ['primary']
+
+    def test_cancel(self) -> None:
+        pool = DownloadPool()
+        pool.concurrency = pool.MIN_CONCURRENCY
+        cancel = threading.Event()
+        started = []
+        discarded = []
+
+        def fetch(i: int) -> int:
+            started.append(i)
+            if i == 0:
+                cancel.set()
+            time.sleep(0.1)
+            return i
+
+        start = time.time()
+        with pytest.raises(DownloadCancelled):
+            pool.map(list(range(100)), fetch, discard_fn=lambda r: discarded.append(r), cancel=cancel)
+        # the downloads in progress complete, the remaining ones don't start
+        assert time.time() - start < 1.0
+        assert len(started) <= pool.MIN_CONCURRENCY
+        assert sorted(discarded) == sorted(started)
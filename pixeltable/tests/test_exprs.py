@@ -1,6 +1,7 @@
 from typing import List
 import urllib.parse
 
+import numpy as np
 import sqlalchemy as sql
 import pytest
 
@@ -14,7 +15,8 @@ from pixeltable.functions.pil.image import blend
 from pixeltable import exceptions as exc
 from pixeltable import exprs
 from pixeltable.function import FunctionRegistry
-from pixeltable.tests.utils import get_image_files
+from pixeltable.tests.utils import get_image_files, read_data_file
+from pixeltable.utils.embedded_index import EmbeddedIndex
 
 
 class TestExprs:
@@ -429,6 +431,50 @@ class TestExprs:
             _ = t[t.img.nearest(5)].show()
         assert 'requires' in str(exc_info.value)
 
+    def test_embedded_index(self, test_client: pt.Client, monkeypatch) -> None:
+        # index files are only written by EmbeddedIndex.flush()
+        monkeypatch.setattr(EmbeddedIndex, 'SAVE_INTERVAL', 3600.0)
+        cl = test_client
+        cols = [
+            catalog.Column('img', ImageType(nullable=False), indexed=True, index_params={'embedded': True}),
+            catalog.Column('category', StringType(nullable=False)),
+            catalog.Column('split', StringType(nullable=False)),
+        ]
+        t = cl.create_table('test_embedded_index', cols)
+        rows, col_names = read_data_file('imagenette2-160', 'manifest.csv', ['img'])
+        rng = np.random.default_rng(17)
+        rows = [rows[i] for i in rng.choice(np.arange(len(rows)), size=40, replace=False)]
+        t.insert(rows[:30], columns=col_names)
+        probe = t[t.img, t.img.localpath].show(1)
+        img, path = probe[0, 0], probe[0, 1]
+
+        # the embedded index returns the same neighbors as pgvector, which is used for queries with a Python filter
+        result = t[t.img.nearest(img)][t.img.localpath].show(5)
+        assert len(result) == 5 and result[0, 0] == path
+        pgvector_result = t[t.img.nearest(img) & (t.img.width > 0)][t.img.localpath].show(5)
+        assert [result[i, 0] for i in range(5)] == [pgvector_result[i, 0] for i in range(5)]
+
+        # the index is maintained on insert and delete
+        t.insert(rows[30:40], columns=col_names)
+        new_img = t[t.img].where(t.img.localpath == rows[35][0]).show(1)[0, 0]
+        assert t[t.img.nearest(new_img)][t.img.localpath].show(1)[0, 0] == rows[35][0]
+        t.delete(t.category == rows[35][1])
+        result = t[t.img.nearest(new_img)][t.category].show(5)
+        assert len(result) > 0 and all(result[i, 0] != rows[35][1] for i in range(len(result)))
+
+        # the file of the preceding version is kept, and revert() loads it
+        img_col = t.tbl_version.cols_by_name['img']
+        EmbeddedIndex.flush()
+        saved_version = t.tbl_version.version
+        t.insert(rows[35:36], columns=col_names)
+        assert [v for _, v in EmbeddedIndex._files(t.tbl_version.id, img_col.id)] == [saved_version]
+        EmbeddedIndex.flush()
+        assert [v for _, v in EmbeddedIndex._files(t.tbl_version.id, img_col.id)] == [saved_version + 1, saved_version]
+        t.revert()
+        assert EmbeddedIndex.get(t.tbl_version, img_col).version == saved_version
+        assert [v for _, v in EmbeddedIndex._files(t.tbl_version.id, img_col.id)] == [saved_version]
+        assert t[t.img.nearest(new_img)][t.img.localpath].show(1)[0, 0] != rows[35][0]
+
     # TODO: this doesn't work when combined with test_similarity(), for some reason the data table for img_tbl
     # doesn't get created; why?
     def test_similarity2(self, img_tbl: catalog.Table) -> None:
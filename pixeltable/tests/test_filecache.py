@@ -0,0 +1,215 @@
+import multiprocessing
+import time
+import uuid
+from pathlib import Path
+from typing import Tuple, Optional
+
+from pixeltable.env import Env
+from pixeltable.utils.filecache import FileCache, Validators
+
+
+class TestFileCache:
+    def _make_file(self, size: int) -> Path:
+        path = Env.get().tmp_dir / uuid.uuid4().hex
+        with open(path, 'wb') as f:
+            f.write(b'x' * size)
+        return path
+
+    def test_eviction(self, init_env) -> None:
+        cache = FileCache.get()
+        cache.clear(capacity=1000)
+        tbl_id = uuid.uuid4()
+        for i in range(4):
+            cache.add(tbl_id, 0, f'url{i}', self._make_file(300))
+        # url0 got evicted
+        assert cache.num_files(tbl_id) == 3
+        assert cache.stats().num_evictions == 1
+        assert cache.lookup('url0') is None
+        assert cache.lookup('url1') is not None
+        # url1 was accessed more recently than url2
+        cache.add(tbl_id, 0, 'url4', self._make_file(300))
+        assert cache.lookup('url2') is None
+        assert cache.lookup('url1') is not None
+        col_stats = cache.stats().util
+        assert len(col_stats) == 1 and col_stats[0].num_evictions == 2
+
+        # a query whose working set exceeds the capacity doesn't evict its own entries
+        query_ts = time.time()
+        cache.clear(capacity=1000)
+        paths = [cache.add(tbl_id, 0, f'url{i}', self._make_file(300), query_ts=query_ts) for i in range(4)]
+        assert cache.num_files(tbl_id) == 3
+        assert cache.stats().num_evictions == 0
+        # the last file wasn't admitted
+        assert paths[3].parent == Env.get().tmp_dir
+        paths[3].unlink()
+
+        # files that exceed the capacity aren't admitted
+        path = self._make_file(1001)
+        assert cache.add(tbl_id, 0, 'url5', path) == path
+        path.unlink()
+        cache.clear()
+
+    def test_quota_and_pinning(self, init_env) -> None:
+        cache = FileCache.get()
+        cache.clear(capacity=1000)
+        tbl1, tbl2 = uuid.uuid4(), uuid.uuid4()
+        cache.set_quota(tbl1, 600)
+        cache.add(tbl2, 0, 'url0', self._make_file(300))
+        for i in range(1, 4):
+            cache.add(tbl1, 0, f'url{i}', self._make_file(300))
+        # tbl1 is limited by its quota and only evicts its own entries
+        assert cache.num_files(tbl1) == 2
+        assert cache.num_files(tbl2) == 1
+        cache.set_quota(tbl1, None)
+
+        # pinned entries are skipped
+        cache.pin(tbl2)
+        cache.add(tbl1, 0, 'url4', self._make_file(300))
+        cache.add(tbl1, 0, 'url5', self._make_file(300))
+        assert cache.lookup('url0') is not None
+        assert cache.num_files(tbl1) == 2
+        cache.unpin(tbl2)
+        cache.clear()
+
+    def test_persistence(self, init_env) -> None:
+        cache = FileCache.get()
+        cache.clear(capacity=1000)
+        tbl_id = uuid.uuid4()
+        for i in range(3):
+            cache.add(tbl_id, 0, f'url{i}', self._make_file(100))
+        _ = cache.lookup('url0')
+        cache.flush()
+
+        # a new instance starts from the index, with the same LRU order
+        FileCache._instance = None
+        cache = FileCache.get()
+        cache.reconcile_thread.join()
+        assert cache.num_files(tbl_id) == 3
+        assert [e.key for e in cache.cache.values()] == [cache._url_hash(f'url{i}') for i in [1, 2, 0]]
+
+        # files that aren't in the index get added by reconciliation, entries without files get removed
+        path = cache.add(tbl_id, 1, 'url3', self._make_file(100))
+        cache.index.execute('DELETE FROM entries WHERE key = ?', (cache._url_hash('url3'),))
+        cache.lookup('url0').unlink()
+        FileCache._instance = None
+        cache = FileCache.get()
+        cache.reconcile_thread.join()
+        assert cache.num_files(tbl_id) == 3
+        assert cache.lookup('url0') is None
+        assert cache.lookup('url3') == path
+        assert cache.total_size == 300
+        cache.clear()
+
+    def test_lookup_batch(self, init_env) -> None:
+        cache = FileCache.get()
+        cache.clear(capacity=1000)
+        tbl_id = uuid.uuid4()
+        paths = [cache.add(tbl_id, 0, f'url{i}', self._make_file(100)) for i in range(3)]
+        result = cache.lookup_batch(['url2', 'url3', 'url0'])
+        assert result == [paths[2], None, paths[0]]
+        stats = cache.stats()
+        assert stats.num_requests == 3 and stats.num_hits == 2
+        # url1 is now the LRU entry
+        assert next(iter(cache.cache.values())).key == cache._url_hash('url1')
+
+        # access times are persisted with flush()
+        cache.flush()
+        FileCache._instance = None
+        cache = FileCache.get()
+        cache.reconcile_thread.join()
+        assert [e.key for e in cache.cache.values()] == [cache._url_hash(f'url{i}') for i in [1, 2, 0]]
+        cache.clear()
+
+    def test_replace(self, init_env) -> None:
+        cache = FileCache.get()
+        cache.clear(capacity=1000)
+        tbl_id = uuid.uuid4()
+        old_path = cache.add(tbl_id, 0, 'url0', self._make_file(100))
+        new_path, retired_path = cache.replace(tbl_id, 0, 'url0', self._make_file(200))
+        # the previous file stays in place until it's removed explicitly
+        assert retired_path == old_path and new_path != old_path
+        assert old_path.stat().st_size == 100 and new_path.stat().st_size == 200
+        assert cache.lookup('url0') == new_path
+        assert cache.total_size == 200
+
+        # another instance picks up the new generation, and reconciliation doesn't add the retired file back
+        cache.flush()
+        FileCache._instance = None
+        cache = FileCache.get()
+        cache.reconcile_thread.join()
+        assert cache.num_files(tbl_id) == 1
+        assert cache.lookup('url0') == new_path
+        cache.remove_retired([retired_path])
+        assert not old_path.exists()
+
+        # retired files that are left behind get removed by reconciliation
+        _, retired_path = cache.replace(tbl_id, 0, 'url0', self._make_file(100))
+        cache.index.execute('UPDATE retired SET ts = ?', (time.time() - FileCache.RETIRED_MAX_AGE - 1,))
+        cache.reconcile()
+        assert not retired_path.exists()
+        assert cache.num_files(tbl_id) == 1
+        cache.clear()
+
+    def test_sync(self, init_env, monkeypatch) -> None:
+        cache = FileCache.get()
+        cache.clear(capacity=100000)
+        tbl_id = uuid.uuid4()
+        monkeypatch.setattr(cache, 'MAX_LOG_SIZE', 10)
+        for i in range(30):
+            cache.add(tbl_id, 0, f'url{i}', self._make_file(10))
+        # the log is trimmed without any accesses
+        assert cache.index.execute('SELECT COUNT(*) FROM log').fetchone()[0] <= 10
+
+        # hits don't read the index, misses pick up the changes of other processes
+        num_syncs = 0
+        sync = cache._sync
+        def counting_sync() -> None:
+            nonlocal num_syncs
+            num_syncs += 1
+            sync()
+        monkeypatch.setattr(cache, '_sync', counting_sync)
+        assert cache.lookup_batch(['url0', 'url1']) == [cache.cache[cache._url_hash(f'url{i}')].path() for i in [0, 1]]
+        assert num_syncs == 0
+        assert cache.lookup('url30') is None
+        assert num_syncs == 1
+        cache.clear()
+
+    def test_multiprocess(self, init_env) -> None:
+        cache = FileCache.get()
+        cache.clear(capacity=1000)
+        cache.flush()
+        tbl_id = uuid.uuid4()
+        counter_path = Env.get().tmp_dir / uuid.uuid4().hex
+
+        def fetch(url: str) -> Tuple[Path, Optional[Validators]]:
+            with open(counter_path, 'a') as f:
+                f.write(f'{url}\n')
+            time.sleep(0.5)
+            return self._make_file(100), None
+
+        def run(q: multiprocessing.Queue) -> None:
+            FileCache._instance = None
+            child_cache = FileCache.get()
+            path, is_cached = child_cache.fetch(tbl_id, 0, 'url0', fetch)
+            q.put((str(path), is_cached, child_cache.total_size))
+
+        # all processes see the file, but only one of them fetches it
+        ctx = multiprocessing.get_context('fork')
+        q = ctx.Queue()
+        procs = [ctx.Process(target=run, args=(q,)) for _ in range(4)]
+        for p in procs:
+            p.start()
+        results = [q.get(timeout=60) for _ in procs]
+        for p in procs:
+            p.join()
+        with open(counter_path) as f:
+            assert f.read().splitlines() == ['url0']
+        counter_path.unlink()
+        assert len(set(results)) == 1
+        path, is_cached, total_size = results[0]
+        assert is_cached and total_size == 100
+
+        # the parent picks up the changes
+        assert cache.lookup('url0') == Path(path)
+        assert cache.total_size == 100
+        cache.clear()
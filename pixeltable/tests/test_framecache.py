@@ -0,0 +1,54 @@
+import numpy as np
+import PIL.Image
+
+from pixeltable.env import Env
+from pixeltable.tests.utils import get_video_files
+from pixeltable.utils.framecache import FrameCache
+
+
+class TestFrameCache:
+    def _make_frame(self, i: int) -> PIL.Image.Image:
+        return PIL.Image.fromarray(np.full((10, 10, 3), i, dtype=np.uint8))
+
+    def test_tiers(self, init_env, monkeypatch) -> None:
+        # room for 2 frames in memory and 3 on disk
+        monkeypatch.setattr(Env.get(), '_frame_cache_memory', 2 * 300)
+        monkeypatch.setattr(Env.get(), '_frame_cache_size', 3 * 500)
+        cache = FrameCache()
+        cache.clear()
+        video_key = cache.video_key(get_video_files()[0], 1)
+        keys = [cache.key(video_key, i) for i in range(6)]
+        for i, key in enumerate(keys):
+            cache.add(key, self._make_frame(i))
+        # evicted frames are written in the background
+        cache.flush()
+        assert len(cache.frames) == 2 and len(cache.files) == 3
+        # key 0 fell out of both tiers
+        assert cache.lookup(keys[0]) is None
+        # key 1 comes from disk, key 5 from memory
+        for i in [1, 5]:
+            img = cache.lookup(keys[i])
+            assert np.array_equal(np.asarray(img), np.asarray(self._make_frame(i)))
+        # cached frames can't be modified in place
+        assert not cache.frames[keys[1]][0].flags.writeable
+
+        # the disk tier is visible to a new cache instance
+        assert FrameCache().lookup(keys[3]) is not None
+        cache.clear()
+        assert FrameCache().lookup(keys[3]) is None
+
+    def test_spill(self, init_env, monkeypatch) -> None:
+        monkeypatch.setattr(Env.get(), '_frame_cache_memory', 2 * 300)
+        monkeypatch.setattr(Env.get(), '_frame_cache_size', 10 * 500)
+        cache = FrameCache()
+        cache.clear()
+        video_key = cache.video_key(get_video_files()[0], 1)
+        keys = [cache.key(video_key, i) for i in range(6)]
+        # only the even frames are worth writing to disk
+        for i, key in enumerate(keys):
+            cache.add(key, self._make_frame(i), spill=i % 2 == 0)
+        cache.flush()
+        assert len(cache.frames) == 2 and len(cache.files) == 2
+        assert cache.lookup(keys[0]) is not None and cache.lookup(keys[2]) is not None
+        assert cache.lookup(keys[1]) is None and cache.lookup(keys[3]) is None
+        cache.clear()
@@ -0,0 +1,107 @@
+import http.server
+import threading
+import uuid
+from typing import Dict, Iterator
+
+import numpy as np
+import PIL.Image
+import pytest
+
+from pixeltable.env import Env
+from pixeltable.tests.utils import get_video_files
+from pixeltable.utils import fetch, video
+from pixeltable.utils.filecache import Validators
+from pixeltable.utils.http import HttpClient
+
+CONTENT = bytes(range(256)) * 40
+ETAG = '"v1"'
+# key: path, value: content; paths starting with NO_RANGE_PREFIX ignore range requests
+FILES: Dict[str, bytes] = {'/media.bin': CONTENT}
+NO_RANGE_PREFIX = '/norange'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    """Serves FILES with an ETag and supports conditional and single-range requests"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        supports_ranges = not self.path.startswith(NO_RANGE_PREFIX)
+        content = FILES[self.path[len(NO_RANGE_PREFIX):] if not supports_ranges else self.path]
+        data, status = content, 200
+        range_header = self.headers.get('Range')
+        if range_header is not None and supports_ranges:
+            start, end = range_header[len('bytes='):].split('-')
+            data, status = content[int(start):int(end) + 1], 206
+        self.send_response(status)
+        self.send_header('ETag', ETAG)
+        if status == 206:
+            self.send_header('Content-Range', f'bytes {start}-{int(start) + len(data) - 1}/{len(content)}')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture(scope='module')
+def server_url() -> Iterator[str]:
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+
+
+class TestHttp:
+    def test_download(self, init_env, server_url: str) -> None:
+        client = HttpClient.get()
+        url = f'{server_url}/media.bin'
+        path = Env.get().tmp_dir / uuid.uuid4().hex
+        modified, validators = client.download(url, path)
+        assert modified and validators == Validators(ETAG, None)
+        assert path.read_bytes() == CONTENT
+        path.unlink()
+
+        # conditional request: nothing gets written
+        modified, _ = client.download(url, path, validators=validators)
+        assert not modified and not path.exists()
+        modified, _ = client.download(url, path, validators=Validators('"v0"', None))
+        assert modified and path.read_bytes() == CONTENT
+        path.unlink()
+
+    def test_read_range(self, server_url: str) -> None:
+        client = HttpClient.get()
+        assert client.read_range(f'{server_url}/media.bin', 1000, 100) == (CONTENT[1000:1100], len(CONTENT))
+        assert client.read_range(f'{server_url}/media.bin', 0, 1) == (CONTENT[:1], len(CONTENT))
+        # the server sends the entire resource
+        assert client.read_range(f'{server_url}{NO_RANGE_PREFIX}/media.bin', 1000, 100) == (CONTENT[1000:1100], None)
+
+    def test_probe_remote_video(self, init_env, server_url: str, tmp_path, monkeypatch) -> None:
+        src_path = get_video_files()[0]
+        # the headers of this mp4 file are at the end, after frames of noise that don't compress
+        mp4_path = tmp_path / 'video.mp4'
+        encoder = video.VideoEncoder(mp4_path, 10, (64, 48))
+        rng = np.random.default_rng(0)
+        for _ in range(30):
+            encoder.write(PIL.Image.fromarray(rng.integers(0, 256, (48, 64, 3), dtype=np.uint8)))
+        encoder.close()
+        assert mp4_path.stat().st_size > 8 * 4096
+        monkeypatch.setitem(FILES, '/video.webm', open(src_path, 'rb').read())
+        monkeypatch.setitem(FILES, '/video.mp4', mp4_path.read_bytes())
+        tmp_files = set(Env.get().tmp_dir.iterdir())
+        # only a small part of each file is read
+        monkeypatch.setattr(fetch, 'PROBE_HEAD_BYTES', 4096)
+        monkeypatch.setattr(fetch, 'PROBE_TAIL_BYTES', 4096)
+        assert fetch.probe_remote_video(f'{server_url}/video.webm') == video.probe(src_path)
+        assert fetch.probe_remote_video(f'{server_url}/video.mp4') == video.probe(str(mp4_path))
+        # without range requests, the video needs to be downloaded
+        assert fetch.probe_remote_video(f'{server_url}{NO_RANGE_PREFIX}/video.webm') is None
+        # the sparse copies are removed
+        assert set(Env.get().tmp_dir.iterdir()) == tmp_files
@@ -0,0 +1,66 @@
+import os
+import uuid
+
+import pytest
+
+from pixeltable.env import Env
+from pixeltable.utils import s3
+
+boto3 = pytest.importorskip('boto3')
+moto_server = pytest.importorskip('moto.server')
+
+
+@pytest.fixture(scope='module')
+def s3_endpoint(init_env) -> str:
+    # a local S3-compatible stand-in
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    server = moto_server.ThreadedMotoServer(ip_address='127.0.0.1', port=5127)
+    server.start()
+    endpoint_url = 'http://127.0.0.1:5127'
+    prev_endpoint_url = Env.get()._s3_endpoint_url
+    Env.get()._s3_endpoint_url = endpoint_url
+    yield endpoint_url
+    Env.get()._s3_endpoint_url = prev_endpoint_url
+    server.stop()
+
+
+class TestS3:
+    def test_transfer_config(self) -> None:
+        small = s3.transfer_config(100 * 1024 ** 2)
+        large = s3.transfer_config(10 * 1024 ** 3)
+        assert small.multipart_chunksize < large.multipart_chunksize
+        assert small.max_request_concurrency < large.max_request_concurrency
+
+    def test_download(self, s3_endpoint: str, monkeypatch) -> None:
+        client = s3.get_client()
+        assert client.meta.endpoint_url == s3_endpoint
+        client.create_bucket(Bucket='media')
+        small_data = os.urandom(1000)
+        large_data = os.urandom(3 * 1024 * 1024)
+        client.put_object(Bucket='media', Key='small.bin', Body=small_data)
+        client.put_object(Bucket='media', Key='large.bin', Body=large_data)
+        # force multipart downloads for the large object
+        monkeypatch.setattr(s3, 'SINGLE_GET_THRESHOLD', 1024 * 1024)
+        monkeypatch.setattr(s3, '_TRANSFER_TIERS', [(None, 1024 * 1024, 4)])
+
+        # the object size determines the download path before anything is transferred
+        calls = []
+        get_object, download_file = client.get_object, client.download_file
+        def counting_get_object(**kwargs) -> dict:
+            calls.append('get')
+            return get_object(**kwargs)
+        def counting_download_file(*args, **kwargs) -> None:
+            calls.append('multipart')
+            download_file(*args, **kwargs)
+        monkeypatch.setattr(client, 'get_object', counting_get_object)
+        monkeypatch.setattr(client, 'download_file', counting_download_file)
+
+        for key, data, expected_calls in [('small.bin', small_data, ['get']), ('large.bin', large_data, ['multipart'])]:
+            path = Env.get().tmp_dir / uuid.uuid4().hex
+            calls.clear()
+            s3.download(client, 'media', key, path)
+            assert path.read_bytes() == data
+            assert calls == expected_calls
+            path.unlink()
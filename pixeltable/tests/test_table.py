@@ -5,9 +5,12 @@ import pandas as pd
 import datetime
 import random
 import os
+import uuid
+from pathlib import Path
 
 import PIL
 import cv2
+import sqlalchemy as sql
 
 import pixeltable as pt
 from pixeltable import exceptions as exc
@@ -17,7 +20,9 @@ from pixeltable.type_system import \
 from pixeltable.tests.utils import make_tbl, create_table_data, read_data_file, get_video_files, assert_resultset_eq
 from pixeltable.functions import make_video, sum
 from pixeltable.utils.imgstore import ImageStore
+from pixeltable.utils.imgcodec import ImageCodec
 from pixeltable.utils.filecache import FileCache
+from pixeltable.env import Env
 
 
 class TestTable:
@@ -336,6 +341,80 @@ class TestTable:
                 'exc', cols, extract_frames_from='video', extracted_frame_col='frame',
                 extracted_frame_idx_col='breaks', extracted_fps=0)
 
+    def test_insert_chunked(self, test_client: pt.Client) -> None:
+        cl = test_client
+        t = cl.create_table('test', [catalog.Column('c1', IntType(nullable=False))])
+        version = t.tbl_version.version
+        t.insert([[i] for i in range(10)], chunk_size=4)
+        assert t.count() == 10
+        # one version per chunk
+        assert t.tbl_version.version == version + 3
+        assert sorted(row[0] for row in t.select(t.c1).show(0).rows) == list(range(10))
+
+        with pytest.raises(exc.Error) as exc_info:
+            t.insert([[1]], chunk_size=0)
+        assert 'chunk_size' in str(exc_info.value)
+
+    def test_insert_from(self, test_client: pt.Client, tmp_path) -> None:
+        pa = pytest.importorskip('pyarrow')
+        import pyarrow.parquet as pq
+        cl = test_client
+        cols = [
+            catalog.Column('c1', IntType(nullable=False)),
+            catalog.Column('c2', StringType(nullable=True)),
+            catalog.Column('c3', FloatType(nullable=True)),
+        ]
+        t = cl.create_table('test', cols)
+        df = pd.DataFrame({'c1': range(100), 'c2': [str(i) for i in range(100)], 'c3': [float(i) for i in range(100)]})
+        t.insert_from(([i, str(i), float(i)] for i in range(100)))
+        t.insert_from(df)
+        t.insert_from(pa.Table.from_pandas(df), columns=['c1', 'c2'])
+        df.to_parquet(tmp_path / 'data.parquet')
+        t.insert_from(tmp_path / 'data.parquet', chunk_size=30)
+        df.to_csv(tmp_path / 'data.csv', index=False)
+        t.insert_from(str(tmp_path / 'data.csv'))
+        assert t.count() == 500
+        assert t.where(t.c3 == None).count() == 100
+
+        with pytest.raises(exc.Error) as exc_info:
+            t.insert_from(pd.DataFrame({'c1': pd.Series([1, None], dtype='Int64')}))
+        assert 'non-nullable' in str(exc_info.value)
+        with pytest.raises(exc.Error) as exc_info:
+            t.insert_from(pd.DataFrame({'c1': [1], 'c4': [2]}))
+        assert 'Unknown' in str(exc_info.value)
+        with pytest.raises(exc.Error) as exc_info:
+            t.insert_from(iter([]))
+        assert 'empty' in str(exc_info.value)
+        assert t.count() == 500
+
+    def test_insert_from_failure(self, test_client: pt.Client, monkeypatch) -> None:
+        from pixeltable.plan import Planner
+        from pixeltable.utils import ingest
+        # small batches: the rows preceding the failure are inserted, and their images stored, before it occurs
+        monkeypatch.setattr(ingest, 'BATCH_SIZE', 4)
+        monkeypatch.setattr(Planner, 'INSERT_BATCH_SIZE', 4)
+        cl = test_client
+        t = cl.create_table('test', [catalog.Column('img', ImageType(nullable=False))])
+        t.add_column(catalog.Column('c1', computed_with=t.img.rotate(90), stored=True))
+        rows, _ = read_data_file('imagenette2-160', 'manifest.csv', ['img'])
+        paths = [r[0] for r in rows[:20]]
+
+        def failing_source():
+            for i, path in enumerate(paths):
+                if i == 14:
+                    raise RuntimeError('source failed')
+                yield [path]
+
+        for chunk_size in [None, 10]:
+            with pytest.raises(RuntimeError):
+                t.insert_from(failing_source(), columns=['img'], chunk_size=chunk_size)
+        # the first chunk of the chunked insert was committed; the failed versions left no images behind
+        assert t.count() == 10
+        assert ImageStore.count(t.id) == t.count()
+        t.insert_from(([path] for path in paths), columns=['img'], chunk_size=10)
+        assert t.count() == 30
+        assert ImageStore.count(t.id) == t.count()
+
     def test_insert(self, test_client: pt.Client) -> None:
         cl = test_client
         c1 = catalog.Column('c1', StringType(nullable=False))
@@ -720,6 +799,176 @@ class TestTable:
         t.insert([[r[0]] for r in rows[:20]], columns=['img'])
         _ = t[t.c3.errortype].show(0)
 
+    def test_vector_index(self, test_client: pt.Client) -> None:
+        cl = test_client
+        with pytest.raises(exc.Error):
+            _ = catalog.Column('c', ImageType(), index_params={'type': 'hnsw'})
+        with pytest.raises(exc.Error):
+            _ = catalog.Column('c', ImageType(), indexed=True, index_params={'type': 'btree'})
+        with pytest.raises(exc.Error):
+            _ = catalog.Column('c', ImageType(), indexed=True, index_params={'metric': 'hamming'})
+        with pytest.raises(exc.Error):
+            # lists only applies to ivfflat
+            _ = catalog.Column('c', ImageType(), indexed=True, index_params={'type': 'hnsw', 'lists': 10})
+
+        index_params = {'metric': 'cosine', 'm': 8, 'ef_search': 100}
+        t = cl.create_table(
+            'test', [catalog.Column('img', ImageType(nullable=False), indexed=True, index_params=index_params)])
+        t.add_column(catalog.Column(
+            'c2', computed_with=t.img.rotate(90), stored=True, indexed=True,
+            index_params={'type': 'ivfflat', 'lists': 4}))
+        store_tbl = t.tbl_version.store_tbl
+        # the ivfflat index isn't trained on an empty table; it's built by the first insert
+        assert not sql.inspect(Env.get().engine).has_index(
+            store_tbl.sa_tbl.name, store_tbl._index_name(t.tbl_version.cols_by_name['c2']))
+        rows, _ = read_data_file('imagenette2-160', 'manifest.csv', ['img'])
+        t.insert([[r[0]] for r in rows[:10]], columns=['img'])
+        indexes = {idx['name']: idx for idx in sql.inspect(Env.get().engine).get_indexes(store_tbl.sa_tbl.name)}
+        for col, ops in [(t.tbl_version.cols_by_name['img'], 'vector_cosine_ops'),
+                         (t.tbl_version.cols_by_name['c2'], 'vector_l2_ops')]:
+            idx = indexes[store_tbl._index_name(col)]
+            assert idx['column_names'] == [col.index_storage_name()]
+            assert idx['dialect_options']['postgresql_ops'] == {col.index_storage_name(): ops}
+
+        # the index parameters are persisted
+        cl = pt.Client()
+        t = cl.get_table('test')
+        assert t.tbl_version.cols_by_name['img'].index.as_dict() == {'type': 'hnsw', **index_params}
+
+    def test_img_codec(self, test_client: pt.Client) -> None:
+        cl = test_client
+        with pytest.raises(exc.Error):
+            _ = catalog.Column('c', IntType(), img_format='png')
+        with pytest.raises(exc.Error):
+            _ = catalog.Column('c', ImageType(), img_format='gif')
+        with pytest.raises(exc.Error):
+            _ = catalog.Column('c', ImageType(), img_format='png', img_quality=90)
+
+        t = cl.create_table('test', [catalog.Column('img', ImageType(nullable=False))])
+        t.add_column(catalog.Column('c1', computed_with=t.img.rotate(90), stored=True, img_format='npy'))
+        t.add_column(
+            catalog.Column('c2', computed_with=t.img.rotate(90), stored=True, img_format='webp', img_quality=50))
+        rows, _ = read_data_file('imagenette2-160', 'manifest.csv', ['img'])
+        # source files are only copied into columns of the same format
+        with PIL.Image.open(rows[0][0]) as img:
+            assert ImageCodec().can_copy_source(img) and ImageCodec('jpeg').can_copy_source(img)
+            assert not ImageCodec('npy').can_copy_source(img) and not ImageCodec('png').can_copy_source(img)
+        t.insert([[r[0]] for r in rows[:10]], columns=['img'])
+        assert ImageStore.count(t.id) == t.count() * 2
+        result = t[t.img.rotate(90), t.c1, t.c1.localpath, t.c2].show(0)
+        for row in result.rows:
+            # npy is lossless
+            assert np.array_equal(np.asarray(row[0]), np.asarray(row[1]))
+            assert row[2].endswith('.npy')
+            assert row[3].size == row[0].size
+
+        # the codec survives a catalog reload
+        cl = pt.Client()
+        t = cl.get_table('test')
+        assert t.c2.col.img_codec.format == 'webp' and t.c2.col.img_codec.quality == 50
+
+    def test_img_dedup(self, test_client: pt.Client) -> None:
+        cl = test_client
+        objects_dir = ImageStore._objects_dir()
+        def num_objects_in_store() -> int:
+            return sum(len(files) for _, _, files in os.walk(objects_dir))
+        num_prev_objects = num_objects_in_store()
+        t = cl.create_table('test', [catalog.Column('img', ImageType(nullable=False))])
+        # c1 and c2 contain identical images
+        t.add_column(catalog.Column('c1', computed_with=t.img.rotate(90), stored=True))
+        t.add_column(catalog.Column('c2', computed_with=t.img.rotate(90), stored=True))
+        rows, _ = read_data_file('imagenette2-160', 'manifest.csv', ['img'])
+        t.insert([[r[0]] for r in rows[:10]], columns=['img'])
+        assert ImageStore.count(t.id) == t.count() * 2
+        num_objects = num_objects_in_store()
+        # each image is stored only once
+        assert num_objects - num_prev_objects <= t.count()
+
+        # the same images in another version don't take up additional space
+        t.insert([[r[0]] for r in rows[:10]], columns=['img'])
+        assert ImageStore.count(t.id) == t.count() * 2
+        assert num_objects_in_store() == num_objects
+        t.revert()
+        assert ImageStore.count(t.id) == t.count() * 2
+        assert num_objects_in_store() == num_objects
+
+        # the last reference to an image removes the image
+        cl.drop_table('test')
+        assert ImageStore.count(t.id) == 0
+        assert num_objects_in_store() == num_prev_objects
+
+    def test_img_legacy_layout(self, test_client: pt.Client) -> None:
+        cl = test_client
+        t = cl.create_table('test', [catalog.Column('img', ImageType(nullable=False))])
+        img_dir = Env.get().img_dir
+        # images from before content addressing, as left behind by an earlier release
+        (img_dir / f'{t.id.hex}_1_0_{uuid.uuid4().hex}').write_bytes(b'x' * 10)
+        (img_dir / f'{t.id.hex}_1_1_{uuid.uuid4().hex}').write_bytes(b'y' * 20)
+        ImageStore.scan_legacy_layout()
+        assert not (img_dir / ImageStore.NO_LEGACY_MARKER).exists()
+        assert ImageStore.count(t.id) == 2
+        assert (t.id, 1, 2, 30) in ImageStore.stats()
+
+        ImageStore.delete(t.id, version=1)
+        assert ImageStore.count(t.id) == 1
+        cl.drop_table('test')
+        assert ImageStore.count(t.id) == 0
+        # the last legacy image is gone: later processes don't scan img_dir
+        assert (img_dir / ImageStore.NO_LEGACY_MARKER).exists()
+
+    def test_img_store_add(self, init_env, monkeypatch) -> None:
+        tbl_id = uuid.uuid4()
+        link = os.link
+
+        def write_tmp(data: bytes) -> str:
+            path = ImageStore.get_path(tbl_id, 1, 0).with_suffix('.npy')
+            path.write_bytes(data)
+            return str(path)
+
+        # without hardlinks, objects and references are copies
+        def failing_link(src, dst) -> None:
+            raise PermissionError(f'no links: {dst}')
+        monkeypatch.setattr(os, 'link', failing_link)
+        ref_path = ImageStore.add(tbl_id, 1, 0, write_tmp(b'x' * 10))
+        assert ref_path.read_bytes() == b'x' * 10
+        monkeypatch.setattr(os, 'link', link)
+
+        # the object disappears before the reference is linked to it: it's re-created
+        obj_path = ImageStore._obj_path(ImageStore._content_hash(str(ref_path)), '.npy')
+        def vanishing_link(src, dst) -> None:
+            if Path(src) == obj_path:
+                os.remove(obj_path)
+                monkeypatch.setattr(os, 'link', link)
+            link(src, dst)
+        monkeypatch.setattr(os, 'link', vanishing_link)
+        ref_path = ImageStore.add(tbl_id, 1, 0, write_tmp(b'x' * 10))
+        assert ref_path.read_bytes() == b'x' * 10 and obj_path.exists()
+        assert ImageStore.count(tbl_id) == 2
+        ImageStore.delete(tbl_id)
+
+    def test_img_packed(self, test_client: pt.Client) -> None:
+        cl = test_client
+        with pytest.raises(exc.Error):
+            _ = catalog.Column('c', IntType(), img_packed=True)
+        t = cl.create_table('test', [catalog.Column('img', ImageType(nullable=False))])
+        t.add_column(catalog.Column('c1', computed_with=t.img.resize((32, 32)), stored=True, img_packed=True))
+        rows, _ = read_data_file('imagenette2-160', 'manifest.csv', ['img'])
+        t.insert([[r[0]] for r in rows[:20]], columns=['img'])
+        assert ImageStore.count(t.id) == t.count()
+        result = t[t.c1, t.c1.fileurl, t.c1.localpath].show(0)
+        for row in result.rows:
+            assert row[0].size == (32, 32)
+            # the url references a range within a segment file
+            assert '#' in row[1]
+            # the local path is a file with just that image
+            with PIL.Image.open(row[2]) as img:
+                assert np.array_equal(np.asarray(img), np.asarray(row[0]))
+        t.insert([[r[0]] for r in rows[:20]], columns=['img'])
+        assert ImageStore.count(t.id) == t.count()
+        t.revert()
+        assert ImageStore.count(t.id) == t.count()
+        _ = t[t.c1].show(0)
+
     def test_computed_window_fn(self, test_client: pt.Client, test_tbl: catalog.Table) -> None:
         cl = test_client
         t = test_tbl
@@ -1,6 +1,12 @@
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
+import uuid
+import shutil
+import threading
+import time
 import pytest
 import PIL
+import numpy as np
+import cv2
 
 import pixeltable as pt
 from pixeltable.type_system import VideoType, IntType, ImageType
@@ -8,6 +14,10 @@ from pixeltable.tests.utils import get_video_files
 from pixeltable import catalog
 from pixeltable import exceptions as exc
 from pixeltable.utils.imgstore import ImageStore
+from pixeltable.utils.video import FrameIterator, KeyframeIndex, DecoderPool, VideoEncoder, count_frames, \
+    get_frame_positions, EXTRACT_KEYFRAMES, EXTRACT_SCENES, DecoderConfig
+from pixeltable.utils.framecache import FrameCache
+from pixeltable.plan import Planner
 
 
 class TestVideo:
@@ -67,6 +77,293 @@ class TestVideo:
         snap = cl.get_table('snap')
         _ = snap[snap.frame].show(10)
 
+    def test_video_md(self, test_client: pt.Client) -> None:
+        video_filepaths = get_video_files()
+        cl = test_client
+        t = cl.create_table('test', [catalog.Column('video', VideoType()), catalog.Column('c', IntType())])
+        t.insert([[p, i] for i, p in enumerate(video_filepaths)], columns=['video', 'c'])
+        res = t[t.video.duration, t.video.fps, t.video.width, t.video.num_frames, t.video.codec].show(0).to_pandas()
+        assert (res['video.duration'] > 0).all() and (res['video.num_frames'] > 0).all()
+        # filters on video metadata are evaluated in SQL
+        from pixeltable.plan import Planner
+        assert Planner.get_info(t.tbl_version, t.video.width >= 16).filter is None
+        assert t[t.video.width >= 16].count() == len(video_filepaths)
+        # the metadata survives updates
+        t.update({'c': -1})
+        assert t[t.video.bitrate != None].count() == len(video_filepaths)
+        with pytest.raises(exc.Error):
+            _ = t.c.duration
+
+    def test_frame_iterator(self, monkeypatch) -> None:
+        video_filepath = get_video_files()[0]
+        # make sure that the sampled frames are skipped over by seeking as well as by grabbing
+        for seek_threshold in [FrameIterator.SEEK_THRESHOLD, 5]:
+            monkeypatch.setattr(FrameIterator, 'SEEK_THRESHOLD', seek_threshold)
+            with FrameIterator(video_filepath, fps=1) as frames, FrameIterator(video_filepath) as all_frames:
+                num_frames = 0
+                for frame_idx, img in frames:
+                    all_frames.seek(frame_idx * frames.frame_freq)
+                    _, expected_img = next(all_frames)
+                    assert np.array_equal(np.asarray(img), np.asarray(expected_img))
+                    num_frames += 1
+                assert num_frames == len(frames) == count_frames(video_filepath, fps=1)
+
+    def test_keyframe_index(self, init_env) -> None:
+        pytest.importorskip('av')
+        video_filepath = get_video_files()[0]
+        tbl_id = uuid.uuid4()
+        keyframes = KeyframeIndex.get(tbl_id, video_filepath)
+        assert keyframes is not None and keyframes[0] == 0 and keyframes == sorted(keyframes)
+        # the index is persisted
+        KeyframeIndex._cache.clear()
+        assert KeyframeIndex.get(tbl_id, video_filepath) == keyframes
+        KeyframeIndex.delete(tbl_id)
+
+        # random access with the keyframe index returns the same frames
+        with FrameIterator(video_filepath) as frames, FrameIterator(video_filepath, keyframes=keyframes) as kf_frames:
+            for frame_idx in [keyframes[-1] + 1, 10, keyframes[1], keyframes[1] - 1, 11]:
+                frames.seek(frame_idx)
+                kf_frames.seek(frame_idx)
+                assert np.array_equal(np.asarray(next(frames)[1]), np.asarray(next(kf_frames)[1]))
+
+    def test_extraction_modes(self, init_env) -> None:
+        pytest.importorskip('av')
+        video_filepath = get_video_files()[0]
+        tbl_id = uuid.uuid4()
+        keyframes = get_frame_positions(video_filepath, EXTRACT_KEYFRAMES, tbl_id)
+        scenes = get_frame_positions(video_filepath, EXTRACT_SCENES, tbl_id)
+        assert scenes[0] == 0 and scenes == sorted(scenes)
+        # the cuts of the test video coincide with its keyframes
+        assert set(scenes) <= set(keyframes)
+        # both are persisted in the same index
+        KeyframeIndex._cache.clear()
+        assert KeyframeIndex.get_scenes(tbl_id, video_filepath) == scenes
+        assert count_frames(video_filepath, mode=EXTRACT_SCENES, tbl_id=tbl_id) == len(scenes)
+
+        pool = DecoderPool()
+        frames = pool.acquire(video_filepath, tbl_id=tbl_id, mode=EXTRACT_KEYFRAMES)
+        with FrameIterator(video_filepath) as all_frames:
+            num_frames = 0
+            for frame_idx, img in frames:
+                all_frames.seek(keyframes[frame_idx])
+                assert np.array_equal(np.asarray(img), np.asarray(next(all_frames)[1]))
+                num_frames += 1
+            assert num_frames == len(keyframes)
+        pool.clear()
+        KeyframeIndex.delete(tbl_id)
+
+    def test_decoder_backends(self, init_env) -> None:
+        pytest.importorskip('av')
+        video_filepath = get_video_files()[0]
+        pyav = DecoderConfig.from_dict({'backend': 'pyav', 'thread_type': 'FRAME', 'thread_count': 2})
+        with FrameIterator(video_filepath, fps=1) as cv_frames, \
+                FrameIterator(video_filepath, fps=1, decoder=pyav) as av_frames:
+            # seeking lands on the same frames
+            for frame_idx in [5, 14, 3, 0]:
+                cv_frames.seek(frame_idx)
+                av_frames.seek(frame_idx)
+                assert np.array_equal(np.asarray(next(cv_frames)[1]), np.asarray(next(av_frames)[1]))
+            for (cv_idx, cv_img), (av_idx, av_img) in zip(cv_frames, av_frames):
+                assert cv_idx == av_idx
+                assert np.array_equal(np.asarray(cv_img), np.asarray(av_img))
+
+        for backend in DecoderConfig.BACKENDS:
+            decoder = DecoderConfig.from_dict({'backend': backend, 'size': [320, 180]})
+            with FrameIterator(video_filepath, fps=1, decoder=decoder) as frames:
+                _, img = next(frames)
+                assert img.size == (320, 180)
+
+        with pytest.raises(exc.Error):
+            DecoderConfig.from_dict({'backend': 'gstreamer'})
+        with pytest.raises(exc.Error):
+            DecoderConfig.from_dict({'backend': 'pyav', 'thread_type': 'GPU'})
+
+    def test_extraction_mode_tables(self, test_client: pt.Client) -> None:
+        pytest.importorskip('av')
+        video_filepaths = get_video_files()
+        cl = test_client
+        cols = [
+            catalog.Column('video', VideoType()),
+            catalog.Column('frame', ImageType()),
+            catalog.Column('frame_idx', IntType()),
+        ]
+        for mode in [EXTRACT_KEYFRAMES, EXTRACT_SCENES]:
+            t = cl.create_table(
+                f'test_{mode}', cols, extract_frames_from='video', extracted_frame_col='frame',
+                extracted_frame_idx_col='frame_idx', extraction_mode=mode)
+            t.insert([[p] for p in video_filepaths], columns=['video'])
+            for path in video_filepaths:
+                positions = get_frame_positions(path, mode, t.id)
+                result = t[t.video == path][t.frame_idx, t.frame].order_by(t.frame_idx).show(0)
+                assert [result[i, 0] for i in range(len(result))] == list(range(len(positions)))
+                # frame i is the video frame at positions[i]
+                with FrameIterator(path) as all_frames:
+                    for i in [0, len(positions) - 1]:
+                        all_frames.seek(positions[i])
+                        assert np.array_equal(np.asarray(result[i, 1]), np.asarray(next(all_frames)[1]))
+
+    def test_decoder_table(self, test_client: pt.Client) -> None:
+        pytest.importorskip('av')
+        video_filepaths = get_video_files()
+        cl = test_client
+        cols = [
+            catalog.Column('video', VideoType()),
+            catalog.Column('frame', ImageType()),
+            catalog.Column('frame_idx', IntType()),
+        ]
+        t = cl.create_table(
+            'test', cols, extract_frames_from='video', extracted_frame_col='frame',
+            extracted_frame_idx_col='frame_idx', extraction_mode='scenes',
+            decoder={'backend': 'pyav', 'thread_count': 2, 'size': (320, 180)})
+        t.insert([[p] for p in video_filepaths], columns=['video'])
+        assert t.count() == sum(count_frames(p, mode=EXTRACT_SCENES, tbl_id=t.id) for p in video_filepaths)
+
+        # frames are decoded with the table's decoder
+        result = t[t.frame].show(0)
+        assert len(result) == t.count()
+        assert all(result[i, 0].size == (320, 180) for i in range(len(result)))
+        # ... unless the query overrides it
+        result = t[t.frame].with_decoder(backend='opencv').show(0)
+        assert all(result[i, 0].size != (320, 180) for i in range(len(result)))
+
+        with pytest.raises(exc.Error):
+            _ = t[t.frame].with_decoder(backend='gstreamer')
+        with pytest.raises(exc.Error):
+            cl.create_table('test2', cols, decoder={'backend': 'pyav'})
+
+    def test_decoder_pool(self, init_env) -> None:
+        video_filepath = get_video_files()[0]
+        pool = DecoderPool()
+        frames = pool.acquire(video_filepath, fps=1)
+        _ = next(frames)
+        pool.release(frames)
+        # the open iterator is reused and continues where it left off
+        reused_frames = pool.acquire(video_filepath, fps=1)
+        assert reused_frames is frames and reused_frames.next_frame_idx == 1
+        other_frames = pool.acquire(video_filepath, fps=1)
+        assert other_frames is not frames
+        pool.release(frames)
+        pool.release(other_frames)
+        assert pool.num_open == 2
+        pool.clear()
+        assert pool.num_open == 0 and frames.video_reader is None
+
+    def test_decode_readahead(self, test_client: pt.Client, tmp_path, monkeypatch) -> None:
+        # copies of the test video under different paths are decoded independently
+        src_path = get_video_files()[0]
+        video_filepaths = [str(tmp_path / f'video{i}.webm') for i in range(3)]
+        for path in video_filepaths:
+            shutil.copy(src_path, path)
+        cl = test_client
+        cols = [
+            catalog.Column('video', VideoType()),
+            catalog.Column('frame', ImageType()),
+            catalog.Column('frame_idx', IntType()),
+        ]
+        t = cl.create_table(
+            'test', cols, extract_frames_from='video', extracted_frame_col='frame',
+            extracted_frame_idx_col='frame_idx', extracted_fps=2)
+        t.insert([[p] for p in video_filepaths], columns=['video'])
+
+        # decode every frame, and keep track of the videos that are being decoded at the same time
+        monkeypatch.setattr(FrameCache, 'lookup', lambda self, key: None)
+        lock = threading.Lock()
+        # key: id of the acquired FrameIterator, value: video path
+        active_videos: Dict[int, str] = {}
+        max_active_videos = 0
+        acquire, release = DecoderPool.acquire, DecoderPool.release
+        def acquire_frames(self, video_path: str, **kwargs) -> FrameIterator:
+            nonlocal max_active_videos
+            frames = acquire(self, video_path, **kwargs)
+            with lock:
+                active_videos[id(frames)] = video_path
+                max_active_videos = max(max_active_videos, len(set(active_videos.values())))
+            time.sleep(0.01)
+            return frames
+        def release_frames(self, frames: FrameIterator) -> None:
+            with lock:
+                del active_videos[id(frames)]
+            release(self, frames)
+        monkeypatch.setattr(DecoderPool, 'acquire', acquire_frames)
+        monkeypatch.setattr(DecoderPool, 'release', release_frames)
+
+        # batches of a single row: the frames of different videos are still decoded at the same time
+        select_list = [t.video, t.frame_idx, t.frame]
+        plan, select_list = Planner.create_query_plan(t.tbl_version, select_list)
+        plan.ctx.batch_size = 1
+        plan.open()
+        try:
+            result = [[row[e.slot_idx] for e in select_list] for batch in plan for row in batch]
+        finally:
+            plan.close()
+        assert max_active_videos > 1
+        # rows are returned in scan order, with the frames of their own video and frame idx
+        expected = t[t.video, t.frame_idx].show(0)
+        assert [row[:2] for row in result] == [[video, frame_idx] for video, frame_idx in expected]
+        ref_frames = [frame for _, frame in FrameIterator(src_path, fps=2)]
+        for _, frame_idx, frame in result:
+            assert np.array_equal(np.asarray(frame), np.asarray(ref_frames[frame_idx]))
+
+        # the decoded frames that are read ahead are limited by the memory budget
+        from pixeltable.exec import ExprEvalNode
+        from pixeltable.env import Env
+        monkeypatch.setattr(Env.get(), '_decode_readahead_bytes', ref_frames[0].width * ref_frames[0].height * 3)
+        max_queued_batches = 0
+        next_input_batch = ExprEvalNode._next_input_batch
+        def record_queue(self):
+            nonlocal max_queued_batches
+            batch = next_input_batch(self)
+            max_queued_batches = max(max_queued_batches, len(self.decode_queue))
+            return batch
+        monkeypatch.setattr(ExprEvalNode, '_next_input_batch', record_queue)
+        plan, select_list = Planner.create_query_plan(t.tbl_version, select_list)
+        plan.ctx.batch_size = 1
+        plan.open()
+        try:
+            result = [[row[e.slot_idx] for e in select_list] for batch in plan for row in batch]
+        finally:
+            plan.close()
+        assert len(result) == len(expected)
+        # only the batch after the returned one stays in flight
+        assert max_queued_batches == 1
+
+    def test_video_encoder(self, tmp_path) -> None:
+        path = tmp_path / 'out.mp4'
+        # odd dimensions
+        encoder = VideoEncoder(path, 2.5, (65, 49))
+        for i in range(10):
+            encoder.write(PIL.Image.new('RGB', (65, 49), color=(i * 20, 0, 0)))
+        encoder.close()
+        cap = cv2.VideoCapture(str(path))
+        assert cap.isOpened()
+        assert cap.get(cv2.CAP_PROP_FPS) == pytest.approx(2.5)
+        assert int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) == 10
+        cap.release()
+
+    def test_video_encoder_fallback(self, tmp_path, monkeypatch) -> None:
+        av = pytest.importorskip('av')
+        closed = []
+
+        class Container:
+            """A PyAV build without libx264"""
+            def add_stream(self, codec_name: str, rate: Any) -> None:
+                raise av.codec.codec.UnknownCodecError(codec_name)
+
+            def close(self) -> None:
+                closed.append(True)
+
+        monkeypatch.setattr(av, 'open', lambda *args, **kwargs: Container())
+        path = tmp_path / 'out.mp4'
+        encoder = VideoEncoder(path, 2.5, (64, 48))
+        assert encoder.container is None and closed == [True]
+        for i in range(10):
+            encoder.write(PIL.Image.new('RGB', (64, 48), color=(i * 20, 0, 0)))
+        encoder.close()
+        cap = cv2.VideoCapture(str(path))
+        assert cap.isOpened()
+        assert int(cap.get(cv2.CAP_PROP_FRAME_COUNT)) == 10
+        cap.release()
+
     def test_query(self, test_client: pt.client) -> None:
         video_filepaths = get_video_files()
         cl = test_client
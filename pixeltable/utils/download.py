@@ -0,0 +1,311 @@
+from __future__ import annotations
+from typing import Optional, List, Dict, Callable, TypeVar, Generic, Tuple
+from collections import deque, namedtuple
+import concurrent.futures
+import logging
+import random
+import socket
+import threading
+import time
+
+_logger = logging.getLogger('pixeltable')
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+def _http_status(e: Exception) -> Optional[int]:
+    try:
+        import requests
+        if isinstance(e, requests.HTTPError) and e.response is not None:
+            return e.response.status_code
+    except ImportError:
+        pass
+    return None
+
+
+def is_throttling_error(e: Exception) -> bool:
+    """Returns True if e signals that the service is overloaded (eg, S3 SlowDown, HTTP 429)"""
+    if _http_status(e) in (429, 503):
+        return True
+    try:
+        import botocore.exceptions
+        if isinstance(e, botocore.exceptions.ClientError):
+            code = str(e.response.get('Error', {}).get('Code', ''))
+            return code in ('SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', '503')
+    except ImportError:
+        pass
+    return False
+
+
+def is_retryable_error(e: Exception) -> bool:
+    """Returns True if a download that failed with e can succeed when retried"""
+    if is_throttling_error(e):
+        return True
+    if isinstance(e, (ConnectionError, TimeoutError, socket.timeout)):
+        return True
+    if _http_status(e) in (500, 502, 504):
+        return True
+    try:
+        import requests
+        if isinstance(e, (requests.ConnectionError, requests.Timeout)):
+            return True
+    except ImportError:
+        pass
+    try:
+        import botocore.exceptions
+        if isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.ReadTimeoutError)):
+            return True
+        if isinstance(e, botocore.exceptions.ClientError):
+            code = str(e.response.get('Error', {}).get('Code', ''))
+            return code in ('RequestTimeout', 'InternalError', '500')
+    except ImportError:
+        pass
+    return False
+
+
+class DownloadCancelled(Exception):
+    """Raised by DownloadPool.map() if the batch was cancelled"""
+    pass
+
+
+class _Request(Generic[T, R]):
+    """State of the download of a single item within a DownloadPool.map() call"""
+    def __init__(self, idx: int, item: T):
+        self.idx = idx
+        self.item = item
+        self.start_ts: Optional[float] = None
+        self.hedged = False
+        self.done = False
+        self.result: Optional[R] = None
+        self.exc: Optional[Exception] = None
+        # number of attempts (primary and hedged) that haven't finished yet
+        self.num_pending = 1
+
+
+class DownloadPool:
+    """
+    A long-lived pool of download threads, shared by all queries.
+
+    The number of concurrent downloads adapts to the observed behavior of the remote service (AIMD):
+    - it increases additively with every successful download (by ~1 per round of concurrent downloads)
+    - it decreases multiplicatively when the service signals throttling, or when the throughput of a batch drops
+      although the concurrency increased
+    Failed downloads are retried with exponential backoff (plus jitter) if the error is retryable.
+
+    Stragglers are hedged: once a download takes longer than HEDGE_FACTOR times the HEDGE_QUANTILE of recent
+    download latencies, a second attempt is started and the first one to finish wins.
+    """
+    _instance: Optional[DownloadPool] = None
+    BatchStats = namedtuple(
+        'DownloadBatchStats',
+        ['num_files', 'num_bytes', 'elapsed', 'throughput', 'num_retries', 'num_hedged', 'concurrency'])
+
+    MIN_CONCURRENCY = 2
+    MAX_CONCURRENCY = 64
+    INITIAL_CONCURRENCY = 16
+    DECREASE_FACTOR = 0.5
+    # a drop in batch throughput by more than this fraction counts as congestion
+    THROUGHPUT_TOLERANCE = 0.1
+
+    MAX_RETRIES = 5
+    BACKOFF_BASE = 0.1
+    BACKOFF_MAX = 10.0
+
+    HEDGE_QUANTILE = 0.95
+    HEDGE_FACTOR = 2.0
+    MIN_HEDGE_DELAY = 0.5
+    # we only hedge once we have a reasonable latency estimate
+    MIN_LATENCY_SAMPLES = 20
+    MAX_HEDGED_FRACTION = 0.1
+    MAX_HEDGES = 8
+
+    @classmethod
+    def get(cls) -> DownloadPool:
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        # primary attempts wait for a slot in their thread, which requires MAX_CONCURRENCY threads
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.MAX_CONCURRENCY, thread_name_prefix='pxt_download')
+        # hedged attempts don't queue up behind primary attempts
+        self.hedge_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.MAX_HEDGES, thread_name_prefix='pxt_hedge')
+        self.concurrency = float(self.INITIAL_CONCURRENCY)
+        self.num_active = 0
+        self.slot_available = threading.Condition()
+        self.last_decrease_ts = 0.0
+        self.latencies: deque = deque(maxlen=200)
+        # (concurrency, throughput) of the last batch
+        self.last_batch: Optional[Tuple[float, float]] = None
+
+    def _acquire_slot(self) -> None:
+        with self.slot_available:
+            while self.num_active >= int(self.concurrency):
+                self.slot_available.wait()
+            self.num_active += 1
+
+    def _release_slot(self, success: bool) -> None:
+        with self.slot_available:
+            self.num_active -= 1
+            if success:
+                # additive increase: ~1 per round of concurrent downloads
+                self.concurrency = min(self.MAX_CONCURRENCY, self.concurrency + 1.0 / self.concurrency)
+            self.slot_available.notify_all()
+
+    def _decrease(self, reason: str) -> None:
+        with self.slot_available:
+            # don't react more than once to the same congestion event
+            if time.time() - self.last_decrease_ts < self._latency_quantile(0.5, default=1.0):
+                return
+            self.concurrency = max(self.MIN_CONCURRENCY, self.concurrency * self.DECREASE_FACTOR)
+            self.last_decrease_ts = time.time()
+        _logger.debug(f'download pool: {reason}, reducing concurrency to {int(self.concurrency)}')
+
+    def _latency_quantile(self, q: float, default: Optional[float] = None) -> Optional[float]:
+        if len(self.latencies) == 0:
+            return default
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    def _hedge_delay(self) -> Optional[float]:
+        if len(self.latencies) < self.MIN_LATENCY_SAMPLES:
+            return None
+        return max(self.MIN_HEDGE_DELAY, self.HEDGE_FACTOR * self._latency_quantile(self.HEDGE_QUANTILE))
+
+    def _call(
+            self, fn: Callable[[T], R], item: T, retries: List[int], cancel: Optional[threading.Event] = None
+    ) -> R:
+        """Call fn(item), retrying retryable errors with exponential backoff"""
+        num_attempts = 0
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise DownloadCancelled()
+            try:
+                return fn(item)
+            except Exception as e:
+                if not is_retryable_error(e) or num_attempts >= self.MAX_RETRIES:
+                    raise
+                if is_throttling_error(e):
+                    self._decrease('throttled')
+                backoff = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** num_attempts)
+                num_attempts += 1
+                retries[0] += 1
+                _logger.debug(f'download pool: retrying {item} in {backoff:.2f}s after {e}')
+                time.sleep(backoff * random.uniform(0.5, 1.5))
+
+    def map(
+            self, items: List[T], fn: Callable[[T], R], hedge_fn: Optional[Callable[[T], R]] = None,
+            size_fn: Optional[Callable[[R], int]] = None, discard_fn: Optional[Callable[[R], None]] = None,
+            cancel: Optional[threading.Event] = None
+    ) -> Tuple[List[R], BatchStats]:
+        """Call fn() for all items concurrently and return the results (in the order of items) and the batch stats.
+
+        hedge_fn: used for hedged attempts (default: fn)
+        size_fn: returns the number of downloaded bytes for a result, for the throughput computation
+        discard_fn: called for the result of the losing attempt of a hedged request
+        cancel: once set, items that haven't started yet are skipped and the downloads in progress are waited for;
+            the results of the completed items are then passed to discard_fn and DownloadCancelled is raised
+        Raises the exception of the first item that failed after all retries.
+        """
+        if hedge_fn is None:
+            hedge_fn = fn
+        start_ts = time.time()
+        requests = [_Request(idx, item) for idx, item in enumerate(items)]
+        lock = threading.Lock()
+        retries = [0]
+        num_hedged = 0
+
+        def finish(request: _Request, result: Optional[R], exc: Optional[Exception]) -> None:
+            with lock:
+                request.num_pending -= 1
+                if request.done:
+                    # we lost the race
+                    if exc is None and discard_fn is not None:
+                        discard_fn(result)
+                    return
+                if exc is not None and request.num_pending > 0:
+                    # the other attempt might still succeed
+                    request.exc = exc
+                    return
+                request.done = True
+                request.result, request.exc = result, exc
+
+        def run_primary(request: _Request) -> None:
+            self._acquire_slot()
+            success = False
+            try:
+                request.start_ts = time.time()
+                result = self._call(fn, request.item, retries, cancel)
+                self.latencies.append(time.time() - request.start_ts)
+                success = True
+                finish(request, result, None)
+            except Exception as e:
+                finish(request, None, e)
+            finally:
+                self._release_slot(success)
+
+        def run_hedge(request: _Request) -> None:
+            try:
+                finish(request, self._call(hedge_fn, request.item, retries, cancel), None)
+            except Exception as e:
+                finish(request, None, e)
+
+        futures = {self.executor.submit(run_primary, r) for r in requests}
+        max_hedged = int(len(requests) * self.MAX_HEDGED_FRACTION)
+        while True:
+            hedge_delay = self._hedge_delay()
+            timeout = hedge_delay / 2 if hedge_delay is not None and num_hedged < max_hedged else None
+            done, not_done = concurrent.futures.wait(
+                futures, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+            futures = not_done
+            with lock:
+                if all(r.done for r in requests):
+                    break
+                pending = [r for r in requests if not r.done]
+            if len(futures) == 0 and all(r.num_pending == 0 for r in pending):
+                break
+            if hedge_delay is None or (cancel is not None and cancel.is_set()):
+                continue
+            now = time.time()
+            for r in pending:
+                if num_hedged >= max_hedged:
+                    break
+                if not r.hedged and r.start_ts is not None and now - r.start_ts > hedge_delay:
+                    r.hedged = True
+                    with lock:
+                        r.num_pending += 1
+                    num_hedged += 1
+                    futures.add(self.hedge_executor.submit(run_hedge, r))
+                    _logger.debug(f'download pool: hedging {r.item} after {now - r.start_ts:.2f}s')
+
+        if cancel is not None and cancel.is_set():
+            if discard_fn is not None:
+                for r in requests:
+                    if r.done and r.exc is None:
+                        discard_fn(r.result)
+            raise DownloadCancelled()
+        for r in requests:
+            if r.exc is not None:
+                raise r.exc
+        results = [r.result for r in requests]
+        elapsed = time.time() - start_ts
+        num_bytes = sum(size_fn(result) for result in results) if size_fn is not None else 0
+        throughput = num_bytes / elapsed if elapsed > 0 else 0.0
+        stats = self.BatchStats(
+            len(items), num_bytes, elapsed, throughput, retries[0], num_hedged, int(self.concurrency))
+        self._adapt(throughput)
+        return results, stats
+
+    def _adapt(self, throughput: float) -> None:
+        """Back off if higher concurrency reduced the throughput (ie, we're congesting the network)"""
+        if throughput == 0.0:
+            return
+        if self.last_batch is not None:
+            last_concurrency, last_throughput = self.last_batch
+            if self.concurrency > last_concurrency \
+                    and throughput < (1.0 - self.THROUGHPUT_TOLERANCE) * last_throughput:
+                self._decrease('throughput dropped')
+        self.last_batch = (self.concurrency, throughput)
@@ -0,0 +1,235 @@
+from __future__ import annotations
+from typing import Optional, Dict, List, Tuple
+from pathlib import Path
+from uuid import UUID
+import atexit
+import logging
+import os
+import shutil
+import threading
+import time
+
+import hnswlib
+import numpy as np
+import sqlalchemy as sql
+
+from pixeltable import catalog
+from pixeltable.env import Env
+from pixeltable.metadata import schema
+
+
+_logger = logging.getLogger('pixeltable')
+
+class EmbeddedIndex:
+    """
+    In-process HNSW index (hnswlib) of the embeddings of an indexed column with index_params embedded=True.
+
+    The index is labeled with rowids and covers the live rows of a table (views aren't supported). It is stored
+    in Env.index_dir/<table id>/<column id>_<version>.hnsw, where version is the table version it reflects. Saving
+    rewrites the entire file, so it happens lazily: once SAVE_ROWS rows were added or deleted, or SAVE_INTERVAL
+    seconds after the last save, and when the process exits. A new file replaces the older ones except for the
+    preceding one. An index that is behind the table (eg, because the process crashed before saving it, or because
+    another process inserted rows) catches up with the rows that were added and deleted in the meantime; an index
+    that is ahead of the table (after revert()) is replaced by the most recent file that isn't, which then catches up.
+
+    nearest() queries against the live table look up the rowids of the nearest neighbors here; the scan then
+    filters on those rowids.
+    """
+    FILE_SUFFIX = '.hnsw'
+    # the number of rowids that are looked up per requested row; entries of rows that were deleted by other
+    # processes are only removed when the index catches up
+    OVERSAMPLING = 2
+    # hnswlib defaults
+    DEFAULT_M = 16
+    DEFAULT_EF_CONSTRUCTION = 200
+    DEFAULT_EF_SEARCH = 10
+    _FETCH_SIZE = 10000
+    SAVE_ROWS = 100000
+    SAVE_INTERVAL = 60.0
+
+    # key: (tbl_id, col_id)
+    _instances: Dict[Tuple[UUID, int], EmbeddedIndex] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, tbl_id: UUID, col_id: int):
+        self.tbl_id = tbl_id
+        self.col_id = col_id
+        self.index: Optional[hnswlib.Index] = None
+        # the table version that self.index reflects; -1: nothing loaded
+        self.version = -1
+        # number of rows added or deleted since the last save
+        self.num_unsaved = 0
+        self.save_ts = time.time()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, tbl: catalog.TableVersion, col: catalog.Column) -> EmbeddedIndex:
+        """Returns the index of col, up to date with the current version of tbl"""
+        assert col.is_indexed and col.index.embedded and tbl.is_insertable()
+        key = (tbl.id, col.id)
+        with cls._lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(tbl.id, col.id)
+            result = cls._instances[key]
+        with result.lock:
+            result._sync(tbl, col)
+        return result
+
+    @classmethod
+    def flush(cls) -> None:
+        """Save all indexes with unsaved changes"""
+        with cls._lock:
+            instances = list(cls._instances.values())
+        for index in instances:
+            with index.lock:
+                if index.index is not None and index.num_unsaved > 0:
+                    index._save()
+
+    @classmethod
+    def delete(cls, tbl_id: UUID, col_id: Optional[int] = None) -> None:
+        """Delete the index of a column, or all indexes of a table"""
+        with cls._lock:
+            for key in [k for k in cls._instances if k[0] == tbl_id and (col_id is None or k[1] == col_id)]:
+                del cls._instances[key]
+        dir = cls._dir(tbl_id)
+        if col_id is None:
+            shutil.rmtree(dir, ignore_errors=True)
+        else:
+            for path, _ in cls._files(tbl_id, col_id):
+                os.remove(path)
+
+    @classmethod
+    def _dir(cls, tbl_id: UUID) -> Path:
+        return Env.get().index_dir / tbl_id.hex
+
+    @classmethod
+    def _files(cls, tbl_id: UUID, col_id: int) -> List[Tuple[Path, int]]:
+        """Returns the index files of the column as (path, version), most recent first"""
+        dir = cls._dir(tbl_id)
+        if not dir.exists():
+            return []
+        result: List[Tuple[Path, int]] = []
+        for path in dir.glob(f'{col_id}_*{cls.FILE_SUFFIX}'):
+            version = path.stem.split('_')[1]
+            if version.isdigit():
+                result.append((path, int(version)))
+        result.sort(key=lambda f: f[1], reverse=True)
+        return result
+
+    def _create_index(self, col: catalog.Column, max_elements: int) -> hnswlib.Index:
+        index = hnswlib.Index(space=col.index.metric, dim=col.sa_idx_col.type.dim)
+        index.init_index(
+            max_elements=max(max_elements, 1), M=col.index.params.get('m', self.DEFAULT_M),
+            ef_construction=col.index.params.get('ef_construction', self.DEFAULT_EF_CONSTRUCTION))
+        return index
+
+    def _load(self, tbl: catalog.TableVersion, col: catalog.Column) -> None:
+        """Load the most recent index file that doesn't reflect a later version than tbl's"""
+        for path, version in self._files(self.tbl_id, self.col_id):
+            if version > tbl.version:
+                # left behind by a revert()
+                os.remove(path)
+                continue
+            index = hnswlib.Index(space=col.index.metric, dim=col.sa_idx_col.type.dim)
+            try:
+                index.load_index(str(path))
+            except RuntimeError as e:
+                _logger.warning(f'Cannot load index {path}: {e}')
+                continue
+            self.index, self.version = index, version
+            self.num_unsaved, self.save_ts = 0, time.time()
+            return
+
+    def _sync(self, tbl: catalog.TableVersion, col: catalog.Column) -> None:
+        if self.version == tbl.version:
+            return
+        if self.version > tbl.version:
+            # revert(): unsaved changes are discarded along with the index
+            self.index, self.version, self.num_unsaved = None, -1, 0
+        if self.index is None:
+            self._load(tbl, col)
+            if self.version == tbl.version:
+                return
+
+        store_tbl = tbl.store_tbl
+        num_added, num_deleted = 0, 0
+        with Env.get().engine.connect() as conn:
+            # rows that were added since self.version and haven't been deleted
+            stmt = sql.select(store_tbl.rowid_col, col.sa_idx_col) \
+                .where(store_tbl.v_min_col > self.version) \
+                .where(store_tbl.v_min_col <= tbl.version) \
+                .where(store_tbl.v_max_col == schema.Table.MAX_VERSION) \
+                .where(col.sa_idx_col != None)
+            result = conn.execution_options(yield_per=self._FETCH_SIZE).execute(stmt)
+            for rows in result.partitions():
+                rowids = np.array([row[0] for row in rows], dtype=np.uint64)
+                embeddings = np.stack([row[1] for row in rows]).astype(np.float32)
+                self._add(col, rowids, embeddings)
+                num_added += len(rows)
+
+            if self.version >= 0:
+                # rows that were deleted since self.version; updated rows keep their rowid
+                live_rowids = sql.select(store_tbl.rowid_col).where(store_tbl.v_max_col == schema.Table.MAX_VERSION)
+                stmt = sql.select(store_tbl.rowid_col) \
+                    .where(store_tbl.v_max_col > self.version) \
+                    .where(store_tbl.v_max_col <= tbl.version) \
+                    .where(store_tbl.rowid_col.not_in(live_rowids))
+                for row in conn.execute(stmt):
+                    try:
+                        self.index.mark_deleted(row[0])
+                        num_deleted += 1
+                    except RuntimeError:
+                        # not in the index, or already deleted
+                        pass
+
+        if self.index is None:
+            self.index = self._create_index(col, 0)
+        self.version = tbl.version
+        self.num_unsaved += num_added + num_deleted
+        if self.num_unsaved >= self.SAVE_ROWS or time.time() - self.save_ts >= self.SAVE_INTERVAL:
+            self._save()
+        _logger.debug(
+            f'Embedded index of column {col.name}: added {num_added} rows, deleted {num_deleted} rows, '
+            f'now at version {self.version}')
+
+    def _add(self, col: catalog.Column, rowids: np.ndarray, embeddings: np.ndarray) -> None:
+        if self.index is None:
+            self.index = self._create_index(col, 2 * len(rowids))
+        required = self.index.element_count + len(rowids)
+        if required > self.index.get_max_elements():
+            self.index.resize_index(max(required, 2 * self.index.get_max_elements()))
+        self.index.add_items(embeddings, rowids)
+
+    def _save(self) -> None:
+        dir = self._dir(self.tbl_id)
+        dir.mkdir(parents=True, exist_ok=True)
+        path = dir / f'{self.col_id}_{self.version}{self.FILE_SUFFIX}'
+        tmp_path = path.with_suffix(f'.{os.getpid()}_{threading.get_ident()}.tmp')
+        self.index.save_index(str(tmp_path))
+        os.replace(tmp_path, path)
+        self.num_unsaved, self.save_ts = 0, time.time()
+        # the new file supersedes those of earlier versions, except for the preceding one, which a revert() of the
+        # current version can load
+        old_files = [f for f in self._files(self.tbl_id, self.col_id) if f[1] < self.version]
+        for old_path, _ in old_files[1:]:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+
+    def search(self, embedding: np.ndarray, k: int, ef_search: Optional[int] = None) -> List[int]:
+        """Returns the rowids of the (at most) k nearest neighbors of embedding, nearest first"""
+        with self.lock:
+            k = min(k, self.index.element_count)
+            self.index.set_ef(max(k, ef_search or self.DEFAULT_EF_SEARCH))
+            while k > 0:
+                try:
+                    labels, _ = self.index.knn_query(np.asarray(embedding, dtype=np.float32), k=k)
+                    return [int(label) for label in labels[0]]
+                except RuntimeError:
+                    # fewer than k entries that aren't deleted
+                    k //= 2
+            return []
+
+
+atexit.register(EmbeddedIndex.flush)
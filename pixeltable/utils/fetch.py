@@ -0,0 +1,133 @@
+from typing import Any, Optional, Tuple, List, Dict
+from pathlib import Path
+import logging
+import os
+import threading
+import urllib.parse
+import uuid
+from uuid import UUID
+
+import requests
+
+from pixeltable import exceptions as exc
+from pixeltable.env import Env
+from pixeltable.utils.download import DownloadPool
+from pixeltable.utils.filecache import FileCache, Validators
+from pixeltable.utils.http import HttpClient
+from pixeltable.utils import video
+
+_logger = logging.getLogger('pixeltable')
+
+# clients for specific services are constructed as needed, because it's time-consuming
+_boto_client: Optional[Any] = None
+_boto_client_lock = threading.Lock()
+
+# probe_remote_video() reads this much of the start and the end of a video: the container headers are at the start,
+# or at the end (eg, mp4 files that weren't written for streaming)
+PROBE_HEAD_BYTES = 2 * 1024 ** 2
+PROBE_TAIL_BYTES = 2 * 1024 ** 2
+
+
+def is_remote(url: str) -> bool:
+    scheme = urllib.parse.urlparse(url).scheme
+    return scheme != '' and scheme != 'file'
+
+
+def tmp_path(url: str) -> Path:
+    """Return a new path in Env.tmp_dir for downloading url"""
+    # the file may stay around for a while (if the cache doesn't admit it): avoid collisions with other downloads
+    return Env.get().tmp_dir / f'{uuid.uuid4().hex}_{os.path.basename(urllib.parse.urlparse(url).path)}'
+
+
+def fetch_url(url: str) -> Tuple[Path, Optional[Validators]]:
+    """Fetch a remote URL into Env.tmp_dir and return its path and the validators of the source
+
+    tmp_dir is on the same file system as the file cache, which can then admit the file without copying it.
+    """
+    global _boto_client
+    parsed = urllib.parse.urlparse(url)
+    assert is_remote(url)
+    path = tmp_path(url)
+    if parsed.scheme == 's3':
+        from pixeltable.utils import s3
+        with _boto_client_lock:
+            if _boto_client is None:
+                _boto_client = s3.get_client()
+        s3.download(_boto_client, parsed.netloc, parsed.path.lstrip('/'), path)
+        return path, None
+    if parsed.scheme == 'http' or parsed.scheme == 'https':
+        _, validators = HttpClient.get().download(url, path)
+        return path, validators
+    assert False, f'Unsupported URL scheme: {parsed.scheme}'
+
+
+def probe_remote_video(url: str) -> Optional[Dict[str, Any]]:
+    """Return the metadata of the video at an http(s) url (see video.probe()), without downloading it.
+
+    The start and the end of the video are read with range requests into a sparse local file, which is probed.
+    Returns None if that isn't possible (other url schemes, no support for range requests, or container headers that
+    aren't within the ranges that were read): the video then needs to be downloaded.
+    """
+    if urllib.parse.urlparse(url).scheme not in ('http', 'https'):
+        return None
+    client = HttpClient.get()
+    path = tmp_path(url)
+    try:
+        head, size = client.read_range(url, 0, PROBE_HEAD_BYTES)
+        if size is None:
+            return None
+        with open(path, 'wb') as f:
+            f.write(head)
+            if size > len(head):
+                tail_offset = max(len(head), size - PROBE_TAIL_BYTES)
+                tail, _ = client.read_range(url, tail_offset, size - tail_offset)
+                f.seek(tail_offset)
+                f.write(tail)
+                # the part in between stays a hole
+                f.truncate(size)
+        return video.probe(str(path))
+    except (requests.RequestException, exc.Error) as e:
+        _logger.debug(f'Failed to probe {url} with range requests: {e}')
+        return None
+    finally:
+        path.unlink(missing_ok=True)
+
+
+def fetch_into_cache(
+        tbl_id: UUID, urls: List[str], col_ids: List[int], query_ts: Optional[float] = None,
+        cancel: Optional[threading.Event] = None
+) -> Tuple[List[Tuple[Path, bool]], DownloadPool.BatchStats]:
+    """Download urls (which belong to columns col_ids of tbl_id) into the file cache, in parallel.
+
+    Returns (local path, is_cached) per url, and the download stats. Files with is_cached == False weren't admitted
+    to the cache and need to be removed by the caller once they're no longer needed.
+    If cancel is set during the downloads, the uncached files are removed and DownloadCancelled is raised.
+    """
+    file_cache = FileCache.get()
+    col_id_by_url = dict(zip(urls, col_ids))
+
+    # FileCache.fetch() makes sure that other processes sharing the cache don't download the same files
+    def fetch(url: str) -> Tuple[Path, bool]:
+        return file_cache.fetch(tbl_id, col_id_by_url[url], url, fetch_url, query_ts=query_ts)
+
+    def fetch_hedged(url: str) -> Tuple[Path, bool]:
+        # the primary attempt holds the fetch lock for url: bypass it; the cache admits only one of the two
+        path, validators = fetch_url(url)
+        local_path = file_cache.add(
+            tbl_id, col_id_by_url[url], url, path, query_ts=query_ts, validators=validators)
+        return local_path, local_path != path
+
+    def size(result: Tuple[Path, bool]) -> int:
+        try:
+            return os.stat(result[0]).st_size
+        except FileNotFoundError:
+            # evicted in the meantime
+            return 0
+
+    def discard(result: Tuple[Path, bool]) -> None:
+        local_path, is_cached = result
+        if not is_cached:
+            os.remove(local_path)
+
+    return DownloadPool.get().map(
+        urls, fetch, hedge_fn=fetch_hedged, size_fn=size, discard_fn=discard, cancel=cancel)
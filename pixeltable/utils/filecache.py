@@ -1,5 +1,5 @@
 from __future__ import annotations
-from typing import Optional, List, Tuple, Dict
+from typing import Optional, List, Tuple, Dict, Set, Iterator, Callable
 from collections import OrderedDict, defaultdict, namedtuple
 import os
 import glob
@@ -8,22 +8,41 @@ from time import time
 import logging
 from uuid import UUID
 import hashlib
+import sqlite3
+import threading
+import atexit
+import fcntl
+from contextlib import contextmanager
 
 from pixeltable.env import Env
 
 
 _logger = logging.getLogger('pixeltable')
 
+# validators of an HTTP resource, for conditional requests
+Validators = namedtuple('Validators', ['etag', 'last_modified'])
+
 class CacheEntry:
-    def __init__(self, key: str, tbl_id: UUID, col_id: int, size: int, last_accessed_ts: int):
+    def __init__(
+            self, key: str, tbl_id: UUID, col_id: int, size: int, last_accessed_ts: float, pid: Optional[int] = None,
+            validators: Optional[Validators] = None, validated_ts: Optional[float] = None, generation: int = 0
+    ):
         self.key = key
         self.tbl_id = tbl_id
         self.col_id = col_id
         self.size = size
         self.last_accessed_ts = last_accessed_ts
+        # the process that accessed the entry last
+        self.pid = pid if pid is not None else os.getpid()
+        self.validators = validators
+        # time at which the file was last known to be up to date
+        self.validated_ts = validated_ts if validated_ts is not None else last_accessed_ts
+        # incremented by FileCache.replace(): each version of the file has its own path
+        self.generation = generation
 
     def filename(self) -> str:
-        return f'{self.tbl_id.hex}_{self.col_id}_{self.key}'
+        suffix = f'-{self.generation}' if self.generation > 0 else ''
+        return f'{self.tbl_id.hex}_{self.col_id}_{self.key}{suffix}'
 
     def path(self) -> Path:
         return Env.get().filecache_dir / self.filename()
@@ -34,25 +53,67 @@ class CacheEntry:
         assert len(components) == 3
         tbl_id = UUID(components[0])
         col_id = int(components[1])
-        key = components[2]
+        key, _, generation = components[2].partition('-')
         file_info = os.stat(str(path))
-        return cls(key, tbl_id, col_id, file_info.st_size, file_info.st_mtime)
+        return cls(
+            key, tbl_id, col_id, file_info.st_size, file_info.st_mtime,
+            generation=int(generation) if generation != '' else 0)
 
 
 class FileCache:
     """
     A local cache of external (eg, S3) file references in cells of a stored table (ie, table or view).
 
-    Cache entries are identified by a hash of the file url and stored in Env.filecache_dir. The time of last
-    access of a cache entries is its file's mtime.
+    Cache entries are identified by a hash of the file url and stored in Env.filecache_dir. The entries, including
+    their time of last access, are recorded in a SQLite index (INDEX_FILE in Env.filecache_dir), which is read at
+    startup; if the index doesn't exist yet, it is built from the cache directory.
+    The index and the directory are reconciled in a background thread after startup: files that aren't in the index
+    (eg, after a crash) are added to it, and entries without a file are removed.
+
+    Lookups don't access the file system: access times are recorded in memory and written to the index in batches
+    (every FLUSH_INTERVAL seconds or FLUSH_BATCH_SIZE accesses, and in flush()).
+
+    The total size of the cache is limited to Env.max_filecache_size; entries are evicted in LRU order.
+    Entries that were accessed by the current query (ie, at or after query_ts) are never evicted on behalf of that
+    query: if the working set of a query exceeds the capacity, the cache stops admitting new entries for it, which
+    keeps the entries it already brought in (ie, it switches to MRU replacement).
+
+    In addition, the size of individual tables can be limited with set_quota(), and the entries of a table or column
+    can be exempted from eviction with pin().
+
+    Multiple processes can share a cache directory:
+    - the index is the shared state: all modifications (admission, eviction, persisting access times) happen in
+      write transactions, which serializes them across processes, and are recorded in a change log (trimmed to
+      MAX_LOG_SIZE records). Each process applies the log to its in-memory state (_sync()) before it admits entries,
+      on lookup misses and every FLUSH_INTERVAL seconds; lookup hits stay in memory
+    - fetch() makes downloads single-flight: a file lock per url (striped over LOCK_STRIPES lock files) ensures
+      that only one process fetches a given url, while the others wait and then find it in the cache
+    - entries that another process accessed within the last EVICTION_GRACE seconds aren't evicted, because that
+      process might still be reading them (access times are persisted at least every FLUSH_INTERVAL seconds)
 
-    TODO:
-    - enforce a maximum capacity with LRU eviction
-    - implement MRU eviction for queries that exceed the capacity
+    Entries can record the validators of their source (eg, the ETag of an HTTP resource); stale_validators() returns
+    them once an entry hasn't been validated for REVALIDATE_INTERVAL seconds. If the source changed, replace() swaps
+    in the new file under a new path (the next generation of the entry): the previous file is retired, but stays in
+    place for rows that still reference it, until the caller releases it with remove_retired(). Retired files are
+    recorded in the index; reconcile() doesn't add them back, and removes those left behind for RETIRED_MAX_AGE
+    seconds (eg, by a crash).
     """
     _instance: Optional[FileCache] = None
-    ColumnStats = namedtuple('FileCacheColumnStats', ['tbl_id', 'col_id', 'num_files', 'total_size'])
+    ColumnStats = namedtuple(
+        'FileCacheColumnStats', ['tbl_id', 'col_id', 'num_files', 'total_size', 'num_evictions'])
     CacheStats = namedtuple('FileCacheStats', ['num_requests', 'num_hits', 'num_evictions', 'util'])
+    INDEX_FILE = '.index.db'
+    LOCK_DIR = '.locks'
+    LOCK_STRIPES = 4096
+    FLUSH_INTERVAL = 10.0
+    FLUSH_BATCH_SIZE = 10000
+    EVICTION_GRACE = 3 * FLUSH_INTERVAL
+    # the change log is trimmed to this many entries; processes that fall behind reload the index
+    MAX_LOG_SIZE = 100000
+    REVALIDATE_INTERVAL = 3600.0
+    RETIRED_MAX_AGE = 24 * 3600.0
+    _COLUMNS = 'key, tbl_id, col_id, size, last_accessed_ts, pid, etag, last_modified, validated_ts, generation'
+    _PLACEHOLDERS = ', '.join('?' * len(_COLUMNS.split(', ')))
 
     @classmethod
     def get(cls) -> FileCache:
@@ -61,19 +122,221 @@ class FileCache:
         return cls._instance
 
     def __init__(self):
-        paths = glob.glob(str(Env.get().filecache_dir / '*'))
         self.cache: OrderedDict[str, CacheEntry] = OrderedDict()  # ordered by entry.last_accessed_ts
         self.total_size = 0
-        #self.capacity = Env.get().max_filecache_size
+        self.tbl_sizes: Dict[UUID, int] = defaultdict(int)
+        self.capacity = Env.get().max_filecache_size
+        self.tbl_quotas: Dict[UUID, int] = {}
+        # pinned tables (col_id is None) and columns
+        self.pinned: Set[Tuple[UUID, Optional[int]]] = set()
         self.num_requests = 0
         self.num_hits = 0
         self.num_evictions = 0
-        entries = [CacheEntry.from_file(Path(path_str)) for path_str in paths]
-        # we need to insert entries in order of last_accessed_ts
-        entries.sort(key=lambda e: e.last_accessed_ts)
-        for entry in entries:
-            self.cache[entry.key] = entry
-            self.total_size += entry.size
+        self.col_evictions: Dict[Tuple[UUID, int], int] = defaultdict(int)
+        self.pid = os.getpid()
+        # protects self.cache and the index against the reconciliation and flush threads
+        self.lock = threading.RLock()
+        # keys of entries with access times that haven't been written to the index yet
+        self.dirty_keys: Set[str] = set()
+        self.last_flush_ts = time()
+        self.last_access_ts = 0.0
+        # seq of the last change log record that has been applied to self.cache
+        self.log_seq = 0
+
+        lock_dir = Env.get().filecache_dir / self.LOCK_DIR
+        lock_dir.mkdir(exist_ok=True)
+        index_path = Env.get().filecache_dir / self.INDEX_FILE
+        # autocommit: we start transactions explicitly; timeout: wait for write transactions of other processes
+        self.index = sqlite3.connect(str(index_path), isolation_level=None, check_same_thread=False, timeout=600)
+        self.index.execute('PRAGMA journal_mode=WAL')
+        self.index.execute('PRAGMA synchronous=NORMAL')
+        with self._transaction():
+            index_exists = self.index.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name='entries'").fetchone() is not None
+            self.index.execute(
+                'CREATE TABLE IF NOT EXISTS entries '
+                '(key TEXT PRIMARY KEY, tbl_id TEXT, col_id INTEGER, size INTEGER, last_accessed_ts REAL, pid INTEGER, '
+                'etag TEXT, last_modified TEXT, validated_ts REAL, generation INTEGER DEFAULT 0)')
+            self.index.execute(
+                'CREATE TABLE IF NOT EXISTS log (seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, op TEXT)')
+            # files of replaced entries that might still be referenced
+            self.index.execute('CREATE TABLE IF NOT EXISTS retired (filename TEXT PRIMARY KEY, ts REAL)')
+            if index_exists:
+                # add columns that were introduced after the index was created
+                col_names = [r[1] for r in self.index.execute('PRAGMA table_info(entries)')]
+                for col_name, col_def in [
+                    ('pid', 'INTEGER DEFAULT 0'), ('etag', 'TEXT'), ('last_modified', 'TEXT'), ('validated_ts', 'REAL'),
+                    ('generation', 'INTEGER DEFAULT 0')
+                ]:
+                    if col_name not in col_names:
+                        self.index.execute(f'ALTER TABLE entries ADD COLUMN {col_name} {col_def}')
+                self._load()
+            else:
+                paths = glob.glob(str(Env.get().filecache_dir / '*'))
+                entries = [CacheEntry.from_file(Path(path_str)) for path_str in paths]
+                # we need to insert entries in order of last_accessed_ts
+                entries.sort(key=lambda e: e.last_accessed_ts)
+                self.index.executemany(
+                    f'INSERT INTO entries ({self._COLUMNS}) VALUES ({self._PLACEHOLDERS})',
+                    [self._index_row(e) for e in entries])
+                for entry in entries:
+                    self._add_entry(entry)
+
+        self.reconcile_thread: Optional[threading.Thread] = None
+        if index_exists:
+            self.reconcile_thread = threading.Thread(target=self.reconcile, daemon=True)
+            self.reconcile_thread.start()
+        # persist access times regularly, so that other processes see them
+        self.stop_event = threading.Event()
+        self.flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self.flush_thread.start()
+        atexit.register(self.flush)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        """A write transaction on the index; excludes writers in other processes"""
+        with self.lock:
+            self.index.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except BaseException:
+                # also on KeyboardInterrupt: an open transaction would keep other processes from writing
+                self.index.execute('ROLLBACK')
+                raise
+            self.index.execute('COMMIT')
+
+    def _load(self) -> None:
+        """Load the in-memory state from the index"""
+        self.cache.clear()
+        self.total_size = 0
+        self.tbl_sizes.clear()
+        rows = self.index.execute(f'SELECT {self._COLUMNS} FROM entries ORDER BY last_accessed_ts')
+        for row in rows:
+            self._add_entry(self._entry_from_row(row))
+        self.log_seq = self.index.execute('SELECT COALESCE(MAX(seq), 0) FROM log').fetchone()[0]
+
+    def _sync(self) -> None:
+        """Apply the changes made by other processes to the in-memory state"""
+        records = self.index.execute('SELECT seq, key, op FROM log WHERE seq > ? ORDER BY seq', (self.log_seq,))
+        records = records.fetchall()
+        if len(records) == 0:
+            return
+        if records[0][0] != self.log_seq + 1:
+            # the log got trimmed: we missed some changes
+            self._load()
+            return
+        self.log_seq = records[-1][0]
+        # the last op determines the state of a key
+        ops: Dict[str, str] = {key: op for _, key, op in records}
+        for key in [key for key, op in ops.items() if op == 'r']:
+            if key in self.cache:
+                self._remove_entry(self.cache[key])
+        updated_keys = [key for key, op in ops.items() if op != 'r']
+        found_keys: Set[str] = set()
+        for i in range(0, len(updated_keys), 500):
+            keys = updated_keys[i:i + 500]
+            rows = self.index.execute(
+                f'SELECT {self._COLUMNS} FROM entries WHERE key IN ({", ".join("?" * len(keys))})', keys)
+            for row in rows:
+                new_entry = self._entry_from_row(row)
+                found_keys.add(new_entry.key)
+                entry = self.cache.get(new_entry.key)
+                if entry is not None and entry.generation != new_entry.generation:
+                    # the entry was replaced
+                    self._remove_entry(entry)
+                    entry = None
+                if entry is None:
+                    self._add_entry(new_entry)
+                    continue
+                entry.validated_ts = max(entry.validated_ts, new_entry.validated_ts)
+                if new_entry.last_accessed_ts > entry.last_accessed_ts:
+                    entry.last_accessed_ts, entry.pid = new_entry.last_accessed_ts, new_entry.pid
+                    self.cache.move_to_end(entry.key, last=True)
+        # keys that have been removed in the meantime
+        for key in set(updated_keys) - found_keys:
+            if key in self.cache:
+                self._remove_entry(self.cache[key])
+
+    def _log(self, keys: List[str], op: str) -> None:
+        self.index.executemany('INSERT INTO log (key, op) VALUES (?, ?)', [(key, op) for key in keys])
+        # trim the log; a range delete on the primary key
+        self.index.execute('DELETE FROM log WHERE seq <= last_insert_rowid() - ?', (self.MAX_LOG_SIZE,))
+
+    @classmethod
+    def _index_row(cls, entry: CacheEntry) -> Tuple:
+        etag, last_modified = entry.validators if entry.validators is not None else (None, None)
+        return (
+            entry.key, entry.tbl_id.hex, entry.col_id, entry.size, entry.last_accessed_ts, entry.pid, etag,
+            last_modified, entry.validated_ts, entry.generation
+        )
+
+    @classmethod
+    def _entry_from_row(cls, row: Tuple) -> CacheEntry:
+        key, tbl_id, col_id, size, ts, pid, etag, last_modified, validated_ts, generation = row
+        validators = Validators(etag, last_modified) if etag is not None or last_modified is not None else None
+        return CacheEntry(key, UUID(hex=tbl_id), col_id, size, ts, pid, validators, validated_ts, generation or 0)
+
+    def _add_entry(self, entry: CacheEntry) -> None:
+        """Add entry to the in-memory state"""
+        self.cache[entry.key] = entry
+        self.total_size += entry.size
+        self.tbl_sizes[entry.tbl_id] += entry.size
+
+    def _remove_entry(self, entry: CacheEntry) -> None:
+        """Remove entry from the in-memory state"""
+        del self.cache[entry.key]
+        self.total_size -= entry.size
+        self.tbl_sizes[entry.tbl_id] -= entry.size
+        self.dirty_keys.discard(entry.key)
+
+    def reconcile(self) -> None:
+        """Make the index consistent with the cache directory"""
+        filenames = set(os.listdir(Env.get().filecache_dir))
+        with self._transaction():
+            self._sync()
+            # entries that were added after we listed the directory have a file
+            missing = [
+                e for e in self.cache.values() if e.filename() not in filenames and not e.path().exists()
+            ]
+            for entry in missing:
+                self._remove_entry(entry)
+            self.index.executemany('DELETE FROM entries WHERE key = ?', [(e.key,) for e in missing])
+            self._log([e.key for e in missing], 'r')
+            known = {e.filename() for e in self.cache.values()}
+            retired = dict(self.index.execute('SELECT filename, ts FROM retired').fetchall())
+            # retired files are still referenced by the rows of a running query, unless they were left behind
+            abandoned = [f for f, ts in retired.items() if ts < time() - self.RETIRED_MAX_AGE]
+            self.index.executemany('DELETE FROM retired WHERE filename = ?', [(f,) for f in abandoned])
+        for filename in abandoned:
+            (Env.get().filecache_dir / filename).unlink(missing_ok=True)
+        unknown = [
+            f for f in filenames
+            if f not in known and f not in retired and not f.startswith('.') and len(f.split('_')) == 3
+        ]
+        new_entries: List[CacheEntry] = []
+        for filename in unknown:
+            try:
+                new_entries.append(CacheEntry.from_file(Env.get().filecache_dir / filename))
+            except FileNotFoundError:
+                # it was evicted in the meantime
+                pass
+        with self._transaction():
+            self._sync()
+            retired = {row[0] for row in self.index.execute('SELECT filename FROM retired')}
+            new_entries = [
+                e for e in new_entries if e.key not in self.cache and e.filename() not in retired and e.path().exists()
+            ]
+            # these are most likely stale: insert them in LRU position
+            for entry in sorted(new_entries, key=lambda e: e.last_accessed_ts, reverse=True):
+                self._add_entry(entry)
+                self.cache.move_to_end(entry.key, last=False)
+            self.index.executemany(
+                f'INSERT OR REPLACE INTO entries ({self._COLUMNS}) VALUES ({self._PLACEHOLDERS})',
+                [self._index_row(e) for e in new_entries])
+            self._log([e.key for e in new_entries], 'a')
+        if len(missing) > 0 or len(new_entries) > 0:
+            _logger.info(
+                f'file cache reconciliation: removed {len(missing)} entries, added {len(new_entries)} files')
 
     def avg_file_size(self) -> int:
         if len(self.cache) == 0:
@@ -83,14 +346,21 @@ class FileCache:
     def num_files(self, tbl_id: Optional[UUID] = None) -> int:
         if tbl_id is None:
             return len(self.cache)
-        entries = [e for e in self.cache.values() if e.tbl_id == tbl_id]
+        with self.lock:
+            entries = [e for e in self.cache.values() if e.tbl_id == tbl_id]
         return len(entries)
 
     def clear(self, tbl_id: Optional[UUID] = None, capacity: Optional[int] = None) -> None:
         """
         For testing purposes: allow resetting capacity and stats.
         """
+        with self._transaction():
+            self._sync()
+            self._clear(tbl_id, capacity)
+
+    def _clear(self, tbl_id: Optional[UUID], capacity: Optional[int]) -> None:
         self.num_requests, self.num_hits, self.num_evictions = 0, 0, 0
+        self.col_evictions.clear()
         entries = list(self.cache.values())  # list(): avoid dealing with values() return type
         if tbl_id is not None:
             entries = [e for e in entries if e.tbl_id == tbl_id]
@@ -98,15 +368,30 @@ class FileCache:
         else:
             _logger.debug(f'clearing {len(entries)} entries from file cache')
         for entry in entries:
-            del self.cache[entry.key]
-            self.total_size -= entry.size
-            os.remove(entry.path())
-        # if capacity is not None:
-        #     self.capacity = capacity
-        # else:
-        #     # need to reset to default
-        #     self.capacity = Env.get().max_filecache_size
-        # _logger.debug(f'setting file cache capacity to {self.capacity}')
+            self._remove(entry)
+        if capacity is not None:
+            self.capacity = capacity
+        else:
+            # need to reset to default
+            self.capacity = Env.get().max_filecache_size
+        _logger.debug(f'setting file cache capacity to {self.capacity}')
+
+    def set_quota(self, tbl_id: UUID, quota: Optional[int]) -> None:
+        """Limit the total size of the entries of tbl_id to quota bytes; None: no limit"""
+        if quota is None:
+            self.tbl_quotas.pop(tbl_id, None)
+        else:
+            self.tbl_quotas[tbl_id] = quota
+
+    def pin(self, tbl_id: UUID, col_id: Optional[int] = None) -> None:
+        """Exempt the entries of tbl_id (or only those of column col_id) from eviction"""
+        self.pinned.add((tbl_id, col_id))
+
+    def unpin(self, tbl_id: UUID, col_id: Optional[int] = None) -> None:
+        self.pinned.discard((tbl_id, col_id))
+
+    def _is_pinned(self, entry: CacheEntry) -> bool:
+        return (entry.tbl_id, None) in self.pinned or (entry.tbl_id, entry.col_id) in self.pinned
 
     def _url_hash(self, url: str) -> str:
         h = hashlib.sha256()
@@ -114,78 +399,278 @@ class FileCache:
         return h.hexdigest()
 
     def lookup(self, url: str) -> Optional[Path]:
-        self.num_requests += 1
-        key = self._url_hash(url)
-        entry = self.cache.get(key, None)
-        if entry is None:
-            _logger.debug(f'file cache miss for {url}')
-            return None
-        # update mtime and cache
-        path = entry.path()
-        path.touch(exist_ok=True)
-        file_info = os.stat(str(path))
-        entry.last_accessed_ts = file_info.st_mtime
-        self.cache.move_to_end(key, last=True)
-        self.num_hits += 1
-        _logger.debug(f'file cache hit for {url}')
-        return path
-
-    # def can_admit(self, query_ts: int) -> bool:
-    #     if self.total_size + self.avg_file_size <= self.capacity:
-    #         return True
-    #     assert len(self.cache) > 0
-    #     # check whether we can evict the current lru entry
-    #     lru_entry = next(iter(self.cache.values()))
-    #     if lru_entry.last_accessed_ts >= query_ts:
-    #         # the current query brought this entry in: we're not going to evict it
-    #         return False
-    #     return True
-
-    def add(self, tbl_id: UUID, col_id: int, url: str, path: Path) -> Path:
+        return self.lookup_batch([url])[0]
+
+    def lookup_batch(self, urls: List[str]) -> List[Optional[Path]]:
+        """Return the paths of the cached files for urls (None for cache misses)"""
+        result: List[Optional[Path]] = []
+        with self.lock:
+            if any(self._url_hash(url) not in self.cache for url in urls):
+                # another process might have added them
+                self._sync()
+            self.num_requests += len(urls)
+            for url in urls:
+                key = self._url_hash(url)
+                entry = self.cache.get(key, None)
+                if entry is None:
+                    _logger.debug(f'file cache miss for {url}')
+                    result.append(None)
+                    continue
+                entry.last_accessed_ts = self._access_ts()
+                self.dirty_keys.add(key)
+                self.cache.move_to_end(key, last=True)
+                self.num_hits += 1
+                result.append(entry.path())
+            if len(self.dirty_keys) >= self.FLUSH_BATCH_SIZE \
+                    or self.last_access_ts - self.last_flush_ts >= self.FLUSH_INTERVAL:
+                self._flush()
+        return result
+
+    def _access_ts(self) -> float:
+        """Return a timestamp for a new access; timestamps are strictly increasing, so that the index preserves the
+        LRU order"""
+        self.last_access_ts = max(time(), self.last_access_ts + 1e-6)
+        return self.last_access_ts
+
+    def flush(self) -> None:
+        """Write pending access times to the index"""
+        with self.lock:
+            self._flush()
+
+    def _flush_loop(self) -> None:
+        while not self.stop_event.wait(self.FLUSH_INTERVAL):
+            with self.lock:
+                # pick up the changes of other processes, in particular evictions of entries that we'd otherwise
+                # report as hits
+                self._sync()
+                if time() - self.last_flush_ts >= self.FLUSH_INTERVAL:
+                    self._flush()
+
+    def _flush(self) -> None:
+        self.last_flush_ts = time()
+        if len(self.dirty_keys) == 0:
+            return
+        with self._transaction():
+            updates = [(self.cache[key].last_accessed_ts, self.pid, key) for key in self.dirty_keys]
+            self.index.executemany('UPDATE entries SET last_accessed_ts = ?, pid = ? WHERE key = ?', updates)
+            self._log(list(self.dirty_keys), 't')
+        _logger.debug(f'file cache: persisted {len(updates)} access times')
+        self.dirty_keys.clear()
+
+    def _remove(self, entry: CacheEntry) -> None:
+        """Remove entry and its file; needs to be called in a transaction"""
+        self._remove_entry(entry)
+        # remove the index entry first: a file without an entry gets picked up by reconcile()
+        self.index.execute('DELETE FROM entries WHERE key = ?', (entry.key,))
+        self._log([entry.key], 'r')
+        try:
+            os.remove(str(entry.path()))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self, size: int, query_ts: float, tbl_id: Optional[UUID] = None) -> bool:
+        """Evict LRU entries (of tbl_id, if given) until size bytes are available.
+
+        Returns False if that requires evicting entries that are pinned or were accessed by the current query (or
+        recently by another process).
+        """
+        if tbl_id is None:
+            limit, current_size = self.capacity, self.total_size
+        else:
+            limit, current_size = self.tbl_quotas[tbl_id], self.tbl_sizes[tbl_id]
+        if current_size + size <= limit:
+            return True
+        if size > limit:
+            return False
+
+        # collect victims first: we only evict if that frees up enough space
+        victims: List[CacheEntry] = []
+        freed = 0
+        grace_ts = time() - self.EVICTION_GRACE
+        for entry in self.cache.values():
+            if current_size - freed + size <= limit:
+                break
+            if entry.pid != self.pid:
+                if entry.last_accessed_ts >= grace_ts:
+                    # another process might still be using this
+                    continue
+            elif entry.last_accessed_ts >= query_ts:
+                # this and all following entries of this process were brought in by the current query
+                break
+            if (tbl_id is not None and entry.tbl_id != tbl_id) or self._is_pinned(entry):
+                continue
+            victims.append(entry)
+            freed += entry.size
+        if current_size - freed + size > limit:
+            return False
+
+        for entry in victims:
+            self._remove(entry)
+            self.num_evictions += 1
+            self.col_evictions[(entry.tbl_id, entry.col_id)] += 1
+            _logger.debug(f'evicted entry {entry.key} of table {entry.tbl_id} from file cache')
+        return True
+
+    def add(
+            self, tbl_id: UUID, col_id: int, url: str, path: Path, query_ts: Optional[float] = None,
+            validators: Optional[Validators] = None
+    ) -> Path:
         """Adds url at 'path' to cache and returns its new path.
-        'path' will not be accessible after this call.
+        'path' will not be accessible after this call, unless the cache doesn't admit the file, in which case the
+        return value is 'path' itself and the caller is responsible for removing it.
+
+        query_ts: start time of the query on whose behalf the file is added; entries accessed after that are not
+        evicted; None: the current time
+        validators: validators of the source of the file, for revalidation
         """
-        file_info = os.stat(str(path))
-        _ = time()
-        #if self.total_size + file_info.st_size > self.capacity:
-        if False:
-            if len(self.cache) == 0:
-                # nothing to evict
-                return
-            # evict entries until we're below the limit or until we run into entries the current query brought in
-            while True:
-                lru_entry = next(iter(self.cache.values()))
-                if lru_entry.last_accessed_ts >= query_ts:
-                    # the current query brought this entry in: switch to MRU and ignore this put()
-                    _logger.debug('file cache switched to MRU')
-                    return
-                self.cache.popitem(last=False)
-                self.total_size -= lru_entry.size
-                self.num_evictions += 1
-                os.remove(str(lru_entry.path()))
-                _logger.debug(f'evicted entry for cell {lru_entry.cell_id} from file cache')
-                if self.total_size + file_info.st_size <= self.capacity:
-                    break
+        with self._transaction():
+            self._sync()
+            return self._add(tbl_id, col_id, url, path, query_ts, validators)
 
+    def _add(
+            self, tbl_id: UUID, col_id: int, url: str, path: Path, query_ts: Optional[float],
+            validators: Optional[Validators], generation: int = 0
+    ) -> Path:
         key = self._url_hash(url)
-        assert key not in self.cache
-        entry = CacheEntry(key, tbl_id, col_id, file_info.st_size, file_info.st_mtime)
-        self.cache[key] = entry
-        self.total_size += entry.size
+        if key in self.cache:
+            # another process added it in the meantime
+            os.remove(str(path))
+            return self.cache[key].path()
+        file_info = os.stat(str(path))
+        if query_ts is None:
+            query_ts = time()
+        # enforce the table quota first: evicting entries of that table also frees up space in the cache
+        admitted = tbl_id not in self.tbl_quotas or self._evict(file_info.st_size, query_ts, tbl_id=tbl_id)
+        admitted = admitted and self._evict(file_info.st_size, query_ts)
+        if not admitted:
+            _logger.debug(f'file cache switched to MRU: not admitting {url}')
+            return path
+
+        entry = CacheEntry(
+            key, tbl_id, col_id, file_info.st_size, self._access_ts(), validators=validators, generation=generation)
+        self._add_entry(entry)
         new_path = entry.path()
+        # move the file first: a file without an entry gets picked up by reconcile()
         os.rename(str(path), str(new_path))
+        self.index.execute(
+            f'INSERT OR REPLACE INTO entries ({self._COLUMNS}) VALUES ({self._PLACEHOLDERS})',
+            self._index_row(entry))
+        self._log([key], 'a')
         _logger.debug(f'added entry for cell {url} to file cache')
         return new_path
 
+    @contextmanager
+    def _fetch_lock(self, key: str) -> Iterator[None]:
+        """Exclusive lock for fetching the url with the given key, across threads and processes"""
+        stripe = int(key[:8], 16) % self.LOCK_STRIPES
+        with open(Env.get().filecache_dir / self.LOCK_DIR / str(stripe), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def fetch(
+            self, tbl_id: UUID, col_id: int, url: str, fetch_fn: Callable[[str], Tuple[Path, Optional[Validators]]],
+            query_ts: Optional[float] = None
+    ) -> Tuple[Path, bool]:
+        """Return a local path for url, which fetch_fn() downloads unless another process already did.
+
+        fetch_fn() returns the path of the downloaded file and the validators of its source.
+
+        Returns (path, True) if the file is in the cache, (path, False) if the cache didn't admit it, in which case the
+        caller is responsible for removing it.
+        """
+        key = self._url_hash(url)
+        with self._fetch_lock(key):
+            with self.lock:
+                self._sync()
+                entry = self.cache.get(key)
+                if entry is not None:
+                    # someone else fetched it while we were waiting for the lock
+                    entry.last_accessed_ts = self._access_ts()
+                    self.dirty_keys.add(key)
+                    self.cache.move_to_end(key, last=True)
+                    return entry.path(), True
+            tmp_path, validators = fetch_fn(url)
+            path = self.add(tbl_id, col_id, url, tmp_path, query_ts=query_ts, validators=validators)
+            return path, path != tmp_path
+
+    def stale_validators(self, url: str) -> Optional[Validators]:
+        """Return the validators of the cached file for url if it is due for revalidation, otherwise None"""
+        with self.lock:
+            entry = self.cache.get(self._url_hash(url))
+            if entry is None or entry.validators is None:
+                return None
+            if time() - entry.validated_ts < self.REVALIDATE_INTERVAL:
+                return None
+            return entry.validators
+
+    def set_validated(self, url: str) -> None:
+        """Record that the cached file for url is up to date"""
+        key = self._url_hash(url)
+        with self._transaction():
+            entry = self.cache.get(key)
+            if entry is None:
+                return
+            entry.validated_ts = time()
+            self.index.execute('UPDATE entries SET validated_ts = ? WHERE key = ?', (entry.validated_ts, key))
+            self._log([key], 't')
+
+    def replace(
+            self, tbl_id: UUID, col_id: int, url: str, path: Path, query_ts: Optional[float] = None,
+            validators: Optional[Validators] = None
+    ) -> Tuple[Path, Optional[Path]]:
+        """Replace the cached file for url with the file at path, eg, because its source changed.
+
+        The new file gets a new path, which is returned as by add(); the previous file is retired, not removed: rows
+        might still reference it. Returns (new path, path of the retired file, if there was one); the caller needs to
+        remove the retired file with remove_retired() once it's no longer referenced.
+        """
+        key = self._url_hash(url)
+        with self._transaction():
+            self._sync()
+            entry = self.cache.get(key)
+            if entry is None:
+                return self._add(tbl_id, col_id, url, path, query_ts, validators), None
+            self._remove_entry(entry)
+            self.index.execute('DELETE FROM entries WHERE key = ?', (key,))
+            self.index.execute(
+                'INSERT OR REPLACE INTO retired (filename, ts) VALUES (?, ?)', (entry.filename(), time()))
+            self._log([key], 'r')
+            # if the new file isn't admitted, the entry stays removed
+            new_path = self._add(tbl_id, col_id, url, path, query_ts, validators, generation=entry.generation + 1)
+            return new_path, entry.path()
+
+    def remove_retired(self, paths: List[Path]) -> None:
+        """Remove files retired by replace()"""
+        with self._transaction():
+            self.index.executemany('DELETE FROM retired WHERE filename = ?', [(p.name,) for p in paths])
+        for path in paths:
+            path.unlink(missing_ok=True)
+
+    def invalidate(self, url: str) -> None:
+        """Remove the cached file for url, eg, because its source changed"""
+        key = self._url_hash(url)
+        with self._transaction():
+            self._sync()
+            entry = self.cache.get(key)
+            if entry is not None:
+                self._remove(entry)
+
     def stats(self) -> CacheStats:
         # collect column stats
-        d: Dict[Tuple[int, int], List[int]] = defaultdict(lambda: [0, 0])
-        for entry in self.cache.values():
-            t = d[(entry.tbl_id, entry.col_id)]
-            t[0] += 1
-            t[1] += entry.size
+        d: Dict[Tuple[UUID, int], List[int]] = defaultdict(lambda: [0, 0])
+        with self.lock:
+            for entry in self.cache.values():
+                t = d[(entry.tbl_id, entry.col_id)]
+                t[0] += 1
+                t[1] += entry.size
+        for k in self.col_evictions:
+            _ = d[k]
         col_stats = [
-            self.ColumnStats(tbl_id, col_id, num_files, size) for (tbl_id, col_id), (num_files, size) in d.items()
+            self.ColumnStats(tbl_id, col_id, num_files, size, self.col_evictions.get((tbl_id, col_id), 0))
+            for (tbl_id, col_id), (num_files, size) in d.items()
         ]
         col_stats.sort(key=lambda e: e[3], reverse=True)
         return self.CacheStats(self.num_requests, self.num_hits, self.num_evictions, col_stats)
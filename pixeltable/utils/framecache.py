@@ -0,0 +1,225 @@
+from __future__ import annotations
+from typing import Optional, List, Tuple
+from collections import OrderedDict
+import atexit
+import hashlib
+import logging
+import os
+import queue
+import threading
+
+import numpy as np
+import PIL.Image
+
+from pixeltable.env import Env
+
+
+_logger = logging.getLogger('pixeltable')
+
+class FrameCache:
+    """
+    A cache of decoded video frames, shared by all queries of a process.
+
+    Entries are keyed by (video file, extraction fps and mode, decoder output, frame idx); the video file is
+    identified by its path, size and mtime, so that a modified file doesn't return stale frames. Frames are stored as
+    raw pixel arrays in two tiers:
+    - in memory, up to Env.frame_cache_memory bytes, in LRU order
+    - frames evicted from memory are written to Env.framecache_dir as .npy files, up to Env.frame_cache_size bytes
+      (0 disables this tier), also in LRU order. Files survive the process, and processes sharing the directory
+      can read each other's frames; the size limit is enforced per process.
+    Only frames added with spill=True go to disk: a frame that the decoder streamed to anyway is as cheap to decode
+    again as it is to read back an uncompressed copy. Files are written by a background thread, so that evictions
+    don't stall decoding; if it falls behind by more than MAX_PENDING_WRITES frames, evicted frames are dropped.
+    """
+    NPY_SUFFIX = '.npy'
+    MAX_PENDING_WRITES = 16
+
+    _instance: Optional[FrameCache] = None
+
+    @classmethod
+    def get(cls) -> FrameCache:
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        # key: cache key, value: (frame, spill to disk on eviction)
+        self.frames: OrderedDict[str, Tuple[np.ndarray, bool]] = OrderedDict()
+        self.memory_size = 0
+        # key: file name, value: file size; loaded from the directory on first access
+        self.files: Optional[OrderedDict[str, int]] = None
+        self.disk_size = 0
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_hits = 0
+        # evicted frames that are waiting to be written; started on first use
+        self.write_queue: queue.Queue[Tuple[str, np.ndarray]] = queue.Queue(maxsize=self.MAX_PENDING_WRITES)
+        self.write_thread: Optional[threading.Thread] = None
+
+    @classmethod
+    def video_key(cls, video_path: str, fps: int, mode: str = 'fps', decoder: str = 'opencv') -> str:
+        """Returns the part of the cache key that identifies the frames of a video extracted at fps in mode
+
+        decoder: identifies the decoder output (DecoderConfig.output_key)
+        """
+        stat = os.stat(video_path)
+        return f'{video_path}:{stat.st_size}:{stat.st_mtime_ns}:{fps}:{mode}:{decoder}'
+
+    @classmethod
+    def key(cls, video_key: str, frame_idx: int) -> str:
+        """Returns the cache key of a frame"""
+        return f'{video_key}:{frame_idx}'
+
+    @classmethod
+    def _filename(cls, key: str) -> str:
+        return hashlib.sha256(key.encode()).hexdigest() + cls.NPY_SUFFIX
+
+    def _load_files(self) -> None:
+        """Initialize self.files from the directory, in LRU order of the file modification times"""
+        entries: List[Tuple[float, str, int]] = []
+        for entry in os.scandir(Env.get().framecache_dir):
+            if entry.name.endswith(self.NPY_SUFFIX):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        self.files = OrderedDict((name, size) for _, name, size in entries)
+        self.disk_size = sum(size for _, _, size in entries)
+
+    def lookup(self, key: str) -> Optional[PIL.Image.Image]:
+        """Returns the frame for key, or None if it isn't cached"""
+        with self.lock:
+            self.num_requests += 1
+            entry = self.frames.get(key)
+            if entry is not None:
+                self.frames.move_to_end(key)
+                self.num_hits += 1
+                return PIL.Image.fromarray(entry[0])
+            if Env.get().frame_cache_size == 0:
+                return None
+            if self.files is None:
+                self._load_files()
+            filename = self._filename(key)
+            if filename not in self.files:
+                return None
+            self.files.move_to_end(filename)
+
+        path = Env.get().framecache_dir / filename
+        try:
+            frame = np.load(path)
+            # the modification time determines the LRU order after a restart
+            os.utime(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            # evicted by another process, or a partial write
+            with self.lock:
+                if filename in self.files:
+                    self.disk_size -= self.files.pop(filename)
+            return None
+        with self.lock:
+            self.num_hits += 1
+        # the file is already there
+        self._add_to_memory(key, frame, spill=False)
+        return PIL.Image.fromarray(frame)
+
+    def add(self, key: str, img: PIL.Image.Image, spill: bool = True) -> None:
+        """Add a decoded frame
+
+        spill: if False, the frame is dropped when it's evicted from memory, instead of being written to disk
+        """
+        self._add_to_memory(key, np.asarray(img), spill)
+
+    def _add_to_memory(self, key: str, frame: np.ndarray, spill: bool) -> None:
+        # frames are shared between rows: make sure nobody modifies them in place
+        frame.flags.writeable = False
+        max_size = Env.get().frame_cache_size
+        evicted: List[Tuple[str, np.ndarray]] = []
+        with self.lock:
+            if key in self.frames:
+                self.frames.move_to_end(key)
+                return
+            self.frames[key] = (frame, spill)
+            self.memory_size += frame.nbytes
+            while self.memory_size > Env.get().frame_cache_memory and len(self.frames) > 0:
+                evicted_key, (evicted_frame, evicted_spill) = self.frames.popitem(last=False)
+                self.memory_size -= evicted_frame.nbytes
+                if evicted_spill and 0 < evicted_frame.nbytes <= max_size:
+                    evicted.append((evicted_key, evicted_frame))
+        if len(evicted) == 0:
+            return
+        self._start_write_thread()
+        for item in evicted:
+            try:
+                self.write_queue.put_nowait(item)
+            except queue.Full:
+                _logger.debug(f'FrameCache: dropped evicted frame {item[0]}')
+
+    def _start_write_thread(self) -> None:
+        with self.lock:
+            if self.write_thread is not None:
+                return
+            self.write_thread = threading.Thread(target=self._write_loop, daemon=True)
+            self.write_thread.start()
+        # finish the pending writes at exit
+        atexit.register(self.flush)
+
+    def _write_loop(self) -> None:
+        while True:
+            key, frame = self.write_queue.get()
+            try:
+                self._write(key, frame)
+            except OSError as e:
+                _logger.warning(f'FrameCache: failed to write frame {key}: {e}')
+            finally:
+                self.write_queue.task_done()
+
+    def flush(self) -> None:
+        """Wait for the pending writes"""
+        if self.write_thread is not None:
+            self.write_queue.join()
+
+    def _write(self, key: str, frame: np.ndarray) -> None:
+        """Write a frame that was evicted from memory to disk"""
+        max_size = Env.get().frame_cache_size
+        filename = self._filename(key)
+        with self.lock:
+            if self.files is None:
+                self._load_files()
+            if filename in self.files:
+                self.files.move_to_end(filename)
+                return
+        path = Env.get().framecache_dir / filename
+        tmp_path = path.with_suffix(f'.{os.getpid()}_{threading.get_ident()}.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.save(f, frame, allow_pickle=False)
+        os.replace(tmp_path, path)
+        size = os.stat(path).st_size
+
+        evicted: List[str] = []
+        with self.lock:
+            self.files[filename] = size
+            self.disk_size += size
+            while self.disk_size > max_size and len(self.files) > 0:
+                evicted_filename, evicted_size = self.files.popitem(last=False)
+                self.disk_size -= evicted_size
+                evicted.append(evicted_filename)
+        for evicted_filename in evicted:
+            try:
+                os.remove(Env.get().framecache_dir / evicted_filename)
+            except FileNotFoundError:
+                pass
+
+    def clear(self) -> None:
+        """Remove all frames, in memory and on disk"""
+        self.flush()
+        with self.lock:
+            self.frames.clear()
+            self.memory_size = 0
+            if self.files is None:
+                self._load_files()
+            filenames = list(self.files.keys())
+            self.files.clear()
+            self.disk_size = 0
+        for filename in filenames:
+            try:
+                os.remove(Env.get().framecache_dir / filename)
+            except FileNotFoundError:
+                pass
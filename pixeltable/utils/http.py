@@ -0,0 +1,101 @@
+from __future__ import annotations
+from typing import Optional, Tuple
+from pathlib import Path
+import threading
+
+import requests
+import requests.adapters
+
+from pixeltable.utils.filecache import Validators
+
+
+class HttpClient:
+    """
+    A shared session for fetching media via HTTP(S).
+
+    The session keeps connections alive and pools them per host (up to POOL_SIZE connections, which matches the
+    maximum concurrency of the DownloadPool), which avoids a TCP/TLS handshake per file when many files come from
+    the same server (eg, a CDN).
+    Downloads return the validators of the response (ETag, Last-Modified), which can be used to revalidate a cached
+    copy with a conditional request later on. Ranged reads fetch parts of a resource without downloading it (eg, the
+    container headers of a video, for probing).
+    """
+    _instance: Optional[HttpClient] = None
+    _lock = threading.Lock()
+    POOL_SIZE = 64
+    CHUNK_SIZE = 1024 * 1024
+    # (connect, read) timeouts in seconds
+    TIMEOUT = (10, 60)
+
+    @classmethod
+    def get(cls) -> HttpClient:
+        with cls._lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    def __init__(self):
+        self.session = requests.Session()
+        # retries are handled by the DownloadPool
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=self.POOL_SIZE, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    @classmethod
+    def _validators(cls, response: requests.Response) -> Optional[Validators]:
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return None
+        return Validators(etag, last_modified)
+
+    def download(
+            self, url: str, path: Path, validators: Optional[Validators] = None) -> Tuple[bool, Optional[Validators]]:
+        """Download url to path.
+
+        If validators are given, the request is conditional: if the resource hasn't changed, nothing is written to
+        path.
+        Returns (True if the resource was written to path, validators of the resource).
+        """
+        headers = {}
+        if validators is not None:
+            if validators.etag is not None:
+                headers['If-None-Match'] = validators.etag
+            if validators.last_modified is not None:
+                headers['If-Modified-Since'] = validators.last_modified
+        with self.session.get(url, headers=headers, stream=True, timeout=self.TIMEOUT) as response:
+            if response.status_code == 304:
+                return False, validators
+            response.raise_for_status()
+            with open(path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                    f.write(chunk)
+            return True, self._validators(response)
+
+    def read_range(self, url: str, offset: int, length: int) -> Tuple[bytes, Optional[int]]:
+        """Read length bytes of url, starting at offset (fewer if the resource ends before that).
+
+        Returns (data, size of the resource); the size is None if the server doesn't support range requests, in which
+        case only the requested bytes of the full response are read.
+        """
+        headers = {'Range': f'bytes={offset}-{offset + length - 1}'}
+        with self.session.get(url, headers=headers, stream=True, timeout=self.TIMEOUT) as response:
+            if response.status_code == 416:
+                # the range starts after the end of the resource
+                content_range = response.headers.get('Content-Range', '')
+                return b'', int(content_range.split('/')[-1]) if content_range.startswith('bytes */') else None
+            response.raise_for_status()
+            if response.status_code == 206:
+                # Content-Range: bytes <first>-<last>/<size>
+                size = response.headers.get('Content-Range', '').split('/')[-1]
+                return response.content, int(size) if size.isdigit() else None
+            # the server ignores range requests and sends the entire resource: skip to offset
+            data = bytearray()
+            pos = 0
+            for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                if pos + len(chunk) > offset:
+                    data += chunk[max(0, offset - pos):]
+                pos += len(chunk)
+                if len(data) >= length:
+                    break
+            return bytes(data[:length]), None
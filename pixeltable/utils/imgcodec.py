@@ -0,0 +1,143 @@
+from __future__ import annotations
+import io
+import os
+import shutil
+import logging
+from typing import Optional, Union, BinaryIO
+from pathlib import Path
+
+import numpy as np
+import PIL.Image
+import PIL.ImageFile
+
+from pixeltable import exceptions as exc
+from pixeltable.env import Env
+
+
+_logger = logging.getLogger('pixeltable')
+
+class ImageCodec:
+    """
+    Encoding of computed images that are stored in the ImageStore.
+
+    The codec of a stored image column is determined by its img_format and img_quality settings:
+    - format None: JPEG with PIL's default quality (the pre-existing behavior)
+    - 'jpeg', 'webp': lossy encoding; quality is passed to PIL
+    - 'png': lossless, compressed
+    - 'npy': lossless, uncompressed pixel array in NumPy format; fastest to write and read
+
+    Images that are pixel-identical to their source file (ie, an input image that is stored again unmodified) are
+    not re-encoded if the source file has the column's format (JPEG for format None): the source file is hardlinked
+    (for files inside Env.home) or copied.
+    """
+    FORMATS = {'jpeg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'npy': None}
+    NPY_SUFFIX = '.npy'
+    NPY_MAGIC = b'\x93NUMPY'
+
+    def __init__(self, format: Optional[str] = None, quality: Optional[int] = None):
+        if format is not None and format not in self.FORMATS:
+            raise exc.Error(
+                f'Unknown image format: {format} (valid formats: {", ".join(self.FORMATS.keys())})')
+        if quality is not None:
+            if format not in ['jpeg', 'webp']:
+                raise exc.Error(f'Image quality only applies to formats jpeg and webp')
+            if quality < 1 or quality > 100:
+                raise exc.Error(f'Image quality needs to be between 1 and 100: {quality}')
+        self.format = format
+        self.quality = quality
+
+    def _source_format(self, img: PIL.Image.Image) -> Optional[str]:
+        """Returns our name for the format of img's source file, or None if img doesn't come from a file"""
+        if not isinstance(img, PIL.ImageFile.ImageFile) or img.format is None:
+            return None
+        fmt = img.format.lower()
+        return 'jpeg' if fmt in ['jpeg', 'mpo'] else fmt
+
+    def _source_path(self, img: PIL.Image.Image) -> Optional[str]:
+        """Returns the path of the file img was read from, if img is pixel-identical to that file"""
+        filename = getattr(img, 'filename', None)
+        if not isinstance(img, PIL.ImageFile.ImageFile) or not filename or not os.path.isfile(filename):
+            return None
+        if len(img.tile) > 0:
+            # the pixel data hasn't been decoded yet, so it can't have been modified in place
+            return filename
+        # img was loaded and could have been modified in place: compare with the source file
+        with PIL.Image.open(filename) as src:
+            if src.mode != img.mode or src.size != img.size or src.tobytes() != img.tobytes():
+                return None
+        return filename
+
+    def can_copy_source(self, img: PIL.Image.Image) -> bool:
+        """Returns True if img's source file satisfies this codec"""
+        src_format = self._source_format(img)
+        if src_format is None:
+            return False
+        # readers of the column expect its format (eg, npy files are loaded as pixel arrays)
+        return src_format == self.format or (self.format is None and src_format == 'jpeg')
+
+    def save(self, img: PIL.Image.Image, filepath: str) -> str:
+        """Save img to filepath, or to a path derived from it, and return the path of the saved file."""
+        if self.can_copy_source(img):
+            src_path = self._source_path(img)
+            if src_path is not None:
+                self._copy(src_path, filepath)
+                return filepath
+        if self.format == 'npy':
+            filepath = filepath + self.NPY_SUFFIX
+        with open(filepath, 'wb') as f:
+            self._write(img, f)
+        return filepath
+
+    def encode(self, img: PIL.Image.Image) -> bytes:
+        """Return the encoded img"""
+        if self.can_copy_source(img):
+            src_path = self._source_path(img)
+            if src_path is not None:
+                with open(src_path, 'rb') as f:
+                    return f.read()
+        buf = io.BytesIO()
+        self._write(img, buf)
+        return buf.getvalue()
+
+    def _write(self, img: PIL.Image.Image, fp: BinaryIO) -> None:
+        if self.format == 'npy':
+            if img.mode == 'P':
+                img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+            np.save(fp, np.asarray(img), allow_pickle=False)
+            return
+
+        pil_format = 'JPEG' if self.format is None else self.FORMATS[self.format]
+        kwargs = {}
+        if self.quality is not None:
+            kwargs['quality'] = self.quality
+        if pil_format == 'JPEG' and img.mode not in ['RGB', 'L', 'CMYK']:
+            img = img.convert('RGB')
+        img.save(fp, format=pil_format, **kwargs)
+
+    @classmethod
+    def _copy(cls, src_path: str, dst_path: str) -> None:
+        """Hardlink files that we own (they're immutable), copy everything else"""
+        if Path(src_path).resolve().is_relative_to(Env.get().home.resolve()):
+            try:
+                os.link(src_path, dst_path)
+                _logger.debug(f'ImageCodec: linked {src_path} as {dst_path}')
+                return
+            except OSError:
+                # eg, the file system doesn't support hardlinks
+                pass
+        shutil.copyfile(src_path, dst_path)
+        _logger.debug(f'ImageCodec: copied {src_path} to {dst_path}')
+
+    @classmethod
+    def open(cls, filepath: str) -> PIL.Image.Image:
+        """Open a file created by save()"""
+        if filepath.endswith(cls.NPY_SUFFIX):
+            return PIL.Image.fromarray(np.load(filepath, allow_pickle=False))
+        return PIL.Image.open(filepath)
+
+    @classmethod
+    def open_buffer(cls, buf: Union[bytes, memoryview]) -> PIL.Image.Image:
+        """Open the output of encode()"""
+        if buf[:len(cls.NPY_MAGIC)] == cls.NPY_MAGIC:
+            return PIL.Image.fromarray(np.load(io.BytesIO(buf), allow_pickle=False))
+        return PIL.Image.open(io.BytesIO(buf))
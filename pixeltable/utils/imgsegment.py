@@ -0,0 +1,100 @@
+from __future__ import annotations
+import mmap
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple, BinaryIO
+
+
+class SegmentWriter:
+    """
+    Appends encoded images to segment files, so that small images don't require a file each.
+
+    Segments are named seg_<uuid>, which allows concurrent writers (in different processes) to use the same directory.
+    Each directory has at most one open segment per process; a segment is closed once it exceeds MAX_SEGMENT_SIZE.
+    """
+    MAX_SEGMENT_SIZE = 64 * 1024 * 1024
+    MAX_OPEN_SEGMENTS = 16
+    PREFIX = 'seg_'
+
+    # key: dir, value: open segment file
+    _segments: OrderedDict[Path, BinaryIO] = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def append(cls, dir: Path, data: bytes) -> Tuple[str, int]:
+        """Append data to the current segment in dir and return (segment path, offset)"""
+        with cls._lock:
+            f = cls._segments.get(dir)
+            if f is not None and f.tell() + len(data) > cls.MAX_SEGMENT_SIZE and f.tell() > 0:
+                f.close()
+                f = None
+            if f is None:
+                dir.mkdir(parents=True, exist_ok=True)
+                f = open(dir / f'{cls.PREFIX}{uuid.uuid4().hex}', 'wb')
+                cls._segments[dir] = f
+                if len(cls._segments) > cls.MAX_OPEN_SEGMENTS:
+                    _, lru_f = cls._segments.popitem(last=False)
+                    lru_f.close()
+            cls._segments.move_to_end(dir)
+            offset = f.tell()
+            f.write(data)
+            # readers access segments via mmap, which doesn't see our write buffer
+            f.flush()
+            return f.name, offset
+
+    @classmethod
+    def close(cls, dir: Optional[Path] = None) -> None:
+        """Close the open segments in dir and its subdirectories, or all open segments"""
+        with cls._lock:
+            for d in [d for d in cls._segments if dir is None or d == dir or dir in d.parents]:
+                cls._segments.pop(d).close()
+
+
+class SegmentReader:
+    """
+    Reads byte ranges from segment files via mmap.
+
+    Mappings are kept open (up to MAX_OPEN_SEGMENTS), so that reading an image doesn't require any file system calls.
+    """
+    MAX_OPEN_SEGMENTS = 64
+
+    # key: segment path, value: mapping of the entire segment
+    _maps: OrderedDict[str, mmap.mmap] = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def read(cls, path: str, offset: int, length: int) -> memoryview:
+        with cls._lock:
+            m = cls._maps.get(path)
+            if m is None or offset + length > len(m):
+                # the segment is new to us or has grown since we mapped it
+                if m is not None:
+                    cls._unmap(m)
+                with open(path, 'rb') as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                cls._maps[path] = m
+                if len(cls._maps) > cls.MAX_OPEN_SEGMENTS:
+                    _, lru_m = cls._maps.popitem(last=False)
+                    cls._unmap(lru_m)
+            cls._maps.move_to_end(path)
+            if offset + length > len(m):
+                raise IOError(f'Segment {path} too short: offset={offset} length={length}')
+            return memoryview(m)[offset:offset + length]
+
+    @classmethod
+    def _unmap(cls, m: mmap.mmap) -> None:
+        try:
+            m.close()
+        except BufferError:
+            # there are still memoryviews of m around; it gets unmapped when those are released
+            pass
+
+    @classmethod
+    def close(cls, dir: Optional[Path] = None) -> None:
+        """Unmap the segments in dir and its subdirectories, or all segments"""
+        with cls._lock:
+            for p in [p for p in cls._maps if dir is None or dir in Path(p).parents]:
+                cls._unmap(cls._maps.pop(p))
@@ -1,65 +1,345 @@
-import glob
+import hashlib
+import io
 import os
 import re
+import shutil
+import threading
+import urllib.parse
+import urllib.request
 import uuid
-from typing import Optional, List, Tuple, Dict
+from collections import OrderedDict
+from typing import Optional, List, Tuple, Dict, Iterator, TextIO
 from pathlib import Path
-from collections import defaultdict
 from uuid import UUID
 
+import PIL.Image
+
 from pixeltable.env import Env
+from pixeltable.utils.imgcodec import ImageCodec
+from pixeltable.utils.imgsegment import SegmentWriter, SegmentReader
 
 
 class ImageStore:
     """
     Utilities to manage images stored in Env.img_dir
 
-    Image file names are a composite of: table id, column id, version, uuid:
-    the table id/column id/version are redundant but useful for identifying all images for a table
-    or all images created for a particular version of a table
+    The store is content-addressed: the data of an image is stored once, in img_dir/objects/<shard>/<content hash>,
+    regardless of how many cells contain that image. Each cell references its image via a hardlink to that object,
+    located in img_dir/<table id>/<column id>/<version>/<shard>/<content hash>_<uuid>; the shard is a prefix of the
+    content hash, which keeps the size of individual directories small.
+
+    Each version directory contains an index file with one line per reference (file name and size), which is used
+    for counts and stats and to delete a version without listing its directories.
+
+    Columns with img_packed=True store their images in segment files in the version directory instead (see
+    SegmentWriter); those images are referenced by a file URL with an '#<offset>:<length>' fragment and don't
+    participate in deduplication. Their local paths (localpath) are files that are extracted from the segment on first
+    access, in the 'extracted' subdirectory of the version directory.
+
+    The reference count of an object is the number of its hardlinks (minus the object itself): deleting the last
+    reference to an object also deletes the object.
+
+    Images stored by earlier releases remain in the flat layout of those releases (their file URLs are recorded in the
+    tables): img_dir/<table id>_<column id>_<version>_<uuid>. They are included in delete(), count() and stats().
+    img_dir is scanned for them once per process (see scan_legacy_layout()); once none are left, a marker file
+    records that, and the scan is skipped.
     """
-    pattern = re.compile(r'([0-9a-fA-F]+)_(\d+)_(\d+)_([0-9a-fA-F]+)')  # tbl_id, col_id, version, uuid
+    OBJECTS_DIR = 'objects'
+    INDEX_FILE = 'index'
+    EXTRACTED_DIR = 'extracted'
+    _SHARD_LEN = 2
+    _CHUNK_SIZE = 1024 * 1024
+    _MAX_OPEN_INDEX_FILES = 16
+    # records that img_dir contains no images in the legacy layout
+    NO_LEGACY_MARKER = '.no_legacy_images'
+    # tbl_id, col_id, version, uuid
+    _LEGACY_PATTERN = re.compile(r'([0-9a-f]{32})_(\d+)_(\d+)_([0-9a-f]{32})')
+
+    # key: version dir, value: index file opened for appending
+    _index_files: OrderedDict[Path, TextIO] = OrderedDict()
+    _lock = threading.Lock()
+    # (img_dir, {tbl_id: [(col_id, version, path)]}) of the images in the legacy layout; None: not scanned yet
+    _legacy_refs: Optional[Tuple[Path, Dict[UUID, List[Tuple[int, int, Path]]]]] = None
+
+    @classmethod
+    def _objects_dir(cls) -> Path:
+        return Env.get().img_dir / cls.OBJECTS_DIR
+
+    @classmethod
+    def _tbl_dir(cls, tbl_id: UUID) -> Path:
+        return Env.get().img_dir / tbl_id.hex
+
+    @classmethod
+    def _version_dir(cls, tbl_id: UUID, col_id: int, version: int) -> Path:
+        return cls._tbl_dir(tbl_id) / str(col_id) / str(version)
+
+    @classmethod
+    def _obj_path(cls, content_hash: str, suffix: str) -> Path:
+        return cls._objects_dir() / content_hash[:cls._SHARD_LEN] / f'{content_hash}{suffix}'
 
     @classmethod
     def get_path(cls, tbl_id: UUID, col_id: int, version: int) -> Path:
-        """Return Path for the target cell.
+        """Return a temporary Path for a new image of the target column.
+
+        The file needs to be moved into the store with add() once it has been written.
         """
         id = uuid.uuid4()
-        return Env.get().img_dir / f'{tbl_id.hex}_{col_id}_{version}_{id.hex}'
+        return Env.get().tmp_dir / f'{tbl_id.hex}_{col_id}_{version}_{id.hex}'
+
+    @classmethod
+    def _content_hash(cls, path: str) -> str:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(cls._CHUNK_SIZE)
+                if len(chunk) == 0:
+                    break
+                h.update(chunk)
+        return h.hexdigest()
+
+    @classmethod
+    def save(
+            cls, img: PIL.Image.Image, tbl_id: UUID, col_id: int, version: int, codec: ImageCodec, packed: bool = False
+    ) -> str:
+        """Store img in the target column and return its file URL"""
+        if packed:
+            return cls.add_packed(tbl_id, col_id, version, codec.encode(img))
+        tmp_path = codec.save(img, str(cls.get_path(tbl_id, col_id, version)))
+        ref_path = cls.add(tbl_id, col_id, version, tmp_path)
+        return urllib.parse.urljoin('file:', urllib.request.pathname2url(str(ref_path)))
+
+    @classmethod
+    def add_packed(cls, tbl_id: UUID, col_id: int, version: int, data: bytes) -> str:
+        """Append data to a segment file of the target column and return its file URL"""
+        version_dir = cls._version_dir(tbl_id, col_id, version)
+        segment_path, offset = SegmentWriter.append(version_dir, data)
+        cls._append_index(version_dir, f'{Path(segment_path).name}@{offset}', len(data))
+        return urllib.parse.urljoin('file:', urllib.request.pathname2url(segment_path)) + f'#{offset}:{len(data)}'
+
+    @classmethod
+    def extract_packed(cls, segment_path: str, offset: int, length: int) -> str:
+        """Return the path of a file that contains the image at offset within a segment file"""
+        data = bytes(SegmentReader.read(segment_path, offset, length))
+        if data[:len(ImageCodec.NPY_MAGIC)] == ImageCodec.NPY_MAGIC:
+            suffix = ImageCodec.NPY_SUFFIX
+        else:
+            with PIL.Image.open(io.BytesIO(data)) as img:
+                suffix = f'.{img.format.lower()}'
+        segment = Path(segment_path)
+        path = segment.parent / cls.EXTRACTED_DIR / f'{segment.name}_{offset}{suffix}'
+        if not path.exists():
+            path.parent.mkdir(exist_ok=True)
+            # segments are immutable: concurrent extractions write the same data
+            tmp_path = path.with_name(f'{path.name}.{uuid.uuid4().hex}.tmp')
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        return str(path)
+
+    @classmethod
+    def _append_index(cls, version_dir: Path, name: str, size: int) -> None:
+        with cls._lock:
+            f = cls._index_files.get(version_dir)
+            if f is None:
+                f = open(version_dir / cls.INDEX_FILE, 'a')
+                cls._index_files[version_dir] = f
+                if len(cls._index_files) > cls._MAX_OPEN_INDEX_FILES:
+                    _, lru_f = cls._index_files.popitem(last=False)
+                    lru_f.close()
+            cls._index_files.move_to_end(version_dir)
+            f.write(f'{name} {size}\n')
+            f.flush()
+
+    @classmethod
+    def _close_files(cls, dir: Path) -> None:
+        """Close all open files in dir and its subdirectories"""
+        with cls._lock:
+            for d in [d for d in cls._index_files if d == dir or dir in d.parents]:
+                cls._index_files.pop(d).close()
+        SegmentWriter.close(dir)
+        SegmentReader.close(dir)
+
+    @classmethod
+    def add(cls, tbl_id: UUID, col_id: int, version: int, path: str) -> Path:
+        """Move the file at path into the store and return the Path of the new reference.
+
+        The suffix of path (eg, '.npy') is retained.
+        """
+        suffix = Path(path).suffix
+        content_hash = cls._content_hash(path)
+        obj_path = cls._obj_path(content_hash, suffix)
+        version_dir = cls._version_dir(tbl_id, col_id, version)
+        ref_name = f'{content_hash}_{uuid.uuid4().hex}{suffix}'
+        ref_path = version_dir / content_hash[:cls._SHARD_LEN] / ref_name
+        ref_path.parent.mkdir(parents=True, exist_ok=True)
+        # path stays in place until the reference exists, in case we need to re-create the object
+        for attempt in range(2):
+            cls._create_object(path, obj_path)
+            try:
+                os.link(obj_path, ref_path)
+                break
+            except FileNotFoundError:
+                # a concurrent delete() garbage-collected the existing object before we linked to it
+                if attempt == 1:
+                    raise
+            except OSError:
+                # eg, the file system doesn't support hardlinks: we lose deduplication, but not correctness
+                shutil.copyfile(path, ref_path)
+                break
+        os.remove(path)
+        cls._append_index(version_dir, ref_name, os.stat(ref_path).st_size)
+        return ref_path
+
+    @classmethod
+    def _create_object(cls, path: str, obj_path: Path) -> None:
+        """Create the object at obj_path from the file at path, unless we already have it"""
+        if obj_path.exists():
+            return
+        obj_path.parent.mkdir(parents=True, exist_ok=True)
+        # if path is a link to a file that we don't manage (eg, an unmodified source image), we need to copy it: the
+        # object's link count needs to reflect our references only
+        if os.stat(path).st_nlink == 1:
+            try:
+                # link instead of rename: this fails if a concurrent add() created the object in the meantime
+                os.link(path, obj_path)
+                return
+            except FileExistsError:
+                return
+            except OSError:
+                # eg, the file system doesn't support hardlinks
+                pass
+        # readers never see a partial object
+        tmp_path = obj_path.with_name(f'{obj_path.name}.{uuid.uuid4().hex}.tmp')
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, obj_path)
+
+    @classmethod
+    def _read_index(cls, version_dir: Path) -> Iterator[Tuple[str, int]]:
+        """Return (reference file name, size) for all references in version_dir"""
+        index_path = version_dir / cls.INDEX_FILE
+        if not index_path.exists():
+            return
+        with open(index_path) as f:
+            for line in f:
+                name, size = line.split()
+                yield name, int(size)
+
+    @classmethod
+    def _version_dirs(cls, tbl_id: UUID, version: Optional[int] = None) -> Iterator[Tuple[int, Path]]:
+        """Return (col_id, version dir) for all version dirs of tbl_id, or only those of the given version"""
+        tbl_dir = cls._tbl_dir(tbl_id)
+        if not tbl_dir.exists():
+            return
+        for col_entry in os.scandir(tbl_dir):
+            if version is not None:
+                version_dir = Path(col_entry.path) / str(version)
+                if version_dir.exists():
+                    yield int(col_entry.name), version_dir
+            else:
+                for version_entry in os.scandir(col_entry.path):
+                    yield int(col_entry.name), Path(version_entry.path)
+
+    @classmethod
+    def _delete_version_dir(cls, version_dir: Path) -> None:
+        """Remove all references in version_dir and garbage-collect objects that lost their last reference"""
+        obj_paths = [
+            cls._obj_path(name.split('_')[0], Path(name).suffix) for name, _ in cls._read_index(version_dir)
+            # skip images in segment files
+            if '@' not in name
+        ]
+        cls._close_files(version_dir)
+        shutil.rmtree(version_dir)
+        for obj_path in obj_paths:
+            try:
+                if os.stat(obj_path).st_nlink == 1:
+                    os.remove(obj_path)
+            except FileNotFoundError:
+                # a duplicate reference within version_dir already removed it
+                pass
+
+    @classmethod
+    def scan_legacy_layout(cls) -> Dict[UUID, List[Tuple[int, int, Path]]]:
+        """Scan img_dir for images in the flat layout of earlier releases and return them by table, as
+        (col_id, version, path)
+        """
+        img_dir = Env.get().img_dir
+        refs: Dict[UUID, List[Tuple[int, int, Path]]] = {}
+        for entry in os.scandir(img_dir):
+            matched = cls._LEGACY_PATTERN.fullmatch(entry.name)
+            if matched is None or not entry.is_file():
+                continue
+            refs.setdefault(UUID(hex=matched[1]), []).append((int(matched[2]), int(matched[3]), Path(entry.path)))
+        if len(refs) == 0:
+            (img_dir / cls.NO_LEGACY_MARKER).touch()
+        else:
+            (img_dir / cls.NO_LEGACY_MARKER).unlink(missing_ok=True)
+        cls._legacy_refs = (img_dir, refs)
+        return refs
+
+    @classmethod
+    def _get_legacy_refs(cls) -> Dict[UUID, List[Tuple[int, int, Path]]]:
+        """Return the result of the last scan_legacy_layout() for the current img_dir, scanning if there is none"""
+        img_dir = Env.get().img_dir
+        if cls._legacy_refs is not None and cls._legacy_refs[0] == img_dir:
+            return cls._legacy_refs[1]
+        if (img_dir / cls.NO_LEGACY_MARKER).exists():
+            cls._legacy_refs = (img_dir, {})
+            return cls._legacy_refs[1]
+        return cls.scan_legacy_layout()
 
     @classmethod
     def delete(cls, tbl_id: UUID, version: Optional[int] = None) -> None:
         """Delete all images belonging to tbl_id"""
         assert tbl_id is not None
-        if version is not None:
-            pattern = f'{tbl_id.hex}_*_{version}_*'
-        else:
-            pattern = f'{tbl_id.hex}_*'
-        paths = glob.glob(str(Env.get().img_dir / pattern))
-        for p in paths:
-            os.remove(p)
+        for _, version_dir in list(cls._version_dirs(tbl_id, version)):
+            cls._delete_version_dir(version_dir)
+        legacy_refs = cls._get_legacy_refs()
+        if tbl_id in legacy_refs:
+            remaining: List[Tuple[int, int, Path]] = []
+            for col_id, ref_version, path in legacy_refs[tbl_id]:
+                if version is None or ref_version == version:
+                    path.unlink(missing_ok=True)
+                else:
+                    remaining.append((col_id, ref_version, path))
+            if len(remaining) > 0:
+                legacy_refs[tbl_id] = remaining
+            else:
+                del legacy_refs[tbl_id]
+                if len(legacy_refs) == 0:
+                    (Env.get().img_dir / cls.NO_LEGACY_MARKER).touch()
+        if version is None:
+            cls._close_files(cls._tbl_dir(tbl_id))
+            shutil.rmtree(cls._tbl_dir(tbl_id), ignore_errors=True)
 
     @classmethod
     def count(cls, tbl_id: UUID) -> int:
         """
         Return number of images for given tbl_id.
         """
-        paths = glob.glob(str(Env.get().img_dir / f'{tbl_id.hex}_*'))
-        return len(paths)
+        num_legacy_refs = len(cls._get_legacy_refs().get(tbl_id, []))
+        return num_legacy_refs + sum(
+            sum(1 for _ in cls._read_index(version_dir)) for _, version_dir in cls._version_dirs(tbl_id))
 
     @classmethod
     def stats(cls) -> List[Tuple[int, int, int, int]]:
-        paths = glob.glob(str(Env.get().img_dir))
+        """Return (tbl_id, col_id, num_files, size) per column; size is the logical size, ie, counts shared objects
+        once per reference
+        """
         # key: (tbl_id, col_id), value: (num_files, size)
-        d: Dict[Tuple[UUID, int], List[int]] = defaultdict(lambda: [0, 0])
-        for p in paths:
-            matched = re.match(cls.pattern, Path(p).name)
-            assert matched is not None
-            tbl_id, col_id = UUID(hex=matched[1]), int(matched[2])
-            file_info = os.stat(p)
-            t = d[(tbl_id, col_id)]
-            t[0] += 1
-            t[1] += file_info.st_size
+        d: Dict[Tuple[UUID, int], List[int]] = {}
+        for tbl_entry in os.scandir(Env.get().img_dir):
+            if tbl_entry.name == cls.OBJECTS_DIR or not tbl_entry.is_dir():
+                continue
+            tbl_id = UUID(hex=tbl_entry.name)
+            for col_id, version_dir in cls._version_dirs(tbl_id):
+                t = d.setdefault((tbl_id, col_id), [0, 0])
+                for _, size in cls._read_index(version_dir):
+                    t[0] += 1
+                    t[1] += size
+        for tbl_id, refs in cls._get_legacy_refs().items():
+            for col_id, _, path in refs:
+                t = d.setdefault((tbl_id, col_id), [0, 0])
+                t[0] += 1
+                t[1] += os.stat(path).st_size
         result = [(tbl_id, col_id, num_files, size) for (tbl_id, col_id), (num_files, size) in d.items()]
         result.sort(key=lambda e: e[3], reverse=True)
         return result
@@ -0,0 +1,212 @@
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+from pathlib import Path
+import itertools
+
+import numpy as np
+import pandas as pd
+
+from pixeltable import exceptions as exc
+from pixeltable.catalog.column import Column
+from pixeltable.type_system import ColumnType
+
+# number of rows that are read and validated at a time
+BATCH_SIZE = 8192
+
+# column data of a batch: a pyarrow.Array, a pandas.Series or a list of Python values
+ColumnData = Any
+
+# pandas.api.types.infer_dtype() results that are valid for a scalar column type, if they're also valid literals
+_PANDAS_DTYPES = {
+    ColumnType.Type.STRING: {'string', 'empty'},
+    ColumnType.Type.INT: {'integer', 'empty'},
+    ColumnType.Type.FLOAT: {'floating', 'empty'},
+    ColumnType.Type.BOOL: {'boolean', 'empty'},
+    ColumnType.Type.TIMESTAMP: {'datetime64', 'datetime', 'date', 'empty'},
+}
+
+
+def _import_pyarrow() -> Any:
+    try:
+        import pyarrow
+        return pyarrow
+    except ImportError:
+        raise exc.Error('Reading Arrow data, Parquet and CSV files requires pyarrow (pip install pyarrow)')
+
+
+def _is_arrow(source: Any) -> bool:
+    try:
+        import pyarrow as pa
+    except ImportError:
+        return False
+    return isinstance(source, (pa.Table, pa.RecordBatch, pa.RecordBatchReader))
+
+
+def read_source(
+        source: Any, col_names: Optional[List[str]], default_col_names: List[str], batch_size: int
+) -> Tuple[List[str], Iterator[List[ColumnData]]]:
+    """Return the names of the columns supplied by source and an iterator over batches of their data.
+
+    Each batch contains one ColumnData per column, each with at most batch_size values.
+
+    Args:
+        source: an iterable of rows (lists of values), a pandas.DataFrame, a pyarrow Table/RecordBatch/
+            RecordBatchReader or the path of a Parquet or CSV file
+        col_names: the columns to read; for an iterable of rows, the columns present in each row
+        default_col_names: the columns present in rows of an iterable, if col_names isn't given
+    """
+    if isinstance(source, (str, Path)):
+        return _read_file(Path(source), col_names, batch_size)
+    if isinstance(source, pd.DataFrame):
+        col_names = _check_source_cols(list(source.columns), col_names)
+        return col_names, (
+            [source[name].iloc[start:start + batch_size] for name in col_names]
+            for start in range(0, len(source), batch_size))
+    if _is_arrow(source):
+        return _read_arrow(source, col_names, batch_size)
+    if isinstance(source, Iterable):
+        if col_names is None:
+            col_names = default_col_names
+        return col_names, _read_rows(iter(source), len(col_names), batch_size)
+    raise exc.Error(f'Cannot insert data from a source of type {type(source).__name__}')
+
+
+def _check_source_cols(source_col_names: List[str], col_names: Optional[List[str]]) -> List[str]:
+    if col_names is None:
+        return source_col_names
+    missing = [name for name in col_names if name not in source_col_names]
+    if len(missing) > 0:
+        raise exc.Error(f'Columns not found in data: {", ".join(missing)}')
+    return col_names
+
+
+def _read_rows(rows: Iterator[Any], num_cols: int, batch_size: int) -> Iterator[List[ColumnData]]:
+    row_idx = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if len(batch) == 0:
+            return
+        for i, row in enumerate(batch):
+            if not isinstance(row, (list, tuple)):
+                raise exc.Error(f'Row {row_idx + i}: expected a list of column values, got {type(row).__name__}')
+            if len(row) != num_cols:
+                raise exc.Error(f'Row {row_idx + i}: expected {num_cols} column values, got {len(row)}')
+        row_idx += len(batch)
+        # transpose into columns
+        yield [list(col_vals) for col_vals in zip(*batch)]
+
+
+def _read_arrow(source: Any, col_names: Optional[List[str]], batch_size: int) -> Tuple[List[str], Iterator]:
+    pa = _import_pyarrow()
+    col_names = _check_source_cols(source.schema.names, col_names)
+    if isinstance(source, pa.Table):
+        batches = source.select(col_names).to_batches(max_chunksize=batch_size)
+    elif isinstance(source, pa.RecordBatch):
+        batches = [source]
+    else:
+        batches = source
+    return col_names, _read_batches(batches, col_names, batch_size)
+
+
+def _read_batches(batches: Iterable[Any], col_names: List[str], batch_size: int) -> Iterator[List[ColumnData]]:
+    for batch in batches:
+        # batches of a reader or a RecordBatch can be larger than batch_size
+        for start in range(0, batch.num_rows, batch_size):
+            chunk = batch.slice(start, batch_size)
+            yield [chunk.column(chunk.schema.get_field_index(name)) for name in col_names]
+
+
+def _read_file(path: Path, col_names: Optional[List[str]], batch_size: int) -> Tuple[List[str], Iterator]:
+    _import_pyarrow()
+    if not path.is_file():
+        raise exc.Error(f'File not found: {path}')
+    suffixes = [s.lower() for s in path.suffixes]
+    if '.parquet' in suffixes or '.pq' in suffixes:
+        import pyarrow.parquet as pq
+        f = pq.ParquetFile(path)
+        col_names = _check_source_cols(f.schema_arrow.names, col_names)
+        # only the requested columns are read from the file
+        return col_names, _read_batches(f.iter_batches(batch_size=batch_size, columns=col_names), col_names, batch_size)
+    if '.csv' in suffixes:
+        import pyarrow.csv as csv
+        options = csv.ConvertOptions(include_columns=col_names) if col_names is not None else None
+        reader = csv.open_csv(path, convert_options=options)
+        return _read_arrow(reader, col_names, batch_size)
+    raise exc.Error(f'Unsupported file type (expected .parquet or .csv): {path}')
+
+
+def validate_column(col: Column, data: ColumnData, start_row_idx: int) -> List[Any]:
+    """Validate the values in data against col's type and return them as a list of Python values.
+
+    Arrow arrays and pandas Series whose type matches a scalar column type are validated without looking at
+    individual values; everything else is validated value by value.
+    """
+    col_type = col.col_type
+    if isinstance(data, pd.Series):
+        vals, is_valid = _from_pandas(col_type, data)
+    elif isinstance(data, list):
+        vals, is_valid = data, False
+    else:
+        vals, is_valid = _from_arrow(col_type, data)
+
+    if is_valid:
+        if not col_type.nullable:
+            null_idxs = [i for i, val in enumerate(vals) if val is None] if _has_nulls(data) else []
+            if len(null_idxs) > 0:
+                raise exc.Error(
+                    f'Column {col.name}: row {start_row_idx + null_idxs[0]} contains None for a non-nullable column')
+        return vals
+
+    for i, val in enumerate(vals):
+        if val is None:
+            if not col_type.nullable:
+                raise exc.Error(f'Column {col.name}: row {start_row_idx + i} contains None for a non-nullable column')
+            continue
+        try:
+            col_type.validate_literal(val)
+        except TypeError as e:
+            raise exc.Error(f'Column {col.name} in row {start_row_idx + i}: {e}')
+    return vals
+
+
+def _has_nulls(data: ColumnData) -> bool:
+    if isinstance(data, pd.Series):
+        return bool(data.isna().any())
+    return data.null_count > 0
+
+
+def _from_pandas(col_type: ColumnType, data: pd.Series) -> Tuple[List[Any], bool]:
+    """Returns the values of data and whether they are known to be valid literals of col_type, nulls aside"""
+    dtype = pd.api.types.infer_dtype(data, skipna=True)
+    if col_type._type not in _PANDAS_DTYPES or dtype not in _PANDAS_DTYPES[col_type._type]:
+        return [None if _is_na(val) else val for val in data.tolist()], False
+    has_nulls = bool(data.isna().any())
+    if col_type.is_timestamp_type() and dtype == 'datetime64':
+        vals = [None if val is pd.NaT else val for val in data.array.to_pydatetime().tolist()]
+    else:
+        # tolist() converts numpy scalars into Python scalars
+        vals = data.astype(object).where(data.notna(), None).tolist() if has_nulls else data.tolist()
+    return vals, True
+
+
+def _is_na(val: Any) -> bool:
+    # pd.isna() is elementwise for array-likes
+    return val is None or (np.isscalar(val) and bool(pd.isna(val)))
+
+
+def _from_arrow(col_type: ColumnType, data: Any) -> Tuple[List[Any], bool]:
+    """Returns the values of data and whether they are known to be valid literals of col_type, nulls aside"""
+    import pyarrow as pa
+    arrow_type = data.type
+    if col_type.is_array_type() and (pa.types.is_list(arrow_type) or pa.types.is_fixed_size_list(arrow_type)):
+        # arrays are stored as (nested) lists
+        dtype = col_type.numpy_dtype()
+        return [None if val is None else np.array(val, dtype=dtype) for val in data.to_pylist()], False
+    is_valid = (
+        (col_type.is_string_type() and (pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type)))
+        or (col_type.is_int_type() and pa.types.is_integer(arrow_type))
+        or (col_type.is_float_type() and pa.types.is_floating(arrow_type))
+        or (col_type.is_bool_type() and pa.types.is_boolean(arrow_type))
+        or (col_type.is_timestamp_type() and (pa.types.is_timestamp(arrow_type) or pa.types.is_date(arrow_type)))
+        or pa.types.is_null(arrow_type)
+    )
+    return data.to_pylist(), is_valid
@@ -1,13 +1,59 @@
 from typing import Any
+from pathlib import Path
+
+from pixeltable.env import Env
+
+# objects up to this size are fetched with a single GET, without multipart machinery
+SINGLE_GET_THRESHOLD = 8 * 1024 * 1024
+# (max object size, part size, max concurrency) for multipart downloads
+_TRANSFER_TIERS = [
+    (256 * 1024 ** 2, 8 * 1024 ** 2, 4),
+    (2 * 1024 ** 3, 16 * 1024 ** 2, 8),
+    (None, 64 * 1024 ** 2, 16),
+]
+# the download threads share the client's connection pool
+MAX_POOL_CONNECTIONS = 128
+_CHUNK_SIZE = 1024 * 1024
 
 
 def get_client() -> Any:
     import boto3
     import botocore
+    endpoint_url = Env.get().s3_endpoint_url
     try:
         boto3.Session().get_credentials().get_frozen_credentials()
-        return boto3.client('s3')  # credentials are available
+        config = botocore.config.Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+        return boto3.client('s3', endpoint_url=endpoint_url, config=config)  # credentials are available
     except AttributeError:
         # No credentials available, use unsigned mode
-        config = botocore.config.Config(signature_version=botocore.UNSIGNED)
-        return boto3.client('s3', config=config)
\ No newline at end of file
+        config = botocore.config.Config(
+            signature_version=botocore.UNSIGNED, max_pool_connections=MAX_POOL_CONNECTIONS)
+        return boto3.client('s3', endpoint_url=endpoint_url, config=config)
+
+
+def transfer_config(size: int) -> Any:
+    """Return a TransferConfig for a multipart download of an object of the given size"""
+    from boto3.s3.transfer import TransferConfig
+    for max_size, part_size, max_concurrency in _TRANSFER_TIERS:
+        if max_size is None or size <= max_size:
+            break
+    return TransferConfig(
+        multipart_threshold=part_size, multipart_chunksize=part_size, max_concurrency=max_concurrency,
+        max_bandwidth=Env.get().s3_max_bandwidth, use_threads=True)
+
+
+def download(client: Any, bucket: str, key: str, path: Path) -> None:
+    """Download s3://bucket/key to path.
+
+    The object size (from a HEAD request) determines the download path: small objects are streamed into path from a
+    single GET; larger ones are downloaded in parallel parts, with a part size and concurrency that depend on the
+    object size.
+    """
+    size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+    if size > SINGLE_GET_THRESHOLD:
+        client.download_file(bucket, key, str(path), Config=transfer_config(size))
+        return
+    response = client.get_object(Bucket=bucket, Key=key)
+    with open(path, 'wb') as f:
+        for chunk in response['Body'].iter_chunks(chunk_size=_CHUNK_SIZE):
+            f.write(chunk)
@@ -0,0 +1,98 @@
+from __future__ import annotations
+from typing import Optional, Dict, Any
+
+import numpy as np
+import sqlalchemy as sql
+
+from pixeltable import exceptions as exc
+
+
+class VectorIndex:
+    """
+    Nearest-neighbor index of the embeddings of an indexed column, maintained by pgvector.
+
+    Parameters (all optional):
+    - type: 'hnsw' (default) or 'ivfflat'
+    - metric: distance function that nearest() orders by: 'l2' (default), 'cosine' or 'ip' (negative inner product);
+      the index is built with the matching operator class
+    - m, ef_construction: HNSW build parameters (pgvector defaults: 16, 64)
+    - lists: IVFFlat build parameter (default: 100)
+    - ef_search: HNSW query parameter (pgvector default: 40)
+    - probes: IVFFlat query parameter (pgvector default: 1)
+    - embedded: if True, also maintains an in-process HNSW index (see EmbeddedIndex), which answers nearest() queries
+      against the live table without a vector search in Postgres; m, ef_construction and ef_search apply to both
+
+    HNSW indexes are updated incrementally as rows are added. IVFFlat indexes assign new rows to the lists that were
+    trained on the rows present when the index was built: they work best for columns that are added to tables
+    that are already populated. For empty tables, the IVFFlat index is only built by the first insert.
+    """
+    HNSW = 'hnsw'
+    IVFFLAT = 'ivfflat'
+    TYPES = [HNSW, IVFFLAT]
+    # metric -> (operator class, name of the pgvector.sqlalchemy.Vector comparator method)
+    METRICS = {
+        'l2': ('vector_l2_ops', 'l2_distance'),
+        'cosine': ('vector_cosine_ops', 'cosine_distance'),
+        'ip': ('vector_ip_ops', 'max_inner_product'),
+    }
+    # parameter -> index types it applies to
+    BUILD_PARAMS = {'m': [HNSW], 'ef_construction': [HNSW], 'lists': [IVFFLAT]}
+    QUERY_PARAMS = {'ef_search': [HNSW], 'probes': [IVFFLAT]}
+    DEFAULT_LISTS = 100
+
+    def __init__(self, type: str = HNSW, metric: str = 'l2', embedded: bool = False, **params: int):
+        if type not in self.TYPES:
+            raise exc.Error(f'Unknown index type: {type} (valid types: {", ".join(self.TYPES)})')
+        if metric not in self.METRICS:
+            raise exc.Error(f'Unknown index metric: {metric} (valid metrics: {", ".join(self.METRICS.keys())})')
+        if not isinstance(embedded, bool):
+            raise exc.Error(f'Index parameter embedded needs to be a bool: {embedded}')
+        if embedded and type != self.HNSW:
+            raise exc.Error(f'Index parameter embedded only applies to index type {self.HNSW}')
+        for name, val in params.items():
+            valid_types = self.BUILD_PARAMS.get(name, self.QUERY_PARAMS.get(name))
+            if valid_types is None:
+                raise exc.Error(f'Unknown index parameter: {name}')
+            if type not in valid_types:
+                raise exc.Error(f'Index parameter {name} only applies to index type {valid_types[0]}')
+            if not isinstance(val, int) or val < 1:
+                raise exc.Error(f'Index parameter {name} needs to be a positive integer: {val}')
+        self.type = type
+        self.metric = metric
+        self.embedded = embedded
+        self.params = params
+
+    @classmethod
+    def from_dict(cls, d: Optional[Dict[str, Any]]) -> VectorIndex:
+        return cls(**d) if d is not None else cls()
+
+    def as_dict(self) -> Dict[str, Any]:
+        result = {'type': self.type, 'metric': self.metric, **self.params}
+        if self.embedded:
+            result['embedded'] = True
+        return result
+
+    @property
+    def is_trained(self) -> bool:
+        """True if the index is trained on the rows present at build time (and is useless without any)"""
+        return self.type == self.IVFFLAT
+
+    @property
+    def ops(self) -> str:
+        """The pgvector operator class of the index"""
+        return self.METRICS[self.metric][0]
+
+    def build_params(self) -> Dict[str, int]:
+        """Returns the storage parameters of the CREATE INDEX statement"""
+        result = {name: val for name, val in self.params.items() if name in self.BUILD_PARAMS}
+        if self.type == self.IVFFLAT and 'lists' not in result:
+            result['lists'] = self.DEFAULT_LISTS
+        return result
+
+    def query_settings(self) -> Dict[str, int]:
+        """Returns the settings that need to be in effect for a query, as {pgvector setting: value}"""
+        return {f'{self.type}.{name}': val for name, val in self.params.items() if name in self.QUERY_PARAMS}
+
+    def distance(self, sa_col: sql.Column, embedding: np.ndarray) -> sql.sql.expression.ClauseElement:
+        """Returns the expression that orders rows by proximity to embedding; this is what the index accelerates"""
+        return getattr(sa_col, self.METRICS[self.metric][1])(embedding)
@@ -1,13 +1,26 @@
 from __future__ import annotations
+import abc
+import bisect
+import dataclasses
+import fractions
+import functools
+import hashlib
+import json
 import math
-from typing import Optional, Tuple
+import os
+import shutil
+import subprocess
+import threading
+from typing import Optional, Tuple, List, Dict, Any
+from collections import OrderedDict
 from collections.abc import Iterator
 from pathlib import Path
+from uuid import UUID
 import logging
 import cv2
+import numpy as np
 
 import PIL
-import docker
 
 from pixeltable.exceptions import Error
 from pixeltable.env import Env
@@ -15,26 +28,563 @@ from pixeltable.env import Env
 
 _logger = logging.getLogger('pixeltable')
 
-def convert_to_h264(input_path: Path, output_path: Path) -> None:
-    """Converts a video to H.264 format by running a docker image.
+# frame extraction modes
+EXTRACT_FPS = 'fps'  # frames at a fixed rate
+EXTRACT_KEYFRAMES = 'keyframes'  # the keyframes of the video
+EXTRACT_SCENES = 'scenes'  # the first frame of each scene
+EXTRACTION_MODES = [EXTRACT_FPS, EXTRACT_KEYFRAMES, EXTRACT_SCENES]
+
+# a frame starts a new scene if the mean absolute difference of its downscaled luma to that of the preceding frame
+# exceeds this fraction of the value range
+SCENE_CHANGE_THRESHOLD = 0.1
+# (width, height) of the luma images that are compared for scene detection
+SCENE_DETECTION_SIZE = (64, 36)
+
+class VideoEncoder:
+    """
+    Streaming H.264/MP4 encoder: frames are encoded as they're written.
+
+    The encoder is PyAV, if it's installed and has libx264, otherwise a local ffmpeg binary that receives raw frames
+    through a pipe.
+    Without either, frames are written with cv2's MPEG-4 Part 2 ('mp4v') codec, which many players don't support.
+    H.264 requires even frame dimensions: odd dimensions are rounded down.
+    """
+    DEFAULT_FPS = 25
+
+    def __init__(self, path: Path, fps: float, size: Tuple[int, int]):
+        self.path = path
+        self.size = size
+        width, height = size[0] - size[0] % 2, size[1] - size[1] % 2
+        self.container: Optional[Any] = None  # PyAV
+        self.stream: Optional[Any] = None
+        self.process: Optional[subprocess.Popen] = None  # ffmpeg
+        self.video_writer: Optional[cv2.VideoWriter] = None
+        try:
+            import av
+        except ImportError:
+            av = None
+        if av is not None:
+            container = av.open(str(path), mode='w')
+            try:
+                stream = container.add_stream('libx264', rate=fractions.Fraction(fps).limit_denominator(10000))
+                stream.width, stream.height = width, height
+                stream.pix_fmt = 'yuv420p'
+                self.container, self.stream = container, stream
+                return
+            except (av.error.FFmpegError, ValueError) as e:
+                # eg, a PyAV build without libx264 (UnknownCodecError)
+                container.close()
+                _logger.debug(f'VideoEncoder: PyAV cannot encode H.264: {e}')
+        ffmpeg_path = shutil.which('ffmpeg')
+        if ffmpeg_path is not None:
+            command = [
+                ffmpeg_path, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                '-s', f'{size[0]}x{size[1]}', '-r', str(fps), '-i', '-',
+                '-vf', f'crop={width}:{height}:0:0', '-c:v', 'libx264', '-pix_fmt', 'yuv420p', str(path),
+            ]
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+            return
+        _logger.warning('Neither PyAV nor ffmpeg are available: writing video with the mp4v codec instead of H.264')
+        self.video_writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+
+    def write(self, img: PIL.Image.Image) -> None:
+        if img.size != self.size:
+            img = img.resize(self.size)
+        frame_array = np.asarray(img.convert('RGB'))
+        if self.container is not None:
+            import av
+            frame = av.VideoFrame.from_ndarray(frame_array[:self.stream.height, :self.stream.width], format='rgb24')
+            for packet in self.stream.encode(frame):
+                self.container.mux(packet)
+        elif self.process is not None:
+            self.process.stdin.write(frame_array.tobytes())
+        else:
+            self.video_writer.write(cv2.cvtColor(frame_array, cv2.COLOR_RGB2BGR))
+
+    def close(self) -> None:
+        if self.container is not None:
+            # flush the encoder
+            for packet in self.stream.encode():
+                self.container.mux(packet)
+            self.container.close()
+            self.container = None
+        elif self.process is not None:
+            self.process.stdin.close()
+            returncode = self.process.wait()
+            self.process = None
+            if returncode != 0:
+                raise Error(f'ffmpeg failed to encode {self.path} (exit code {returncode})')
+        elif self.video_writer is not None:
+            self.video_writer.release()
+            self.video_writer = None
+
+
+def probe(video_path_str: str) -> Dict[str, Any]:
+    """Returns the metadata of a video, from the container and stream headers (no frames are decoded).
+
+    Keys: duration (in seconds), fps, width, height, num_frames, codec (the FourCC, such as 'avc1' or 'VP90') and
+    bitrate (in bits per second).
+    """
+    video_reader = cv2.VideoCapture(video_path_str)
+    try:
+        if not video_reader.isOpened():
+            raise Error(f'Failed to open video: {video_path_str}')
+        video_fps = video_reader.get(cv2.CAP_PROP_FPS)
+        num_video_frames = int(video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+        if num_video_frames == 0:
+            raise Error(f'Video {video_path_str}: failed to get number of frames')
+        fourcc = int(video_reader.get(cv2.CAP_PROP_FOURCC))
+        # in kbit/s; 0 if the container doesn't record it
+        bitrate = int(video_reader.get(cv2.CAP_PROP_BITRATE) * 1000)
+        width = int(video_reader.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(video_reader.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        video_reader.release()
+    duration = num_video_frames / video_fps if video_fps > 0 else None
+    if bitrate <= 0 and duration:
+        bitrate = int(os.stat(video_path_str).st_size * 8 / duration)
+    codec = fourcc.to_bytes(4, 'little').decode('ascii', errors='replace').strip('\x00 ') if fourcc > 0 else None
+    return {
+        'duration': duration, 'fps': video_fps, 'width': width, 'height': height, 'num_frames': num_video_frames,
+        'codec': codec or None, 'bitrate': bitrate if bitrate > 0 else None,
+    }
+
+
+def _frame_freq(video_path_str: str, video_fps: int, fps: int) -> int:
+    """Returns the number of video frames per extracted frame"""
+    if fps > video_fps:
+        raise Error(f'Video {video_path_str}: requested fps ({fps}) exceeds that of the video ({video_fps})')
+    return int(video_fps / fps) if fps > 0 else 1
+
+
+@functools.lru_cache(maxsize=1024)
+def _video_rate(video_path_str: str, mtime_ns: int) -> Tuple[float, int]:
+    """Returns the exact fps and the number of frames of a video"""
+    video_reader = cv2.VideoCapture(video_path_str)
+    try:
+        if not video_reader.isOpened():
+            raise Error(f'Failed to open video: {video_path_str}')
+        return video_reader.get(cv2.CAP_PROP_FPS), int(video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        video_reader.release()
+
+
+def get_frame_rate(
+        video_path_str: str, fps: int = 0, mode: str = EXTRACT_FPS, tbl_id: Optional[UUID] = None) -> float:
+    """Returns the number of frames per second of video time that are extracted with the given fps and mode.
+
+    For modes other than EXTRACT_FPS this is the average rate.
+    """
+    video_fps, num_video_frames = _video_rate(video_path_str, os.stat(video_path_str).st_mtime_ns)
+    positions = get_frame_positions(video_path_str, mode, tbl_id)
+    if positions is not None:
+        return len(positions) * video_fps / max(num_video_frames, 1)
+    return video_fps / _frame_freq(video_path_str, int(video_fps), fps)
+
+
+def get_frame_positions(video_path_str: str, mode: str, tbl_id: Optional[UUID]) -> Optional[List[int]]:
+    """Returns the idxs of the video frames that are extracted in the given mode, or None for EXTRACT_FPS.
+
+    The positions are computed once per video and stored in the KeyframeIndex of tbl_id.
+    """
+    if mode == EXTRACT_FPS:
+        return None
+    assert tbl_id is not None
+    if mode == EXTRACT_KEYFRAMES:
+        positions = KeyframeIndex.get(tbl_id, video_path_str)
+        if positions is None:
+            raise Error(f'Video {video_path_str}: failed to read keyframes (extracting keyframes requires PyAV)')
+        return positions
+    assert mode == EXTRACT_SCENES
+    return KeyframeIndex.get_scenes(tbl_id, video_path_str)
+
+
+def detect_scenes(video_path_str: str, threshold: float = SCENE_CHANGE_THRESHOLD) -> List[int]:
+    """Returns the idxs of the frames that start a new scene; frame 0 always does.
+
+    Every frame is decoded, but only its luma plane is converted, at SCENE_DETECTION_SIZE. With PyAV, the
+    scaling happens in YUV space and decoding is multi-threaded.
+    """
+    try:
+        import av
+    except ImportError:
+        av = None
+    scenes: List[int] = []
+    prev_luma: Optional[np.ndarray] = None
+
+    def add_frame(frame_idx: int, luma: np.ndarray) -> None:
+        nonlocal prev_luma
+        if prev_luma is None or cv2.absdiff(luma, prev_luma).mean() / 255 > threshold:
+            scenes.append(frame_idx)
+        prev_luma = luma
+
+    if av is not None:
+        try:
+            with av.open(video_path_str) as container:
+                stream = container.streams.video[0]
+                stream.thread_type = 'AUTO'
+                width, height = SCENE_DETECTION_SIZE
+                for frame_idx, frame in enumerate(container.decode(stream)):
+                    add_frame(frame_idx, frame.reformat(width=width, height=height, format='gray').to_ndarray())
+            return scenes
+        except (av.error.FFmpegError, IndexError) as e:
+            raise Error(f'Failed to detect scenes in {video_path_str}: {e}')
+
+    video_reader = cv2.VideoCapture(video_path_str)
+    try:
+        if not video_reader.isOpened():
+            raise Error(f'Failed to open video: {video_path_str}')
+        frame_idx = 0
+        while video_reader.grab():
+            status, img = video_reader.retrieve()
+            if not status:
+                break
+            luma = cv2.cvtColor(cv2.resize(img, SCENE_DETECTION_SIZE, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+            add_frame(frame_idx, luma)
+            frame_idx += 1
+    finally:
+        video_reader.release()
+    return scenes
+
+
+def count_frames(
+        video_path_str: str, fps: int = 0, mode: str = EXTRACT_FPS, tbl_id: Optional[UUID] = None,
+        md: Optional[Dict[str, Any]] = None
+) -> int:
+    """Returns the number of frames that are extracted with the given fps and mode.
+
+    For EXTRACT_FPS this doesn't decode any frames; md is the result of probe(), if the caller already has it.
+    """
+    positions = get_frame_positions(video_path_str, mode, tbl_id)
+    if positions is not None:
+        return len(positions)
+    if md is None:
+        md = probe(video_path_str)
+    frame_freq = _frame_freq(video_path_str, int(md['fps']), fps)
+    # ceil: round up to ensure we count frame 0
+    return math.ceil(md['num_frames'] / frame_freq)
+
+
+class KeyframeIndex:
+    """
+    Per-table index of the keyframes of videos, stored in Env.keyframe_dir/<table id>/<hash of the video path>.json
+
+    An index lists the idxs of the keyframes of a video (in terms of video frames, not extracted frames) and records
+    the size and mtime of the video file; it is rebuilt if the file changes. Building an index demuxes the container
+    without decoding any frames and requires PyAV; without it, no index is available.
+    The index also stores the scene starts of the video (see detect_scenes()), once they've been requested.
+    """
+    _MAX_CACHED = 1024
+    KEYFRAMES = 'keyframes'
+    SCENES = 'scenes'
+
+    # key: (tbl_id, video path, size, mtime, entry), value: frame idxs
+    _cache: OrderedDict[Tuple[UUID, str, int, int, str], Optional[List[int]]] = OrderedDict()
+    _lock = threading.Lock()
+
+    @classmethod
+    def _path(cls, tbl_id: UUID, video_path_str: str) -> Path:
+        return Env.get().keyframe_dir / tbl_id.hex / f'{hashlib.sha256(video_path_str.encode()).hexdigest()}.json'
+
+    @classmethod
+    def get(cls, tbl_id: UUID, video_path_str: str) -> Optional[List[int]]:
+        """Returns the keyframe idxs of the video, or None if they can't be determined"""
+        return cls._get(tbl_id, video_path_str, cls.KEYFRAMES)
+
+    @classmethod
+    def get_scenes(cls, tbl_id: UUID, video_path_str: str) -> List[int]:
+        """Returns the idxs of the frames of the video that start a new scene"""
+        return cls._get(tbl_id, video_path_str, cls.SCENES)
+
+    @classmethod
+    def _get(cls, tbl_id: UUID, video_path_str: str, entry: str) -> Optional[List[int]]:
+        stat = os.stat(video_path_str)
+        key = (tbl_id, video_path_str, stat.st_size, stat.st_mtime_ns, entry)
+        with cls._lock:
+            if key in cls._cache:
+                cls._cache.move_to_end(key)
+                return cls._cache[key]
+
+        index_path = cls._path(tbl_id, video_path_str)
+        md = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+        try:
+            with open(index_path) as f:
+                stored_md = json.load(f)
+            if stored_md['size'] == stat.st_size and stored_md['mtime'] == stat.st_mtime_ns:
+                md = stored_md
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        idxs: Optional[List[int]] = md.get(entry)
+        if idxs is None:
+            idxs = cls.build(video_path_str) if entry == cls.KEYFRAMES else detect_scenes(video_path_str)
+            if idxs is not None:
+                md[entry] = idxs
+                index_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = index_path.with_suffix(f'.{os.getpid()}_{threading.get_ident()}.tmp')
+                with open(tmp_path, 'w') as f:
+                    json.dump(md, f)
+                os.replace(tmp_path, index_path)
+
+        with cls._lock:
+            cls._cache[key] = idxs
+            if len(cls._cache) > cls._MAX_CACHED:
+                cls._cache.popitem(last=False)
+        return idxs
+
+    @classmethod
+    def build(cls, video_path_str: str) -> Optional[List[int]]:
+        """Returns the sorted keyframe idxs of the video, or None if PyAV isn't available"""
+        try:
+            import av
+        except ImportError:
+            return None
+        try:
+            keyframes = set()
+            with av.open(video_path_str) as container:
+                stream = container.streams.video[0]
+                if stream.average_rate is None:
+                    return None
+                start_time = stream.start_time or 0
+                # only packet headers are read
+                for packet in container.demux(stream):
+                    if packet.is_keyframe and packet.pts is not None:
+                        # the same mapping of timestamps to frame idxs as the one cv2 uses for seeking
+                        keyframes.add(round(float((packet.pts - start_time) * stream.time_base * stream.average_rate)))
+            return sorted(keyframes) if len(keyframes) > 0 else None
+        except (av.error.FFmpegError, IndexError) as e:
+            _logger.debug(f'Failed to build keyframe index for {video_path_str}: {e}')
+            return None
+
+    @classmethod
+    def delete(cls, tbl_id: UUID) -> None:
+        """Delete all keyframe indices of tbl_id"""
+        shutil.rmtree(Env.get().keyframe_dir / tbl_id.hex, ignore_errors=True)
+        with cls._lock:
+            for key in [key for key in cls._cache if key[0] == tbl_id]:
+                del cls._cache[key]
+
+
+@dataclasses.dataclass(frozen=True)
+class DecoderConfig:
+    """
+    Selects and configures the VideoDecoder used for frame extraction.
+
+    backend: 'opencv' (cv2.VideoCapture) or 'pyav'
+    thread_type, thread_count: PyAV only; 'FRAME' (decode several frames in parallel), 'SLICE' (decode the slices of
+        a frame in parallel) or 'AUTO' (both); thread_count 0 means one thread per core
+    size: (width, height) to which frames are scaled; with PyAV, scaling happens before the conversion to RGB
+    """
+    OPENCV = 'opencv'
+    PYAV = 'pyav'
+    BACKENDS = [OPENCV, PYAV]
+    THREAD_TYPES = ['NONE', 'SLICE', 'FRAME', 'AUTO']
+
+    backend: str = OPENCV
+    thread_type: str = 'AUTO'
+    thread_count: int = 0
+    size: Optional[Tuple[int, int]] = None
+
+    @classmethod
+    def from_dict(cls, d: Optional[Dict[str, Any]]) -> DecoderConfig:
+        """Create a validated DecoderConfig from a dict of parameters (None: the default config)"""
+        if d is None:
+            return cls()
+        field_names = [f.name for f in dataclasses.fields(cls)]
+        unknown = [key for key in d if key not in field_names]
+        if len(unknown) > 0:
+            raise Error(f'Unknown decoder parameter(s): {", ".join(unknown)}')
+        config = cls(**{**d, 'size': tuple(d['size']) if d.get('size') is not None else None})
+        if config.backend not in cls.BACKENDS:
+            raise Error(f'Decoder backend must be one of {", ".join(cls.BACKENDS)}, got {config.backend!r}')
+        if config.thread_type not in cls.THREAD_TYPES:
+            raise Error(f'Decoder thread_type must be one of {", ".join(cls.THREAD_TYPES)}, got {config.thread_type!r}')
+        if not isinstance(config.thread_count, int) or config.thread_count < 0:
+            raise Error(f'Decoder thread_count must be a non-negative int, got {config.thread_count!r}')
+        if config.size is not None and \
+                (len(config.size) != 2 or not all(isinstance(v, int) and v > 0 for v in config.size)):
+            raise Error(f'Decoder size must be (width, height), got {d["size"]!r}')
+        if config.backend == cls.PYAV:
+            try:
+                import av
+            except ImportError:
+                raise Error('Decoder backend pyav requires PyAV (pip install av)')
+        return config
+
+    def as_dict(self) -> Dict[str, Any]:
+        return dataclasses.asdict(self)
+
+    @property
+    def output_key(self) -> str:
+        """Identifies the frames the decoder returns: backends convert colors differently"""
+        return self.backend if self.size is None else f'{self.backend}:{self.size[0]}x{self.size[1]}'
+
+    def create(self, video_path_str: str) -> VideoDecoder:
+        if self.backend == self.PYAV:
+            return PyAVDecoder(video_path_str, self)
+        return OpenCVDecoder(video_path_str, self)
+
+
+class VideoDecoder(abc.ABC):
+    """
+    Decodes the frames of a video in order, starting at frame 0 or at the position of the last seek().
+
+    grab() decodes the next frame and retrieve() converts the last grabbed frame into an RGB image, so that frames
+    that aren't needed can be skipped without paying for the conversion.
     """
-    cl = docker.from_env()
-    command = ['-i', f'/input/{input_path.name}', '-vcodec', 'libx264', f'/output/{output_path.name}']
-    volumes = [f'{input_path.parent}:/input', f'{output_path.parent}:/output']
-    _ = cl.containers.run(
-        Env.get().ffmpeg_image(),
-        command,
-        detach=False,
-        stderr=True,
-        volumes=volumes,
-    )
+    def __init__(self, video_path_str: str, config: DecoderConfig):
+        self.video_path_str = video_path_str
+        self.config = config
+        self.fps = 0.0
+        self.num_frames = 0
+
+    @abc.abstractmethod
+    def grab(self) -> Optional[int]:
+        """Decodes the next frame and returns its idx, or None at the end of the video"""
+        pass
+
+    @abc.abstractmethod
+    def retrieve(self) -> Optional[PIL.Image.Image]:
+        """Returns the last grabbed frame"""
+        pass
+
+    @abc.abstractmethod
+    def seek(self, video_frame_idx: int) -> None:
+        """The next grab() returns video frame video_frame_idx"""
+        pass
+
+    @abc.abstractmethod
+    def close(self) -> None:
+        pass
+
+
+class OpenCVDecoder(VideoDecoder):
+    """Decoder based on cv2.VideoCapture, which decodes in a single thread and converts frames via BGR"""
+    def __init__(self, video_path_str: str, config: DecoderConfig):
+        super().__init__(video_path_str, config)
+        self.video_reader = cv2.VideoCapture(video_path_str)
+        if not self.video_reader.isOpened():
+            raise Error(f'Failed to open video: {video_path_str}')
+        self.fps = self.video_reader.get(cv2.CAP_PROP_FPS)
+        self.num_frames = int(self.video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+        # idx of the video frame that the next grab() returns
+        self.pos = 0
+
+    def grab(self) -> Optional[int]:
+        if not self.video_reader.grab():
+            return None
+        self.pos += 1
+        return self.pos - 1
+
+    def retrieve(self) -> Optional[PIL.Image.Image]:
+        status, img = self.video_reader.retrieve()
+        if not status:
+            return None
+        if self.config.size is not None:
+            img = cv2.resize(img, self.config.size, interpolation=cv2.INTER_AREA)
+        return PIL.Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+
+    def seek(self, video_frame_idx: int) -> None:
+        self.video_reader.set(cv2.CAP_PROP_POS_FRAMES, video_frame_idx)
+        self.pos = video_frame_idx
+
+    def close(self) -> None:
+        self.video_reader.release()
+
+
+class PyAVDecoder(VideoDecoder):
+    """
+    Decoder based on PyAV, with multi-threaded decoding and direct conversion into RGB (at the configured size).
+
+    Frame idxs are derived from presentation timestamps in the same way as for OpenCVDecoder (and KeyframeIndex).
+    """
+    def __init__(self, video_path_str: str, config: DecoderConfig):
+        super().__init__(video_path_str, config)
+        import av
+        try:
+            self.container = av.open(video_path_str)
+            self.stream = self.container.streams.video[0]
+        except (av.error.FFmpegError, IndexError) as e:
+            raise Error(f'Failed to open video: {video_path_str}: {e}')
+        self.stream.thread_type = config.thread_type
+        self.stream.thread_count = config.thread_count
+        rate = self.stream.guessed_rate or self.stream.average_rate
+        if rate is None:
+            self.close()
+            raise Error(f'Video {video_path_str}: failed to get frame rate')
+        self.rate = rate
+        self.fps = float(rate)
+        self.start_time = self.stream.start_time or 0
+        self.num_frames = self.stream.frames
+        if self.num_frames == 0:
+            # estimate it the same way OpenCV does
+            if self.container.duration is not None:
+                duration = self.container.duration / av.time_base
+            else:
+                duration = float((self.stream.duration or 0) * self.stream.time_base)
+            self.num_frames = math.floor(duration * self.fps + 0.5)
+        self.decoded_frames: Optional[Iterator[Any]] = None
+        self.frame: Optional[Any] = None
+        # frames before this idx are skipped after a seek
+        self.min_idx = 0
+        self.next_idx = 0
+
+    def grab(self) -> Optional[int]:
+        if self.decoded_frames is None:
+            self.decoded_frames = self.container.decode(self.stream)
+        while True:
+            try:
+                frame = next(self.decoded_frames)
+            except StopIteration:
+                return None
+            if frame.pts is not None:
+                idx = round(float((frame.pts - self.start_time) * self.stream.time_base * self.rate))
+            else:
+                idx = self.next_idx
+            self.next_idx = idx + 1
+            if idx >= self.min_idx:
+                self.frame = frame
+                return idx
+
+    def retrieve(self) -> Optional[PIL.Image.Image]:
+        if self.frame is None:
+            return None
+        if self.config.size is not None:
+            width, height = self.config.size
+            return PIL.Image.fromarray(self.frame.reformat(width=width, height=height, format='rgb24').to_ndarray())
+        return PIL.Image.fromarray(self.frame.to_ndarray(format='rgb24'))
+
+    def seek(self, video_frame_idx: int) -> None:
+        # seek to the keyframe at or before the target and decode forward from there; the pts is the largest one that
+        # maps to video_frame_idx, so that seeking to a keyframe doesn't land on the preceding one
+        frame_time = (video_frame_idx + fractions.Fraction(1, 2)) / self.rate
+        pts = self.start_time + math.ceil(frame_time / self.stream.time_base) - 1
+        self.container.seek(pts, stream=self.stream, backward=True)
+        self.decoded_frames = None
+        self.frame = None
+        self.min_idx = video_frame_idx
+        self.next_idx = video_frame_idx
+
+    def close(self) -> None:
+        self.container.close()
+
 
 class FrameIterator:
     """
     Iterator over the frames of a video.
+
+    Only the selected frames (every frame_freq-th frame of the video, or the video frames listed in positions) are
+    converted into images. Frames in between are grabbed without being retrieved, and larger gaps are skipped by
+    seeking. Seeking resumes decoding at the keyframe preceding the target, and is only worth it if that keyframe lies
+    beyond the current position: with a keyframe index (see KeyframeIndex) that decision is exact, otherwise it's
+    based on SEEK_THRESHOLD.
+    Frames are decoded by the VideoDecoder that decoder selects (by default, OpenCVDecoder).
     """
+    # without a keyframe index: seek if the next selected frame is more than this many frames ahead
+    SEEK_THRESHOLD = 250
 
-    def __init__(self, video_path_str: str, fps: int = 0):
+    def __init__(
+            self, video_path_str: str, fps: int = 0, keyframes: Optional[List[int]] = None,
+            positions: Optional[List[int]] = None, decoder: Optional[DecoderConfig] = None):
         video_path = Path(video_path_str)
         if not video_path.exists():
             raise Error(f'File not found: {video_path_str}')
@@ -42,21 +592,23 @@ class FrameIterator:
             raise Error(f'Not a file: {video_path_str}')
         self.video_path = video_path
         self.fps = fps
-        self.video_reader = cv2.VideoCapture(str(video_path))
-        if not self.video_reader.isOpened():
-            raise Error(f'Failed to open video: {video_path_str}')
-        video_fps = int(self.video_reader.get(cv2.CAP_PROP_FPS))
-        if fps > video_fps:
-            raise Error(f'Video {video_path_str}: requested fps ({fps}) exceeds that of the video ({video_fps})')
-        self.frame_freq = int(video_fps / fps) if fps > 0 else 1
-        num_video_frames = int(self.video_reader.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.video_reader: Optional[VideoDecoder] = (decoder or DecoderConfig()).create(str(video_path))
+        self.frame_freq = _frame_freq(video_path_str, int(self.video_reader.fps), fps)
+        num_video_frames = self.video_reader.num_frames
         if num_video_frames == 0:
             raise Error(f'Video {video_path_str}: failed to get number of frames')
         # ceil: round up to ensure we count frame 0
-        self.num_frames = math.ceil(num_video_frames / self.frame_freq) if fps > 0 else num_video_frames
+        self.num_frames = math.ceil(num_video_frames / self.frame_freq) if positions is None else len(positions)
+        # sorted idxs of the selected video frames; None: every frame_freq-th frame
+        self.positions = positions
+        # the DecoderPool key, if the iterator belongs to the pool
+        self.pool_key: Optional[Tuple[str, int, str, DecoderConfig]] = None
         _logger.debug(f'FrameIterator: path={self.video_path} fps={self.fps}')
 
         self.next_frame_idx = 0
+        # idx of the video frame that the next grab() returns
+        self.next_video_frame_idx = 0
+        self.keyframes = keyframes
 
     def __iter__(self) -> Iterator[Tuple[int, PIL.Image.Image]]:
         return self
@@ -64,27 +616,59 @@ class FrameIterator:
     def __next__(self) -> Tuple[int, PIL.Image.Image]:
         """Returns (frame idx, image).
         """
-        while True:
-            status, img = self.video_reader.read()
-            if not status:
+        if self.video_reader is None:
+            raise StopIteration
+        if self.positions is not None and self.next_frame_idx >= len(self.positions):
+            self.close()
+            raise StopIteration
+        target_idx = self._video_frame_idx(self.next_frame_idx)
+        if target_idx != self.next_video_frame_idx and self._should_seek(target_idx):
+            self.video_reader.seek(target_idx)
+            self.next_video_frame_idx = target_idx
+        # skip over unselected frames without converting them
+        while self.next_video_frame_idx <= target_idx:
+            video_frame_idx = self.video_reader.grab()
+            if video_frame_idx is None:
                 _logger.debug(f'releasing video reader for {self.video_path}')
-                self.video_reader.release()
-                self.video_reader = None
+                self.close()
                 raise StopIteration
-            # -1: CAP_PROP_POS_FRAMES points to the next frame
-            if (self.video_reader.get(cv2.CAP_PROP_POS_FRAMES) - 1) % self.frame_freq == 0:
-                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-                result = (self.next_frame_idx, PIL.Image.fromarray(img))
-                self.next_frame_idx += 1
-                return result
+            self.next_video_frame_idx = video_frame_idx + 1
+        img = self.video_reader.retrieve()
+        if img is None:
+            self.close()
+            raise StopIteration
+        result = (self.next_frame_idx, img)
+        self.next_frame_idx += 1
+        return result
 
     def seek(self, frame_idx: int) -> None:
         """Seek to frame idx"""
         if frame_idx == self.next_frame_idx:
             return
-        _logger.debug(f'seeking to frame {frame_idx}')
-        self.video_reader.set(cv2.CAP_PROP_POS_FRAMES, frame_idx * self.frame_freq)
         self.next_frame_idx = frame_idx
+        if self.positions is not None and frame_idx >= len(self.positions):
+            # __next__() stops
+            return
+        target_idx = self._video_frame_idx(frame_idx)
+        if not self._should_seek(target_idx):
+            # __next__() grabs its way forward
+            return
+        _logger.debug(f'seeking to frame {frame_idx}')
+        self.video_reader.seek(target_idx)
+        self.next_video_frame_idx = target_idx
+
+    def _video_frame_idx(self, frame_idx: int) -> int:
+        return frame_idx * self.frame_freq if self.positions is None else self.positions[frame_idx]
+
+    def _should_seek(self, target_idx: int) -> bool:
+        """Returns True if seeking to video frame target_idx is cheaper than grabbing forward"""
+        if target_idx < self.next_video_frame_idx:
+            return True
+        if self.keyframes is None:
+            return target_idx - self.next_video_frame_idx > self.SEEK_THRESHOLD
+        # seeking resumes decoding at the last keyframe at or before target_idx
+        i = bisect.bisect_right(self.keyframes, target_idx) - 1
+        return i >= 0 and self.keyframes[i] > self.next_video_frame_idx
 
     def __len__(self) -> int:
         return self.num_frames
@@ -99,5 +683,82 @@ class FrameIterator:
 
     def close(self) -> None:
         if self.video_reader is not None:
-            self.video_reader.release()
+            self.video_reader.close()
             self.video_reader = None
+
+
+class DecoderPool:
+    """
+    LRU pool of open FrameIterators, keyed by (video path, fps, extraction mode, decoder config).
+
+    Reusing an open iterator avoids reopening the container, and a request for a frame following the previously
+    returned one continues decoding without seeking. An acquired iterator belongs to the caller until it's released.
+    """
+    MAX_OPEN = 8
+
+    _instance: Optional[DecoderPool] = None
+
+    @classmethod
+    def get(cls) -> DecoderPool:
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def __init__(self):
+        # key: (video path, fps, mode, decoder config); several iterators can be open for the same video
+        self.frames: OrderedDict[Tuple[str, int, str, DecoderConfig], List[FrameIterator]] = OrderedDict()
+        self.num_open = 0
+        self.lock = threading.Lock()
+
+    def acquire(
+            self, video_path_str: str, fps: int = 0, tbl_id: Optional[UUID] = None, mode: str = EXTRACT_FPS,
+            decoder: Optional[DecoderConfig] = None
+    ) -> FrameIterator:
+        """Returns an open FrameIterator for the video; the keyframe index is that of tbl_id, if given.
+
+        Modes other than EXTRACT_FPS require tbl_id.
+        """
+        decoder = decoder or DecoderConfig()
+        key = (video_path_str, fps, mode, decoder)
+        with self.lock:
+            frames = self.frames.get(key)
+            if frames is not None:
+                result = frames.pop()
+                if len(frames) == 0:
+                    del self.frames[key]
+                self.num_open -= 1
+                return result
+        keyframes = KeyframeIndex.get(tbl_id, video_path_str) if tbl_id is not None else None
+        positions = get_frame_positions(video_path_str, mode, tbl_id)
+        result = FrameIterator(video_path_str, fps=fps, keyframes=keyframes, positions=positions, decoder=decoder)
+        result.pool_key = key
+        return result
+
+    def release(self, frames: FrameIterator) -> None:
+        """Returns frames to the pool"""
+        if frames.video_reader is None or frames.pool_key is None:
+            # exhausted, or not from the pool
+            return
+        to_close: List[FrameIterator] = []
+        with self.lock:
+            key = frames.pool_key
+            self.frames.setdefault(key, []).append(frames)
+            self.frames.move_to_end(key)
+            self.num_open += 1
+            while self.num_open > self.MAX_OPEN:
+                lru_key, lru_frames = next(iter(self.frames.items()))
+                to_close.append(lru_frames.pop(0))
+                if len(lru_frames) == 0:
+                    del self.frames[lru_key]
+                self.num_open -= 1
+        for f in to_close:
+            f.close()
+
+    def clear(self) -> None:
+        """Close all pooled iterators"""
+        with self.lock:
+            frames = [f for frames in self.frames.values() for f in frames]
+            self.frames.clear()
+            self.num_open = 0
+        for f in frames:
+            f.close()